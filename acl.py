@@ -0,0 +1,57 @@
+class ACL:
+    """
+    This object maps chat and user ids to a bitmask of their roles.
+
+    It is built once from the configuration lists, so every auth question is
+    a single dict lookup. It is never mutated afterwards: a config reload
+    builds a new ACL and swaps the reference, so readers holding the old one
+    keep a consistent view.
+    """
+
+    ADM = 1
+    OPERATIONAL = 2
+    RESTRICTED = 4
+    MOTD_ONLY = 8
+    INVASIVE_WASHSNAKE = 16
+
+    # Config list -> role of the ids in it.
+    CONFIG_ROLES = (('adm_ids', ADM),
+                    ('operational_chats', OPERATIONAL),
+                    ('restricted_chats', RESTRICTED),
+                    ('motd_only_chats', MOTD_ONLY),
+                    ('invasive_washsnake_chats', INVASIVE_WASHSNAKE))
+
+    __slots__ = ('roles', )
+
+    def __init__(self,
+                 config):
+        """
+        Arguments:
+            config (dict):
+                Configuration with any of the lists in CONFIG_ROLES.
+        """
+        roles = dict()
+        for key, role in self.CONFIG_ROLES:
+            for id in config.get(key) or []:
+                roles[id] = roles.get(id, 0) | role
+        self.roles = roles
+
+    def roles_of(self,
+                 id):
+        """
+        Returns:
+            Role bitmask of id, 0 when it has none.
+        """
+        return self.roles.get(id, 0)
+
+    def has(self,
+            id,
+            mask):
+        """
+        Returns:
+            True when id holds any role in mask.
+        """
+        return bool(self.roles.get(id, 0) & mask)
+
+    def __len__(self):
+        return len(self.roles)
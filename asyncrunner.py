@@ -0,0 +1,120 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+class AsyncUpdateRunner:
+    """
+    This object runs a bot's update loop on asyncio.
+
+    Updates of one chat are handled in order, different chats run
+    concurrently on a thread pool. Fetching with a higher offset confirms
+    the updates before it to Telegram, so the next batch is only fetched,
+    and bot.LAST_UPDATE_ID only advances, once the whole batch has been
+    handled: a crash mid-batch gets the batch again on restart.
+
+    The bot must provide get_latest_update_id(), handle_update(update),
+    LAST_UPDATE_ID and a `bot` attribute implementing getUpdates().
+    """
+
+    def __init__(self,
+                 bot,
+                 workers = 8,
+                 timeout = 10,
+                 metrics = None):
+        """
+        Arguments:
+            metrics (Optional[Metrics]):
+                Receives 'fetch' latencies and 'fetch_errors' counts.
+        """
+        self.bot = bot
+        self.metrics = metrics
+        self.workers = workers
+        self.timeout = timeout
+        self.logger = logging.getLogger("AsyncUpdateRunner")
+        self.is_running = False
+
+    def run(self):
+        """
+        Block and run the loop until stop() is called or interrupted.
+        """
+        asyncio.run(self.main())
+
+    def stop(self):
+        """
+        Stop after the batch being handled.
+        """
+        self.is_running = False
+
+    def fetch(self,
+              offset):
+        """
+        Returns:
+            List of updates after offset, empty on errors.
+        """
+        try:
+            if self.metrics:
+                return self.metrics.timed('fetch', self.bot.bot.getUpdates, offset = offset, timeout = self.timeout)
+            return self.bot.bot.getUpdates(offset = offset, timeout = self.timeout)
+        except Exception:
+            if self.metrics:
+                self.metrics.inc('fetch_errors')
+            self.logger.exception('!!! Fetching updates failed !!!')
+            return None
+
+    @staticmethod
+    def chat_of(update):
+        """
+        Returns:
+            Chat id an update belongs to, or None.
+        """
+        mesg = update.message or update.edited_message
+        return mesg.chat_id if mesg else None
+
+    def handle_chat(self,
+                    updates):
+        """Handle updates of a single chat in order."""
+        for update in updates:
+            try:
+                self.bot.handle_update(update)
+            except Exception:
+                self.logger.exception('!!! EXCEPTION HAS OCCURRED !!!')
+
+    async def handle_batch(self,
+                           loop,
+                           executor,
+                           updates):
+        """Handle a batch: one task per chat, all chats concurrently."""
+        chats = OrderedDict()
+        for update in updates:
+            chats.setdefault(self.chat_of(update), []).append(update)
+
+        await asyncio.gather(*[loop.run_in_executor(executor, self.handle_chat, ups)
+                               for ups in chats.values()])
+
+    async def main(self):
+        loop = asyncio.get_running_loop()
+        # Fetching gets its own thread so a long poll never takes a handler worker.
+        fetcher = ThreadPoolExecutor(max_workers = 1)
+        executor = ThreadPoolExecutor(max_workers = self.workers)
+
+        self.bot.get_latest_update_id()
+        self.is_running = True
+
+        offset = self.bot.LAST_UPDATE_ID
+        try:
+            while self.is_running:
+                updates = await loop.run_in_executor(fetcher, self.fetch, offset)
+
+                if updates is None:
+                    # Retry the same offset after a short break, nothing is skipped.
+                    await asyncio.sleep(1)
+                    continue
+
+                if updates:
+                    await self.handle_batch(loop, executor, updates)
+                    offset = updates[-1].update_id + 1
+                    self.bot.LAST_UPDATE_ID = offset
+        finally:
+            fetcher.shutdown(wait = False)
+            executor.shutdown(wait = True)
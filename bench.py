@@ -0,0 +1,491 @@
+#!/usr/bin/env python3
+## coding=UTF-8
+#
+# Offline replay benchmark for the AFXBot and Eatsnakebot message pipelines.
+#
+# Synthetic (or recorded) updates are fed through handle_update() with a stub
+# in place of telegram.Bot, against generated databases of configurable size.
+# Results are printed as JSON, e.g.:
+#
+#     python3 bench.py --keywords 10000 --restaurants 100000 -o bench.json
+#
+
+import argparse
+import json
+import logging
+import os
+import random
+import sqlite3
+import string
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from acl import ACL
+from botstate import BotState
+from dbpool import open_db
+from dice import DiceRoller
+from fortunecache import FortuneCache
+from kwspace import KeywordSpaces
+from metrics import Histogram, Metrics
+from motdstore import MotdStore
+from washrecord import WashRecord
+
+# Chat and admin ids used by synthetic updates.
+BENCH_CHAT = -100
+BENCH_ADM = 1
+
+class StubBot:
+    """
+    This object stands in for telegram.Bot: every API call is counted and
+    answered with a minimal message object.
+    """
+
+    def __init__(self):
+        self.calls = Counter()
+        self.message_id = 0
+
+    def getUpdates(self, *args, **kwargs):
+        return []
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            self.calls[name] += 1
+            self.message_id += 1
+            return SimpleNamespace(message_id = self.message_id,
+                                   photo = [SimpleNamespace(file_id = 'stub')])
+        return call
+
+class DirectDispatcher:
+    """
+    This object replaces SendDispatcher, sending synchronously and without rate
+    limits so the measured latency is the handling itself.
+    """
+
+    def __init__(self,
+                 owner):
+        self.owner = owner
+
+    def send_message(self,
+                     chat_id,
+                     text,
+                     reply_to_message_id = None):
+        self.owner.bot.sendMessage(chat_id = chat_id, text = text, reply_to_message_id = reply_to_message_id)
+
+    def call(self,
+             method,
+             **kwargs):
+        getattr(self.owner.bot, method)(**kwargs)
+
+    def pending(self):
+        return 0
+
+def random_word(rnd, lo = 3, hi = 8):
+    return ''.join(rnd.choice(string.ascii_lowercase) for i in range(rnd.randint(lo, hi)))
+
+def make_resp_db(path,
+                 n_keywords,
+                 n_get_keywords,
+                 per_keyword = 3,
+                 seed = 0):
+    """
+    Create a resp database shaped like resp_db_example.sqlite.
+
+    Returns:
+        (keywords, get keywords)
+    """
+    rnd = random.Random(seed)
+    conn = sqlite3.connect(path)
+    conn.executescript('''
+        CREATE TABLE resp (IIDX INTEGER PRIMARY KEY, keyword TEXT, cont TEXT, gid INTEGER NOT NULL DEFAULT -1);
+        CREATE TABLE resp_get (IIDX INTEGER PRIMARY KEY, keyword TEXT, cont TEXT, tag TEXT DEFAULT null, gid INTEGER NOT NULL DEFAULT -1);
+        CREATE TABLE symptom (IIDX INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT, before TEXT NOT NULL, after TEXT NOT NULL, gid INTEGER NOT NULL DEFAULT -1);
+        CREATE TABLE symptom_get (IIDX INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT, before TEXT NOT NULL, after TEXT NOT NULL, gid INTEGER NOT NULL DEFAULT -1);
+    ''')
+
+    keywords = set()
+    while len(keywords) < n_keywords:
+        keywords.add('kw' + random_word(rnd))
+    keywords = sorted(keywords)
+    conn.executemany('INSERT INTO resp (keyword, cont) VALUES (?, ?)',
+                     ((kw, 'reply {0} {1}'.format(kw, i)) for kw in keywords for i in range(per_keyword)))
+    # A symptom for every tenth keyword.
+    conn.executemany('INSERT INTO symptom (before, after) VALUES (?, ?)',
+                     (('alias' + kw, kw) for kw in keywords[::10]))
+
+    get_keywords = ['get' + str(i) for i in range(n_get_keywords)]
+    conn.executemany('INSERT INTO resp_get (keyword, cont, tag) VALUES (?, ?, ?)',
+                     ((kw, 'photo-{0}-{1}'.format(kw, i), rnd.choice([None, 'a', 'b']))
+                      for kw in get_keywords for i in range(per_keyword)))
+
+    conn.commit()
+    conn.close()
+    return keywords, get_keywords
+
+def make_loc_db(path,
+                n_restaurants,
+                seed = 0):
+    """
+    Create a restaurant database with the locDBHelper.setup() schema, spread
+    over about 20km around NTU.
+
+    Returns:
+        List of tags used.
+    """
+    rnd = random.Random(seed)
+    tags = ['ramen', 'curry', 'noodles', 'rice', 'burger', 'hotpot', 'vegan', 'bento']
+    conn = sqlite3.connect(path)
+    conn.execute('''CREATE TABLE restaurants (idx INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL,
+                    pricerange INTEGER, mincharge TEXT, address TEXT, optime TEXT, tags TEXT,
+                    latitude REAL, longitude REAL, others TEXT)''')
+    conn.executemany('INSERT INTO restaurants (name, pricerange, mincharge, address, tags, latitude, longitude) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                     (('r{0}'.format(i), rnd.randint(50, 500), None, 'addr {0}'.format(i),
+                       ','.join(rnd.sample(tags, 2)),
+                       25.017356 + rnd.uniform(-0.1, 0.1), 121.539755 + rnd.uniform(-0.1, 0.1))
+                      for i in range(n_restaurants)))
+    conn.commit()
+    conn.close()
+    return tags
+
+def make_update(update_id,
+                text = None,
+                chat_id = BENCH_CHAT,
+                user_id = None,
+                location = None):
+    """
+    Returns:
+        Object with the telegram.Update attributes the bots read.
+    """
+    message = SimpleNamespace(chat_id = chat_id,
+                              chat = SimpleNamespace(id = chat_id),
+                              message_id = update_id,
+                              from_user = SimpleNamespace(id = user_id if user_id is not None else 1000 + update_id),
+                              date = datetime.now(),
+                              text = text,
+                              photo = None,
+                              location = location)
+    return SimpleNamespace(update_id = update_id, message = message, edited_message = None)
+
+def load_recorded(file_name):
+    """
+    Read recorded updates, one Update JSON per line, as produced by
+    telegram.Update.to_json().
+
+    Returns:
+        List of (scenario, update).
+    """
+    updates = []
+    with open(file_name, 'r', encoding = 'utf8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            data = json.loads(line)
+            mesg = data.get('message') or {}
+            loc = mesg.get('location')
+            updates.append(('recorded', make_update(data['update_id'],
+                                                    mesg.get('text'),
+                                                    mesg.get('chat', {}).get('id', BENCH_CHAT),
+                                                    mesg.get('from', {}).get('id'),
+                                                    SimpleNamespace(**loc) if loc else None)))
+    return updates
+
+def base_strings():
+    with open('strings_example.json', 'r', encoding = 'utf8') as f:
+        strs = json.loads(f.read())
+    # Keys read by the bots but missing in the example strings.
+    strs.setdefault('r_invasive_random_angry_strs', ['!'])
+    strs.setdefault('q_eatsnake_kws', ['吃蛇', 'eatsnake'])
+    return strs
+
+def make_afxbot(resp_db,
+                strs):
+    """
+    Returns:
+        AFXBot set up like __init__ does, without argparse and telegram.Bot.
+    """
+    from eatsnake import AFXBot
+
+    bot = AFXBot.__new__(AFXBot)
+    bot.LAST_UPDATE_ID = None
+    bot.NOW_HANDLING_UPDATE_ID = None
+    bot.logger = logging.getLogger('bench.AFXBot')
+    config = {'resp_db': resp_db,
+              'loc_db': ':memory:',
+              'adm_ids': [BENCH_ADM],
+              'operational_chats': [BENCH_CHAT],
+              'restricted_chats': [],
+              'invasive_washsnake_chats': []}
+    bot.state = BotState(config, strs, ACL(config),
+                         wash_snake_strs_unified = strs['r_wash_snake_strs'] + strs['r_invasive_wash_snake_strs'])
+    bot.pinned_state = threading.local()
+    bot.motd_store = MotdStore(open_db(':memory:'), 60)
+    bot.motd_store.set(BENCH_CHAT, 'bench')
+    bot.resp_db = None
+    bot.loc_db = None
+    bot.is_running = True
+    bot.is_accepting_photos = False
+    bot.wash_record = WashRecord(timedelta(seconds = 60), 256)
+    bot.dice = DiceRoller()
+    bot.fortune_cache = FortuneCache()
+    bot.metrics = Metrics()
+    bot.metrics.gauge('fortune_cache_hits', lambda: bot.fortune_cache.hits)
+    bot.metrics.gauge('fortune_cache_misses', lambda: bot.fortune_cache.misses)
+    bot.metrics_server = None
+    bot.recognition_list = []
+    bot.bot = StubBot()
+    bot.dispatcher = DirectDispatcher(bot)
+
+    # Fortune tables are not defined by AFXBot in this tree; minimal ones here.
+    if not hasattr(bot, 'fortune_strs'):
+        bot.fortune_strs = ['大吉', '中吉', '小吉', '吉', '末吉', '凶', '大凶']
+    if not hasattr(bot, 'fortune_types'):
+        bot.fortune_types = {'今日': 0, '明日': 1}
+    if not hasattr(bot, 'match_fortune_type'):
+        bot.match_fortune_type = lambda mesg: next((t for t in bot.fortune_types if t + '運勢' in mesg), None)
+
+    bot.register_callbacks()
+    bot.init_resp()
+    return bot
+
+def make_litebot(loc_db,
+                 strs):
+    """
+    Returns:
+        Eatsnakebot set up like __init__ does, without argparse and telegram.Bot.
+    """
+    from eatsnake_lite import Eatsnakebot
+
+    bot = Eatsnakebot.__new__(Eatsnakebot)
+    bot.LAST_UPDATE_ID = None
+    bot.NOW_HANDLING_UPDATE_ID = None
+    bot.logger = logging.getLogger('bench.Eatsnakebot')
+    config = {'loc_db': loc_db,
+              'adm_ids': [BENCH_ADM],
+              'operational_chats': [BENCH_CHAT],
+              'restricted_chats': [],
+              'eatsnake_nearby_k': 10}
+    bot.state = BotState(config, strs, ACL(config))
+    bot.pinned_state = threading.local()
+    bot.loc_list = []
+    bot.is_running = True
+    bot.is_accepting_photos = False
+    bot.metrics = Metrics()
+    bot.metrics_server = None
+    bot.recognition_list = []
+    bot.bot = StubBot()
+    bot.dispatcher = DirectDispatcher(bot)
+
+    bot.register_callbacks()
+    bot.init_locdb()
+    return bot
+
+def afx_updates(n,
+                keywords,
+                get_keywords,
+                scenarios,
+                rnd):
+    """
+    Returns:
+        List of (scenario, update) for AFXBot.
+    """
+    gens = {
+        'response': lambda: 'so {0} today'.format(rnd.choice(keywords)),
+        'miss': lambda: ' '.join(random_word(rnd) for i in range(8)),
+        'get': lambda: '/get {0}'.format(rnd.choice(get_keywords)),
+        'get_tag': lambda: '/get {0} {1}'.format(rnd.choice(get_keywords), rnd.choice(['a', 'b'])),
+        'roll': lambda: rnd.choice(['/roll', '/roll 3d6+2', '/roll 10d10s6', '/roll 1-20', '/roll 100d100', '/roll 4d6k3', '/roll 10d6!', '/roll 100000d6']),
+        'fortune': lambda: rnd.choice(['今日運勢', '明日運勢']),
+        'motd': lambda: '/motd',
+        'motd_history': lambda: rnd.choice(['/motd history 7', '/motd ' + datetime.now().strftime('%Y-%m-%d')]),
+        'ls_kw': lambda: '/adm ls_kw {0}'.format(rnd.choice(keywords)),
+        'ls_get': lambda: '/adm ls_get {0}'.format(rnd.choice(get_keywords)),
+        'ls_page': lambda: '/adm {0} page {1}'.format(rnd.choice(['ls_kw', 'ls_get']), rnd.randint(1, 20)),
+    }
+    adm = ('ls_kw', 'ls_get', 'ls_page')
+    return [(s, make_update(i, gens[s](), user_id = BENCH_ADM if s in adm else None))
+            for i, s in enumerate(rnd.choice(scenarios) for i in range(n))]
+
+def lite_updates(n,
+                 tags,
+                 strs,
+                 scenarios,
+                 rnd):
+    """
+    Returns:
+        List of (scenario, update) for Eatsnakebot.
+    """
+    kw = strs['q_eatsnake_kws'][0]
+    out = []
+    for i in range(n):
+        s = rnd.choice(scenarios)
+        if s == 'eatsnake':
+            out.append((s, make_update(i, kw)))
+        elif s == 'eatsnake_filtered':
+            out.append((s, make_update(i, '{0} {1} <{2}'.format(kw, rnd.choice(tags), rnd.randint(100, 400)))))
+        elif s == 'eatsnake_nearby':
+            loc = SimpleNamespace(latitude = 25.017356 + rnd.uniform(-0.05, 0.05),
+                                  longitude = 121.539755 + rnd.uniform(-0.05, 0.05))
+            out.append((s, make_update(i, None, location = loc)))
+    return out
+
+def replay(bot,
+           updates):
+    """
+    Feed updates through bot.handle_update().
+
+    Returns:
+        Result dict: overall and per-scenario throughput and latency in ms.
+    """
+    hists = dict()
+    routes = Counter()
+    started = time.perf_counter()
+    for scenario, update in updates:
+        t = time.perf_counter()
+        routes[str(bot.handle_update(update))] += 1
+        hists.setdefault(scenario, Histogram(len(updates))).observe(time.perf_counter() - t)
+    elapsed = time.perf_counter() - started
+
+    result = {'updates': len(updates),
+              'seconds': round(elapsed, 6),
+              'updates_per_sec': round(len(updates) / elapsed, 1) if elapsed else None,
+              'routes': dict(routes),
+              'api_calls': dict(bot.bot.calls),
+              'scenarios': dict()}
+    for scenario, h in sorted(hists.items()):
+        p50, p95, p99 = h.quantiles((0.5, 0.95, 0.99))
+        result['scenarios'][scenario] = {'count': h.count,
+                                         'mean_ms': round(h.sum / h.count * 1000, 4),
+                                         'p50_ms': round(p50 * 1000, 4),
+                                         'p95_ms': round(p95 * 1000, 4),
+                                         'p99_ms': round(p99 * 1000, 4)}
+    return result
+
+def stage_summary(metrics):
+    """
+    Returns:
+        Stage latencies collected by the bot's own Metrics, in ms.
+    """
+    hists = metrics.snapshot()[0]
+    out = dict()
+    for (stage, route), (count, total, qv) in sorted(hists.items(), key = lambda x: (x[0][0], str(x[0][1]))):
+        name = stage if route is None else '{0}[{1}]'.format(stage, route)
+        out[name] = {'count': count,
+                     'p50_ms': round(qv[0] * 1000, 4),
+                     'p95_ms': round(qv[1] * 1000, 4),
+                     'p99_ms': round(qv[2] * 1000, 4)}
+    return out
+
+def query_latency(path,
+                  keywords,
+                  get_keywords,
+                  n,
+                  rnd):
+    """
+    Returns:
+        Mean microseconds of the SQL lookups behind /adm ls_kw, /adm ls_get,
+        a tagged /get and a symptom, on the database as it is.
+    """
+    conn = sqlite3.connect(path)
+    queries = {'ls_kw': ('SELECT IIDX, cont FROM resp WHERE keyword = ? ORDER BY IIDX ASC;',
+                         lambda: (rnd.choice(keywords), )),
+               'ls_get': ('SELECT IIDX, cont, tag FROM resp_get WHERE keyword = ? ORDER BY IIDX ASC;',
+                          lambda: (rnd.choice(get_keywords), )),
+               'get_tag': ('SELECT cont FROM resp_get WHERE keyword = ? AND tag = ?;',
+                           lambda: (rnd.choice(get_keywords), rnd.choice(['a', 'b']))),
+               'symptom': ('SELECT after FROM symptom WHERE before = ?;',
+                           lambda: ('alias' + rnd.choice(keywords), ))}
+    out = dict()
+    for name, (sql, args) in queries.items():
+        out[name] = time_calls(lambda: conn.execute(sql, args()).fetchall(), n)
+    out['schema_version'] = conn.execute('PRAGMA user_version').fetchone()[0]
+    conn.close()
+    return out
+
+def time_calls(func,
+               n):
+    """
+    Returns:
+        Mean microseconds per func() call over n calls.
+    """
+    t = time.perf_counter()
+    for i in range(n):
+        func()
+    return round((time.perf_counter() - t) / n * 1e6, 3)
+
+def main():
+    arg_parser = argparse.ArgumentParser(description = 'Offline replay benchmark for the bot pipelines.')
+    arg_parser.add_argument('--keywords', type = int, default = 1000, help = 'resp keywords (e.g. 100 - 100000)')
+    arg_parser.add_argument('--get-keywords', type = int, default = 200, help = 'resp_get keywords')
+    arg_parser.add_argument('--restaurants', type = int, default = 10000, help = 'restaurants (e.g. 10000 - 1000000)')
+    arg_parser.add_argument('--updates', type = int, default = 5000, help = 'updates replayed per bot')
+    arg_parser.add_argument('--afx-scenarios', default = 'response,miss,get,get_tag,roll,fortune,motd,motd_history,ls_kw,ls_get,ls_page')
+    arg_parser.add_argument('--lite-scenarios', default = 'eatsnake,eatsnake_filtered,eatsnake_nearby')
+    arg_parser.add_argument('--bots', default = 'afx,lite', help = 'which bots to run')
+    arg_parser.add_argument('--replay', help = 'recorded updates (one Update JSON per line) for AFXBot instead of synthetic ones')
+    arg_parser.add_argument('--seed', type = int, default = 0)
+    arg_parser.add_argument('-o', '--output', help = 'write JSON results to this file instead of stdout')
+    args = arg_parser.parse_args()
+
+    logging.basicConfig(level = logging.WARNING)
+    rnd = random.Random(args.seed)
+    strs = base_strings()
+    bots = args.bots.split(',')
+    results = {'date': datetime.now().isoformat(timespec = 'seconds'),
+               'params': vars(args)}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if 'afx' in bots:
+            resp_db = os.path.join(tmp, 'resp.sqlite')
+            keywords, get_keywords = make_resp_db(resp_db, args.keywords, args.get_keywords, seed = args.seed)
+
+            # make_afxbot() migrates the database, indexes included.
+            queries_before = query_latency(resp_db, keywords, get_keywords, 200, rnd)
+            t = time.perf_counter()
+            bot = make_afxbot(resp_db, strs)
+            load = time.perf_counter() - t
+            queries_after = query_latency(resp_db, keywords, get_keywords, 200, rnd)
+
+            if args.replay:
+                updates = load_recorded(args.replay)
+            else:
+                updates = afx_updates(args.updates, keywords, get_keywords, args.afx_scenarios.split(','), rnd)
+            results['afx'] = replay(bot, updates)
+            results['afx']['load_seconds'] = round(load, 6)
+            results['afx']['queries_us'] = {'before_migration': queries_before, 'after_migration': queries_after}
+            results['afx']['stages'] = stage_summary(bot.metrics)
+            results['afx']['fortune_cache'] = {'hits': bot.fortune_cache.hits, 'misses': bot.fortune_cache.misses}
+            results['afx']['find_all_us'] = time_calls(lambda: KeywordSpaces.find_all(bot.kw_spaces.of_chat(BENCH_CHAT), 'so {0} today'.format(rnd.choice(keywords))), 1000)
+            bot.resp_db.close()
+
+        if 'lite' in bots:
+            loc_db = os.path.join(tmp, 'loc.sqlite')
+            tags = make_loc_db(loc_db, args.restaurants, seed = args.seed)
+
+            t = time.perf_counter()
+            bot = make_litebot(loc_db, strs)
+            load = time.perf_counter() - t
+
+            updates = lite_updates(args.updates, tags, strs, args.lite_scenarios.split(','), rnd)
+            results['lite'] = replay(bot, updates)
+            results['lite']['load_seconds'] = round(load, 6)
+            results['lite']['stages'] = stage_summary(bot.metrics)
+            results['lite']['get_choice_us'] = time_calls(bot.loc_db.get_choice, 1000)
+            results['lite']['get_choice_weighted_us'] = time_calls(lambda: bot.loc_db.get_choice(weighted = True), 1000)
+            results['lite']['get_nearby_us'] = time_calls(lambda: bot.loc_db.get_nearby(25.017356, 121.539755, 10), 1000)
+            bot.loc_db.db.close()
+
+    out = json.dumps(results, indent = 2, ensure_ascii = False)
+    if args.output:
+        with open(args.output, 'w', encoding = 'utf8') as f:
+            f.write(out + '\n')
+    else:
+        print(out)
+
+if __name__ == '__main__':
+    main()
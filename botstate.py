@@ -0,0 +1,98 @@
+from types import MappingProxyType
+
+class BotState:
+    """
+    This object holds what a config reload replaces: config, L10N strings,
+    the unified wash snake strings, ACL and the routing tables.
+
+    It is never mutated once built. A reload builds a new one aside and
+    swaps the single bot.state reference, and each update pins the state it
+    started with, so no handler sees config of one reload next to strings
+    or routes of another.
+    """
+
+    __slots__ = ('config', 'strs', 'wash_snake_strs_unified', 'acl', 'tables')
+
+    def __init__(self,
+                 config,
+                 strs = None,
+                 acl = None,
+                 tables = None,
+                 wash_snake_strs_unified = None):
+        """
+        Arguments:
+            config (dict):
+                Configuration.
+            strs (Optional[dict]):
+                L10N strings.
+            acl (Optional[ACL]):
+                ACL built from config.
+            tables (Optional[dict]):
+                Routing tables by attribute name, as build_callbacks() returns.
+            wash_snake_strs_unified (Optional[list]):
+                r_wash_snake_strs followed by r_invasive_wash_snake_strs.
+        """
+        object.__setattr__(self, 'config', MappingProxyType(config))
+        object.__setattr__(self, 'strs', MappingProxyType(strs) if strs is not None else None)
+        object.__setattr__(self, 'acl', acl)
+        object.__setattr__(self, 'tables', MappingProxyType(dict(tables or {})))
+        object.__setattr__(self, 'wash_snake_strs_unified',
+                           tuple(wash_snake_strs_unified) if wash_snake_strs_unified is not None else None)
+
+    def __setattr__(self,
+                    name,
+                    value):
+        raise AttributeError('BotState is immutable, build a new one with replace()')
+
+    def __getattr__(self,
+                    name):
+        # Routing tables read as attributes, e.g. state.router.
+        if name == 'tables':
+            raise AttributeError(name)
+        try:
+            return self.tables[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def replace(self,
+                **kwargs):
+        """
+        Returns:
+            New BotState with the given fields replaced.
+        """
+        fields = {k: getattr(self, k) for k in self.__slots__}
+        fields.update(kwargs)
+        for k in ('config', 'strs'):
+            if isinstance(fields[k], MappingProxyType):
+                fields[k] = dict(fields[k])
+        return BotState(**fields)
+
+def current_state(bot):
+    """
+    Returns:
+        State pinned by the update handled on this thread, otherwise bot.state.
+    """
+    return getattr(bot.pinned_state, 'state', None) or bot.state
+
+def pin_state(bot):
+    """
+    Pin bot.state to this thread until unpin_state(), so every read of the
+    update goes to the same state even if a reload swaps bot.state meanwhile.
+
+    Returns:
+        The pinned state.
+    """
+    state = bot.state
+    bot.pinned_state.state = state
+    return state
+
+def unpin_state(bot):
+    bot.pinned_state.state = None
+
+def state_property(name):
+    """
+    Returns:
+        Read-only bot attribute resolved from current_state().
+    """
+    return property(lambda bot: getattr(current_state(bot), name),
+                    doc = 'BotState.{0} of the current update.'.format(name))
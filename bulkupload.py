@@ -0,0 +1,209 @@
+import hashlib
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+class BulkUpload:
+    """
+    This object uploads a batch of photo files from a background thread.
+
+    Files are hashed and uploaded by a bounded pool of workers, each file
+    opened only while it is read. Contents already uploaded (by this or an
+    earlier, possibly interrupted run) are recorded by SHA-256 in the
+    `photo_upload` table and skipped, so a re-run resumes where the last
+    one stopped. Returned file_ids go straight into resp_get, committed in
+    small batches, and progress is shown by editing a single message.
+
+    Attributes:
+        keyword_of (func(path)):
+            Returns (keyword, tag) of the resp_get row of a file.
+        on_uploaded (func(rows)):
+            Called with [(IIDX, keyword, file_id, tag)] after each committed
+            batch, to update in-memory indexes.
+    """
+
+    CHUNK_SIZE = 1 << 16
+
+    def __init__(self,
+                 bot,
+                 db,
+                 files,
+                 chat_id,
+                 keyword_of,
+                 on_uploaded,
+                 gid = -1,
+                 workers = 4,
+                 batch_size = 20,
+                 progress_interval = 3.0,
+                 retries = 3,
+                 reply_to_message_id = None):
+        """
+        Arguments:
+            bot (telegram.Bot):
+                Uploads with sendPhoto to chat_id, reports with editMessageText.
+            db (DBPool):
+                Response database holding resp_get.
+            files (list of Path):
+                Photo files to upload.
+        """
+        self.bot = bot
+        self.db = db
+        self.files = files
+        self.chat_id = chat_id
+        self.keyword_of = keyword_of
+        self.on_uploaded = on_uploaded
+        self.gid = gid
+        self.workers = workers
+        self.batch_size = batch_size
+        self.progress_interval = progress_interval
+        self.retries = retries
+        self.reply_to_message_id = reply_to_message_id
+        self.logger = logging.getLogger("BulkUpload")
+
+        self.uploaded = 0
+        self.skipped = 0
+        self.failed = 0
+        # Hashes uploaded before, and the ones taken by a worker in this run.
+        self.known = set()
+        self.claimed = set()
+        self.lock = threading.Lock()
+        self.progress_id = None
+        self.thread = None
+
+        self.db.execute('''CREATE TABLE IF NOT EXISTS photo_upload (hash TEXT PRIMARY KEY,
+                                                                    file_id TEXT NOT NULL,
+                                                                    resp_get_iidx INTEGER)''')
+
+    @classmethod
+    def hash_file(cls,
+                  path):
+        """
+        Returns:
+            SHA-256 hex digest of the file, read in chunks.
+        """
+        digest = hashlib.sha256()
+        with open(str(path), 'rb') as f:
+            for chunk in iter(lambda: f.read(cls.CHUNK_SIZE), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def send_photo(self,
+                   path):
+        """
+        Upload one file, waiting out flood control up to `retries` times.
+
+        Returns:
+            file_id of the largest size of the uploaded photo.
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                with open(str(path), 'rb') as f:
+                    res = self.bot.sendPhoto(chat_id = self.chat_id, photo = f)
+                return res.photo[-1].file_id
+            except Exception as ex:
+                retry_after = getattr(ex, 'retry_after', None)
+                if not retry_after or attempt == self.retries:
+                    raise
+                self.logger.warning('flood control, retry {0} after {1}s'.format(path, retry_after))
+                time.sleep(retry_after)
+
+    def upload_one(self,
+                   path):
+        """
+        Returns:
+            ('uploaded', path, hash, file_id), ('skipped', path, hash, None)
+            or ('failed', path, hash, None).
+        """
+        digest = None
+        try:
+            digest = self.hash_file(path)
+            with self.lock:
+                if digest in self.known or digest in self.claimed:
+                    return ('skipped', path, digest, None)
+                self.claimed.add(digest)
+            return ('uploaded', path, digest, self.send_photo(path))
+        except Exception:
+            self.logger.exception('Failed to upload {0}'.format(path))
+            if digest:
+                with self.lock:
+                    self.claimed.discard(digest)
+            return ('failed', path, digest, None)
+
+    def write(self,
+              results):
+        """
+        Insert uploaded files into resp_get and photo_upload in one transaction.
+        """
+        rows = []
+        with self.db.writer() as conn:
+            for path, digest, file_id in results:
+                keyword, tag = self.keyword_of(path)
+                iidx = conn.execute('INSERT INTO resp_get (keyword, cont, tag, gid) VALUES (?, ?, ?, ?)',
+                                    (keyword, file_id, tag, self.gid)).lastrowid
+                rows.append((iidx, keyword, file_id, tag))
+                conn.execute('INSERT OR REPLACE INTO photo_upload (hash, file_id, resp_get_iidx) VALUES (?, ?, ?)',
+                             (digest, file_id, iidx))
+        self.on_uploaded(rows)
+
+    def progress_text(self,
+                      done = False):
+        return 'Photo upload{0}: {1}/{2}, {3} uploaded, {4} skipped, {5} failed'.format(
+            ' done' if done else '', self.uploaded + self.skipped + self.failed, len(self.files),
+            self.uploaded, self.skipped, self.failed)
+
+    def report(self,
+               done = False):
+        try:
+            if self.progress_id is None:
+                res = self.bot.sendMessage(chat_id = self.chat_id, text = self.progress_text(done),
+                                           reply_to_message_id = self.reply_to_message_id)
+                self.progress_id = res.message_id
+            else:
+                self.bot.editMessageText(chat_id = self.chat_id, message_id = self.progress_id,
+                                         text = self.progress_text(done))
+        except Exception:
+            self.logger.exception('Failed to report progress')
+
+    def run(self):
+        try:
+            self.upload_all()
+        except Exception:
+            self.logger.exception('Photo upload aborted')
+        self.report(True)
+        self.logger.info(self.progress_text(True))
+
+    def upload_all(self):
+        self.known = set(r[0] for r in self.db.fetchall('SELECT hash FROM photo_upload'))
+        self.report()
+        reported = time.monotonic()
+
+        pending = []
+        with ThreadPoolExecutor(max_workers = self.workers, thread_name_prefix = 'BulkUpload') as pool:
+            futures = [pool.submit(self.upload_one, path) for path in self.files]
+            for future in as_completed(futures):
+                status, path, digest, file_id = future.result()
+                if status == 'uploaded':
+                    self.uploaded += 1
+                    pending.append((path, digest, file_id))
+                elif status == 'skipped':
+                    self.skipped += 1
+                else:
+                    self.failed += 1
+
+                if len(pending) >= self.batch_size:
+                    self.write(pending)
+                    pending = []
+                if time.monotonic() - reported >= self.progress_interval:
+                    self.report()
+                    reported = time.monotonic()
+
+        if pending:
+            self.write(pending)
+
+    def start(self):
+        self.thread = threading.Thread(target = self.run, name = 'BulkUpload', daemon = True)
+        self.thread.start()
+
+    def is_alive(self):
+        return bool(self.thread) and self.thread.is_alive()
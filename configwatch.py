@@ -0,0 +1,70 @@
+import logging
+import os
+import threading
+
+class FileWatcher:
+    """
+    This object polls files for modification from a background thread and
+    calls back once per change.
+
+    Attributes:
+        paths (func()):
+            Returns the paths to watch, asked on every poll so a reload that
+            points to another file (e.g. a new strings_json) is followed.
+        callback (func()):
+            Called from the watcher thread when any watched file changed.
+    """
+
+    def __init__(self,
+                 paths,
+                 callback,
+                 interval = 5.0):
+        self.paths = paths
+        self.callback = callback
+        self.interval = interval
+        self.logger = logging.getLogger("FileWatcher")
+        self.stopped = threading.Event()
+        self.mtimes = self.stat()
+        self.thread = None
+
+    def stat(self):
+        """
+        Returns:
+            path -> modification time (None when missing) of the watched files.
+        """
+        mtimes = dict()
+        for p in self.paths():
+            try:
+                mtimes[p] = os.stat(p).st_mtime_ns
+            except OSError:
+                mtimes[p] = None
+        return mtimes
+
+    def poll(self):
+        """
+        Call back when the watched files changed since the last poll.
+
+        Returns:
+            True when a change was seen.
+        """
+        mtimes = self.stat()
+        if mtimes == self.mtimes:
+            return False
+
+        self.mtimes = mtimes
+        try:
+            self.callback()
+        except Exception:
+            self.logger.exception('Reload after file change failed')
+        return True
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.poll()
+
+    def start(self):
+        self.thread = threading.Thread(target = self.run, name = 'FileWatcher', daemon = True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,149 @@
+import logging
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+class DBPool:
+    """
+    This object manages the connections of one SQLite database.
+
+    Connections are opened once, in WAL mode with synchronous=NORMAL and a
+    larger page cache, and keep a statement cache so hot queries are not
+    compiled again. Readers borrow one of up to `readers` connections, so
+    they run concurrently under WAL; every write goes through the single
+    writer connection, one transaction at a time.
+
+    An in-memory database (':memory:') is private to its connection, so
+    readers then share the writer connection, serialized by its lock.
+    """
+
+    def __init__(self,
+                 dbname,
+                 readers = 4,
+                 cache_kb = 16384,
+                 cached_statements = 256):
+        """
+        Arguments:
+            readers (int):
+                Most reader connections opened, in addition to the writer.
+            cache_kb (int):
+                Page cache of each connection, in KiB.
+        """
+        self.dbname = dbname
+        self.readers = readers
+        self.cache_kb = cache_kb
+        self.cached_statements = cached_statements
+        self.logger = logging.getLogger("DBPool")
+
+        self.shared = dbname in ('', ':memory:')
+        self.write_lock = threading.RLock()
+        self.writer_conn = self._connect()
+        if not self.shared:
+            mode = self.writer_conn.execute('PRAGMA journal_mode=WAL').fetchone()[0]
+            if mode.lower() != 'wal':
+                self.logger.warning('{0}: journal_mode is {1}, not WAL'.format(dbname, mode))
+
+        self.idle = queue.LifoQueue()
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.dbname,
+                               check_same_thread = False,
+                               cached_statements = self.cached_statements)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA cache_size=-{0}'.format(int(self.cache_kb)))
+        return conn
+
+    @contextmanager
+    def reader(self):
+        """
+        Borrow a connection for reading, opened on demand up to `readers`.
+        """
+        if self.shared:
+            with self.write_lock:
+                yield self.writer_conn
+            return
+
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                spawn = self.opened < self.readers
+                if spawn:
+                    self.opened += 1
+            conn = self._connect() if spawn else self.idle.get()
+        try:
+            yield conn
+        finally:
+            self.idle.put(conn)
+
+    @contextmanager
+    def writer(self):
+        """
+        Hold the writer connection for one transaction: committed when the
+        block completes, rolled back when it raises.
+        """
+        with self.write_lock:
+            try:
+                yield self.writer_conn
+                self.writer_conn.commit()
+            except Exception:
+                self.writer_conn.rollback()
+                raise
+
+    def fetchall(self,
+                 sql,
+                 params = ()):
+        with self.reader() as conn:
+            return conn.execute(sql, params).fetchall()
+
+    def fetchone(self,
+                 sql,
+                 params = ()):
+        with self.reader() as conn:
+            return conn.execute(sql, params).fetchone()
+
+    def execute(self,
+                sql,
+                params = ()):
+        """
+        Run one write statement in its own transaction.
+
+        Returns:
+            The cursor, for lastrowid / rowcount.
+        """
+        with self.writer() as conn:
+            return conn.execute(sql, params)
+
+    def close(self):
+        with pools_lock:
+            if pools.get(self.dbname) is self:
+                del pools[self.dbname]
+        with self.write_lock:
+            self.writer_conn.close()
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+# dbname -> DBPool, so every user of a database shares its connections.
+pools = dict()
+pools_lock = threading.Lock()
+
+def open_db(dbname,
+            **kwargs):
+    """
+    Returns:
+        The DBPool of dbname, created by the first call (with kwargs).
+    """
+    if dbname in ('', ':memory:'):
+        return DBPool(dbname, **kwargs)
+    with pools_lock:
+        pool = pools.get(dbname)
+        if not pool:
+            pool = pools[dbname] = DBPool(dbname, **kwargs)
+        return pool
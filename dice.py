@@ -0,0 +1,218 @@
+import random
+import re
+from collections import Counter
+
+class DicePool:
+    """
+    This object holds a parsed dice expression and, once rolled, its result.
+
+    Attributes:
+        count, sides (int):
+            XdY, count clamped to the roller's max_dice.
+        keep (int or None):
+            kN: only the N highest dice count.
+        reroll (int or None):
+            rN: dice showing N or less are rerolled once.
+        explode (bool):
+            !: every die showing its highest face adds another die.
+        success (int or None):
+            sZ: count dice showing Z or more instead of summing.
+        modifier (int):
+            +M / -M added to the sum.
+        rolls (list of int):
+            Faces rolled, in order, including rerolls and exploded dice.
+        hist (Counter):
+            face -> dice showing it, over rolls.
+        exploded (int):
+            Dice added by explosions.
+    """
+    __slots__ = ('count', 'sides', 'keep', 'reroll', 'explode', 'success', 'modifier',
+                 'rolls', 'hist', 'exploded')
+
+    def __init__(self,
+                 count,
+                 sides,
+                 keep = None,
+                 reroll = None,
+                 explode = False,
+                 success = None,
+                 modifier = 0):
+        self.count = count
+        self.sides = sides
+        self.keep = keep
+        self.reroll = reroll
+        self.explode = explode
+        self.success = success
+        self.modifier = modifier
+        self.rolls = None
+        self.hist = None
+        self.exploded = 0
+
+    def expr(self):
+        """
+        Returns:
+            Canonical notation of the pool, e.g. 4d6k3 or 2d20+5.
+        """
+        s = '{0}d{1}'.format(self.count, self.sides)
+        if self.keep is not None:
+            s += 'k{0}'.format(self.keep)
+        if self.reroll is not None:
+            s += 'r{0}'.format(self.reroll)
+        if self.explode:
+            s += '!'
+        if self.success is not None:
+            s += 's{0}'.format(self.success)
+        elif self.modifier > 0:
+            s += '+{0}'.format(self.modifier)
+        elif self.modifier < 0:
+            s += str(self.modifier)
+        return s
+
+class DiceRoller:
+    """
+    This object parses and rolls /roll dice expressions:
+
+        XdY[kN][rN][!][sZ | +M | -M]
+
+    Every batch of dice is drawn with a single random.choices() call, and
+    sums, kept dice and success counts are taken from a face histogram, so
+    a roll costs O(dice) C-level work plus O(distinct faces) in Python.
+    Dice, including rerolled and exploded ones, are capped at max_dice, and
+    pools longer than max_listed are answered with the histogram (or
+    min/max/mean for dice with many faces) instead of every die.
+    """
+
+    NOTATION = re.compile('([0-9]+)d([0-9]+)(?:kh?([0-9]+))?(?:r([0-9]+))?(!)?(?:s([0-9]+)|([+-][0-9]+))?')
+
+    def __init__(self,
+                 max_dice = 100000,
+                 max_sides = 1000000,
+                 max_listed = 100,
+                 max_hist_sides = 20,
+                 rnd = None):
+        self.max_dice = max_dice
+        self.max_sides = max_sides
+        self.max_listed = max_listed
+        self.max_hist_sides = max_hist_sides
+        self.rnd = rnd or random
+
+    def parse(self,
+              text):
+        """
+        Returns:
+            DicePool of text, or None when text is not dice notation.
+        Raises:
+            ValueError: when text is dice notation which cannot be rolled.
+        """
+        res = self.NOTATION.match(text)
+        if not res:
+            return None
+
+        count, sides = int(res.group(1)), int(res.group(2))
+        if count < 1 or sides < 1 or sides > self.max_sides:
+            raise ValueError('Bad dice: {0}'.format(text))
+
+        pool = DicePool(min(count, self.max_dice), sides)
+        if res.group(3):
+            pool.keep = int(res.group(3))
+            if pool.keep < 1:
+                raise ValueError('Bad keep: {0}'.format(text))
+        if res.group(4):
+            pool.reroll = int(res.group(4))
+            if pool.reroll >= sides:
+                raise ValueError('Rerolling every face: {0}'.format(text))
+        if res.group(5):
+            if sides < 2:
+                raise ValueError('Exploding a 1-sided die: {0}'.format(text))
+            pool.explode = True
+        if res.group(6):
+            pool.success = int(res.group(6))
+        if res.group(7):
+            pool.modifier = int(res.group(7))
+        return pool
+
+    def roll(self,
+             pool):
+        """
+        Roll pool, filling in its rolls, hist and exploded.
+
+        Returns:
+            pool.
+        """
+        faces = range(1, pool.sides + 1)
+        rolls = self.rnd.choices(faces, k = pool.count)
+
+        if pool.reroll is not None:
+            low = pool.reroll
+            n = sum(1 for v in rolls if v <= low)
+            if n:
+                new = iter(self.rnd.choices(faces, k = n))
+                rolls = [next(new) if v <= low else v for v in rolls]
+
+        if pool.explode:
+            n = rolls.count(pool.sides)
+            while n and len(rolls) < self.max_dice:
+                batch = self.rnd.choices(faces, k = min(n, self.max_dice - len(rolls)))
+                rolls.extend(batch)
+                pool.exploded += len(batch)
+                n = batch.count(pool.sides)
+
+        pool.rolls = rolls
+        pool.hist = Counter(rolls)
+        return pool
+
+    def kept(self,
+             pool):
+        """
+        Returns:
+            face -> dice counted, the highest pool.keep dice if set.
+        """
+        if pool.keep is None or pool.keep >= len(pool.rolls):
+            return pool.hist
+
+        kept = dict()
+        left = pool.keep
+        for face in sorted(pool.hist, reverse = True):
+            kept[face] = min(left, pool.hist[face])
+            left -= kept[face]
+            if not left:
+                break
+        return kept
+
+    def describe_dice(self,
+                      pool):
+        """
+        Returns:
+            Every die as '(a, b, ...)' for short pools, a summary otherwise.
+        """
+        if len(pool.rolls) <= self.max_listed:
+            return '(' + ', '.join(map(str, pool.rolls)) + ')'
+        if pool.sides <= self.max_hist_sides:
+            return '[' + ', '.join('{0}×{1}'.format(f, pool.hist[f]) for f in sorted(pool.hist)) + ']'
+        return '[min {0}, max {1}, avg {2:.2f}]'.format(min(pool.hist), max(pool.hist),
+                                                        sum(pool.rolls) / len(pool.rolls))
+
+    def describe(self,
+                 pool):
+        """
+        Returns:
+            Reply text of a rolled pool.
+        """
+        dstr = '{0} : {1}'.format(pool.expr(), self.describe_dice(pool))
+        if pool.exploded:
+            dstr += ' +{0}!'.format(pool.exploded)
+
+        kept = self.kept(pool)
+        if pool.keep is not None and kept is not pool.hist and len(pool.rolls) <= self.max_listed:
+            dstr += ' → (' + ', '.join(str(f) for f in sorted(kept, reverse = True) for i in range(kept[f])) + ')'
+
+        if pool.success is not None:
+            succ = sum(c for f, c in kept.items() if f >= pool.success)
+            return '{0} >= {1}, 成功 {2} 次'.format(dstr, pool.success, succ)
+
+        total = sum(f * c for f, c in kept.items())
+        if pool.modifier == 0:
+            return '{0} = {1}'.format(dstr, total)
+
+        dm_str = '{0:+d}'.format(pool.modifier)
+        return '{0} {1} = {2} {1} = {3}'.format(dstr, dm_str, total, total + pool.modifier)
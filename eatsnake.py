@@ -19,28 +19,75 @@
 
 
 import argparse
+import atexit
 import hashlib
 import http
+import itertools
 import json
 import logging
 import random
 import re
 import requests
-import sqlite3
 import string
 import time
 import telegram
+import threading
 import urllib
+from acl import ACL
+from asyncrunner import AsyncUpdateRunner
+from botstate import BotState, pin_state, state_property, unpin_state
+from bulkupload import BulkUpload
 from collections import OrderedDict
+from configwatch import FileWatcher
 from datetime import date, datetime, timedelta
-from locdbHelper import locDBHelper
+from dbpool import open_db
+from dice import DiceRoller
+from fortunecache import FortuneCache
+from kwspace import KeywordSpaces
+from locdbhelper import locDBHelper
+from logutil import log_update, setup_logging
+from metrics import Metrics, MetricsServer
+from migrate import LOC_MIGRATIONS, RESP_MIGRATIONS, migrate
+from motdstore import MotdStore
 from pathlib import Path
+from router import CallbackRouter, ParsedMessage
+from senddispatcher import SendDispatcher
+from washrecord import WashRecord, WashSnake
+from webhook import WebhookServer
 
 class AFXBot:
     """
     This object represents a working Telegram bot.
 
     """
+
+    # Roles of chats allowed to use commands, and to reach the bot at all.
+    OPERATIONAL_ROLES = ACL.ADM | ACL.OPERATIONAL
+    AUGMENTED_ROLES = ACL.ADM | ACL.OPERATIONAL | ACL.RESTRICTED | ACL.MOTD_ONLY
+
+    # Longest range of /motd history N.
+    MOTD_HISTORY_MAX_DAYS = 31
+
+    # Config keys only read at start-up, reported by reload_configuration() when changed.
+    RESTART_KEYS = ('bot_token', 'resp_db', 'loc_db', 'db_readers', 'db_cache_kb',
+                    'motd_db', 'motd_flush_interval', 'motd_cache_size',
+                    'send_chat_rate', 'send_chat_burst', 'send_global_rate', 'async_workers',
+                    'webhook_url', 'webhook_listen', 'webhook_port', 'webhook_path', 'webhook_secret',
+                    'webhook_queue_size', 'webhook_workers', 'metrics_listen', 'metrics_port',
+                    'config_watch_interval')
+
+    # Read through the BotState pinned by the update being handled, see handle_update().
+    config = state_property('config')
+    strs = state_property('strs')
+    wash_snake_strs_unified = state_property('wash_snake_strs_unified')
+    acl = state_property('acl')
+    bot_callbacks_restricted = state_property('bot_callbacks_restricted')
+    bot_callbacks = state_property('bot_callbacks')
+    router_restricted = state_property('router_restricted')
+    router = state_property('router')
+    cmd_handlers = state_property('cmd_handlers')
+    adm_handlers = state_property('adm_handlers')
+
     def __init__(self,
                  conf_file_name = None,
                  **kwargs):
@@ -49,29 +96,46 @@ class AFXBot:
         self.NOW_HANDLING_UPDATE_ID = None
         self.logger = logging.getLogger()
         self.bot = None
-        self.motds = None
-        self.config = None
-        self.strs = None
+        self.motd_store = None
+        self.conf_file_name = None
+        self.resp_db = None
+        self.loc_db = None
+
+        # Config, strings, ACL and routing tables, replaced as one by reloads.
+        self.state = None
+        self.pinned_state = threading.local()
 
-        # Keyword and Symptom lists.
-        self.kw_list = None
-        self.kw_list_get = None
-        self.symptom_tbl = None
-        self.symptom_get = None
+        # Config reloads, by /adm reload or the file watcher.
+        self.reload_lock = threading.Lock()
+        self.config_watcher = None
 
-        # Unified with symptom entries.
-        self.unified_kw_list = None
-        self.unified_get_list = None
+        # Keyword, symptom and content tables in memory, partitioned by gid.
+        self.kw_spaces = None
 
         # Bot state
         self.is_running = True
         self.is_accepting_photos = False
+        self.bulkupload = None
+
+        # Anti-flood records, chat -> user -> WashSnake within the last 60 seconds.
+        self.wash_record = WashRecord(timedelta(seconds = 60), 256)
+
+        # /roll dice engine, pool sizes are capped.
+        self.dice = DiceRoller()
 
+        # Fortune-tell results of the day, per user and type.
+        self.fortune_cache = FortuneCache()
+
+        # Stage/route latencies, counters and queue depths.
+        self.metrics = Metrics()
+        self.metrics_server = None
 
         # Parse command line params
-        self.log_fmt_str = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
         arg_parser = argparse.ArgumentParser(description = 'Eatsnakebot, a simple Telegram bot in Python.')
-        arg_parser.add_argument('-l', '--logfile', help='Logfile Name', action='store_true')
+        arg_parser.add_argument('-l', '--logfile', help='Logfile path, rotated at 10 MB')
+        arg_parser.add_argument('--log-level', default='INFO', help='DEBUG, INFO, WARNING, ...')
+        arg_parser.add_argument('--log-json', help='JSON lines with update_id, chat_id, route and latency', action='store_true')
+        arg_parser.add_argument('--log-sample', help='Fraction of records below WARNING kept', type=float, default=1.0)
 
         args = arg_parser.parse_args()
 
@@ -79,16 +143,21 @@ class AFXBot:
         self.init_l10n_strings()
         self.init_motd()
 
-        if args.logfile:
-            logging.basicConfig( level=logging.DEBUG, format=self.log_fmt_str, filename=args.logfile)
-        else:
-            logging.basicConfig( level=logging.DEBUG, format=self.log_fmt_str)
+        self.log_listener = setup_logging(args.logfile, args.log_level, args.log_json, args.log_sample)
+        atexit.register(self.log_listener.stop)
         self.logger = logging.getLogger('NTUEatsnakebot')
-        self.logger.setLevel(logging.DEBUG)
 
         # Telegram Bot Authorization Token
         self.bot = telegram.Bot(self.config['bot_token'])
         self.api_url = "https://api.telegram.org/bot{}/".format(self.config['bot_token'])
+        self.dispatcher = SendDispatcher(self,
+                                         self.config.get('send_chat_rate', 1.0),
+                                         self.config.get('send_chat_burst', 3),
+                                         self.config.get('send_global_rate', 30.0),
+                                         metrics = self.metrics)
+        self.metrics.gauge('send_queue_depth', self.dispatcher.pending)
+        self.metrics.gauge('fortune_cache_hits', lambda: self.fortune_cache.hits)
+        self.metrics.gauge('fortune_cache_misses', lambda: self.fortune_cache.misses)
         self.register_callbacks()
         self.recognition_list = []
 
@@ -105,20 +174,11 @@ class AFXBot:
         # Load Configuration
         if not file_name:
             file_name = 'config.json'
+        self.conf_file_name = file_name
 
         try:
-            with open(file_name, 'r', encoding = 'utf8') as f:
-                self.config = json.loads(f.read())
-
-            # Check Configuration
-            configs_check = ['bot_token', 'resp_db', 'adm_ids', 'operational_chats', 'strings_json']
-            for c in configs_check:
-                self.check_config_entry(c)
-
-            list_configs_check = ['restricted_chats', 'motd_only_chats', 'invasive_washsnake_chats']
-            for c in list_configs_check:
-                self.check_config_entry_of_list(c)
-
+            config = self.load_configuration(file_name)
+            self.state = BotState(config, acl = ACL(config))
             self.init_resp()
         except FileNotFoundError:
             logging.exception('config file not found!')
@@ -129,55 +189,122 @@ class AFXBot:
         except:
             raise
 
-    def init_motd(self,
-                  file_name = 'motd.json'):
+    def load_configuration(self,
+                           file_name):
+        """
+        Read and check a configuration file without touching the running bot.
+
+        Returns:
+            Configuration dict.
+        """
+        with open(file_name, 'r', encoding = 'utf8') as f:
+            config = json.loads(f.read())
+
+        # Check Configuration
+        configs_check = ['bot_token', 'resp_db', 'adm_ids', 'operational_chats', 'strings_json']
+        for c in configs_check:
+            self.check_config_entry(config, c)
+
+        list_configs_check = ['restricted_chats', 'motd_only_chats', 'invasive_washsnake_chats']
+        for c in list_configs_check:
+            self.check_config_entry_of_list(config, c)
+
+        return config
+
+    def init_l10n_strings(self,
+                          file_name = None):
         """
-        Initialize MotD.
+        Initialize L10N strings.
 
         Arguments:
             file_name (Optional[str]):
-                Name of MotD file.
+                Name of L10N strings file, config['strings_json'] by default.
         """
-        # Load MotD
-        try:
-            with open(file_name, 'r', encoding = 'utf8') as f:
-                self.motds = json.loads(f.read())
-
-            # str -> datetime
-            for k in self.motds.keys():
-                self.motds[k]['date'] = datetime.strptime(self.motds[k]['date'], '%Y-%m-%d').date()
+        if not file_name:
+            file_name = self.config['strings_json']
 
-        except FileNotFoundError:
-            logging.exception('MOTD file not found!')
-        except ValueError:
-            logging.exception('MOTD read error!')
+        try:
+            strs = self.load_l10n_strings(file_name)
         except:
+            logging.exception('L10N Strings read error!')
             raise
 
-        if not self.motds:
-            self.motds = dict()
+        self.state = self.state.replace(strs = strs,
+                                        wash_snake_strs_unified = strs['r_wash_snake_strs'] + strs.get('r_invasive_wash_snake_strs', []))
+
+    def load_l10n_strings(self,
+                          file_name):
+        """
+        Read and check a L10N strings file without touching the running bot.
+
+        Returns:
+            Strings dict.
+        """
+        with open(file_name, 'r', encoding = 'utf8') as f:
+            strs = json.loads(f.read())
+
+        # Read directly by handle_update(); callback keywords are checked by register_callbacks().
+        for k in ['q_status_kw', 'qr_status_t', 'qr_status_f', 's_status_t_kw', 'sr_status_t_ok',
+                  'q_motd_kws', 'v_photo_bulkupload', 'vr_photo_bulkupload_no_file', 'r_wash_snake_strs']:
+            if k not in strs:
+                logging.error('strs[\'{0}\'] is missing!'.format(k))
+                raise ValueError
+
+        return strs
+
+    def init_motd(self,
+                  file_name = 'motd.json'):
+        """
+        Initialize MotD storage, config['motd_db'] flushed every
+        config['motd_flush_interval'] seconds.
+
+        Arguments:
+            file_name (Optional[str]):
+                Name of a legacy MotD file, imported into an empty database.
+        """
+        self.motd_store = MotdStore(open_db(self.config.get('motd_db', 'motd.sqlite')),
+                                    self.config.get('motd_flush_interval', 5.0),
+                                    file_name,
+                                    self.config.get('motd_cache_size', 1024))
+        # Pending MOTDs are written on a normal exit too.
+        atexit.register(self.motd_store.close)
 
     def check_config_entry(self,
+                           config,
                            name):
         """
         Check whether the config is sane.
         """
-        if not self.config[name]:
-            logging.error('config[\'{0}\'] is missing!')
+        if not config.get(name):
+            logging.error('config[\'{0}\'] is missing!'.format(name))
             raise ValueError
 
     def check_config_entry_of_list(self,
+                                   config,
                                    name):
         """
         Check whether the list in config is sane, or init a empty one.
         """
-        if not self.config[name]:
-            self.config[name] = []
+        if not config.get(name):
+            config[name] = []
 
-    def run():
+    def run(self):
         """
         Run the bot: start the loop to fetch updates and handle.
         """
+        self.start_metrics_server()
+        self.start_config_watcher()
+
+        # Updates pushed by Telegram when config['webhook_url'] is set.
+        if self.config.get('webhook_url'):
+            self.run_webhook()
+            return
+
+        # Concurrent handling when config['async_workers'] is set.
+        if self.config.get('async_workers'):
+            AsyncUpdateRunner(self, self.config['async_workers'], metrics = self.metrics).run()
+            return
+
         self.get_latest_update_id()
         self.recoverStatus = False
 
@@ -204,6 +331,94 @@ class AFXBot:
                 logging.exception('!!! EXCEPTION HAS OCCURRED !!!')
                 self.recover()
 
+    def run_webhook(self):
+        """
+        Register config['webhook_url'] with config['webhook_secret'] and serve
+        updates pushed to it at config['webhook_path'].
+        """
+        server = WebhookServer(self,
+                               self.config.get('webhook_listen', '127.0.0.1'),
+                               self.config.get('webhook_port', 8443),
+                               self.config.get('webhook_path'),
+                               self.config.get('webhook_secret'),
+                               self.config.get('webhook_queue_size', 1000),
+                               self.config.get('webhook_workers', 1))
+        self.metrics.gauge('webhook_queue_depth', server.queue.qsize)
+        self.bot.setWebhook(self.config['webhook_url'], secret_token = self.config['webhook_secret'])
+        try:
+            server.serve_forever()
+        finally:
+            server.stop()
+
+    def reload_configuration(self):
+        """
+        Reload configuration and L10N strings while the bot keeps serving.
+
+        Everything is read, checked and built aside into a new BotState,
+        which replaces self.state in one assignment once all of it
+        succeeded, so a broken file leaves the bot as it was and updates in
+        flight keep the state they pinned. Changes to RESTART_KEYS are
+        logged and left out until a restart.
+
+        Returns:
+            True when reloaded, otherwise False.
+        """
+        with self.reload_lock:
+            try:
+                config = self.load_configuration(self.conf_file_name)
+                strs = self.load_l10n_strings(config['strings_json'])
+                acl = ACL(config)
+                tables = self.build_callbacks(strs)
+                wash_snake_strs_unified = strs['r_wash_snake_strs'] + strs.get('r_invasive_wash_snake_strs', [])
+            except Exception:
+                self.logger.exception('Reload failed, keeping the running configuration')
+                return False
+
+            # Keep the running values, so config describes what is in effect.
+            running = self.state.config
+            not_applied = [k for k in self.RESTART_KEYS if config.get(k) != running.get(k)]
+            for k in not_applied:
+                if k in running:
+                    config[k] = running[k]
+                else:
+                    del config[k]
+            if not_applied:
+                self.logger.warning('Changed config not applied until restart: {0}'.format(', '.join(not_applied)))
+
+            # Everything is built, swap it in.
+            self.state = BotState(config, strs, acl, tables, wash_snake_strs_unified)
+            # Results depend on x_fortune_salt_str.
+            self.fortune_cache.clear()
+
+        self.logger.info('Configuration reloaded from {0}'.format(self.conf_file_name))
+        return True
+
+    def start_config_watcher(self):
+        """
+        Reload when the config or strings file changes, polled every
+        config['config_watch_interval'] seconds if set.
+        """
+        interval = self.config.get('config_watch_interval')
+        if not interval or self.config_watcher:
+            return
+
+        self.config_watcher = FileWatcher(lambda: [self.conf_file_name, self.config['strings_json']],
+                                          self.reload_configuration,
+                                          interval)
+        self.config_watcher.start()
+
+    def start_metrics_server(self):
+        """
+        Serve Prometheus-text metrics on localhost when config['metrics_port'] is set.
+        """
+        if not self.config.get('metrics_port') or self.metrics_server:
+            return
+
+        self.metrics_server = MetricsServer(self.metrics,
+                                            self.config.get('metrics_listen', '127.0.0.1'),
+                                            self.config['metrics_port'])
+        self.metrics_server.start()
+
     def recover(self):
         """
         Recover the bot in next loop.
@@ -219,104 +434,146 @@ class AFXBot:
         Fetch updates from server for further processes.
         """
         # Request updates after the last updated_id
-        for update in self.bot.getUpdates(offset = self.LAST_UPDATE_ID, timeout = 10):
-            self.logger.info('Update: ' + str(update));
-            # chat_id is required to reply any message
-            chat_id = update.message.chat_id
-            message = update.message.text
-            mesg_id = update.message.message_id
-            user_id = update.message.from_user.id
-            self.NOW_HANDLING_UPDATE_ID = update.update_id
-            self.logger.debug('Now handling update: {0}'.format(self.NOW_HANDLING_UPDATE_ID))
+        updates = self.metrics.timed('fetch', self.bot.getUpdates, offset = self.LAST_UPDATE_ID, timeout = 10)
+        for update in updates:
+            self.handle_update(update)
 
-            try:
-                if message:
-                    # YOU SHALL NOT PASS!
-                    # Only authorized group chats and users (admins) can access this bot.
-                    if not self.do_augmented_auth(update.message.chat.id):
-                        if '__FOR_RECOGNITION__' in message and not update.message.chat.id in self.recognition_list:
-                            self.send_generic_mesg(chat_id, 'Please contact moderator to add following id into ACL.')
-                            self.send_generic_mesg(chat_id, str(update.message.chat.id))
-                            self.recognition_list.append(update.message.chat.id)
-                        else:
-                            self.logger.info('Access denied from: ' + str(update.message.chat.id))
-
-                    elif self.handle_washsnake(update):
-                        nothing_todo = 1
-
-                    # Status querying.
-                    elif self.strs['q_status_kw'] in message:
-                        if self.is_running:
-                            self.send_generic_mesg(chat_id, self.strs['qr_status_t'], mesg_id)
-                        else:
-                            self.send_generic_mesg(chat_id, self.strs['qr_status_f'], mesg_id)
-
-                    # Only admins can re-enable bot.
-                    elif not self.is_running and message.startswith(self.strs['s_status_t_kw']) and self.do_adm_auth(user_id):
-                        self.send_generic_mesg(chat_id, self.strs['sr_status_t_ok'], mesg_id)
-                        self.init_resp()
-                        self.is_running = True
-
-                    # MOTDs are necessary.
-                    elif message.lower().startswith('/motd') or self.is_handle_motd(message):
-                        self.handle_motd(update)
-
-                    # Only MOTD for some special groups, otherwise...
-                    elif self.is_running and self.do_operational_auth(update.message.chat.id):
-                        # Batch update *.jpg in /images/
-                        if message.startswith(self.strs['v_photo_bulkupload']) and self.do_adm_auth(user_id):
-                            p = Path('images')
-                            fl = list(p.glob('*.jpg'))
-                            if len(fl) == 0:
-                                self.send_generic_mesg(chat_id, self.strs['vr_photo_bulkupload_no_file'], mesg_id)
-                            else:
-                                for image_name in fl:
-                                    # for uploading new photos
-                                    with open(str(image_name), 'rb') as nn:
-                                        photo_res = self.bot.sendPhoto(chat_id = chat_id, photo = nn)
-
-                                    photo_mesg = photo_res.photo[-1].file_id
-                                    self.send_generic_mesg(chat_id, photo_mesg, photo_res.message_id)
-
-
-                        # Reload keyword table
-                        # Disable bot
-                        # Enter/Exit photo upload mode
-                        # Handle ADM cmd/Common cmd/Fortune tell
-                        elif self.execute_callbacks(self.bot_callbacks, update):
-                            nothing_todo = 1
-
-                        # other...
-                        else:
-                            self.handle_response(update)
-                    elif self.is_running and update.message.chat.id in self.config['restricted_chats']:
-                        if self.execute_callbacks(self.bot_callbacks_restricted, update):
-                            nothing_todo = 1
-                    elif self.is_running:
-                        self.logger.debug('Not handling, in motd_only chats?')
+            # Updates global offset to get the new updates
+            self.LAST_UPDATE_ID = update.update_id + 1
+
+    def handle_update(self,
+                      update):
+        """
+        Handle a single update.
+
+        Args:
+            update (telegram.update):
+                Update object to handle.
+        Returns:
+            Name of the route which handled the update, or None.
+        """
+        # Config, strings, ACL and routes stay the ones of this state for the whole update.
+        state = pin_state(self)
+        try:
+            return self.dispatch_update(update, state)
+        finally:
+            unpin_state(self)
+
+    def dispatch_update(self,
+                        update,
+                        state):
+        """
+        Route a single update, see handle_update().
+
+        Args:
+            update (telegram.update):
+                Update object to handle.
+            state (BotState):
+                State pinned for this update.
+        Returns:
+            Name of the route which handled the update, or None.
+        """
+        self.logger.debug('Update: %s', update)
+        # chat_id is required to reply any message
+        chat_id = update.message.chat_id
+        message = update.message.text
+        mesg_id = update.message.message_id
+        user_id = update.message.from_user.id
+        self.NOW_HANDLING_UPDATE_ID = update.update_id
+        self.logger.debug('Now handling update: %s', self.NOW_HANDLING_UPDATE_ID)
+        route = None
+        started = time.perf_counter()
+        self.metrics.inc('updates')
+
+        try:
+            if message:
+                # Tokenized once, shared by every handler below.
+                parsed = ParsedMessage(message)
+                # Every role of the chat in one lookup.
+                chat_roles = self.metrics.timed('auth', state.acl.roles_of, update.message.chat.id)
+
+                # YOU SHALL NOT PASS!
+                # Only authorized group chats and users (admins) can access this bot.
+                if not chat_roles & self.AUGMENTED_ROLES:
+                    if '__FOR_RECOGNITION__' in message and not update.message.chat.id in self.recognition_list:
+                        self.send_generic_mesg(chat_id, 'Please contact moderator to add following id into ACL.')
+                        self.send_generic_mesg(chat_id, str(update.message.chat.id))
+                        self.recognition_list.append(update.message.chat.id)
                     else:
-                        self.logger.debug('Not running...')
-
-                # upload photo, adm only
-                elif update.message.photo and self.is_accepting_photos and self.do_adm_auth(user_id):
-                    try:
-                        self.logger.debug('PhotoContent: ' + update.message.photo[-1].file_id);
-                        photo_mesg = update.message.photo[-1].file_id
-                        photo_res = self.bot.sendPhoto(chat_id = chat_id, photo = photo_mesg)
-                        photo_mesg = photo_res.photo[-1].file_id
-                        self.send_generic_mesg(chat_id, photo_mesg, photo_res.message_id)
-                    except:
-                        nothing_todo = 1
-
-                #else:
-                #    self.logger.debug('NotHandleContent: ' + str(update.message));
-            except:
-                if chat_id != None and mesg_id != None:
-                    self.send_generic_mesg(chat_id, self.append_more_smiles('好像哪裡怪怪der '), mesg_id)
-                self.logger.exception('')
+                        self.logger.info('Access denied from: %s', update.message.chat.id)
 
-            # Updates global offset to get the new updates
-            self.LAST_UPDATE_ID = self.NOW_HANDLING_UPDATE_ID + 1
+                elif self.metrics.timed('washsnake', self.handle_washsnake, update):
+                    route = 'washsnake'
+
+                # Status querying.
+                elif state.strs['q_status_kw'] in message:
+                    route = 'status'
+                    if self.is_running:
+                        self.send_generic_mesg(chat_id, state.strs['qr_status_t'], mesg_id)
+                    else:
+                        self.send_generic_mesg(chat_id, state.strs['qr_status_f'], mesg_id)
+
+                # Only admins can re-enable bot.
+                elif not self.is_running and message.startswith(state.strs['s_status_t_kw']) and self.do_adm_auth(user_id):
+                    route = 'set_running_t'
+                    self.send_generic_mesg(chat_id, state.strs['sr_status_t_ok'], mesg_id)
+                    self.init_resp()
+                    self.is_running = True
+
+                # MOTDs are necessary.
+                elif parsed.cmd == '/motd' or self.is_handle_motd(message):
+                    route = 'motd'
+                    self.handle_motd(update)
+
+                # Only MOTD for some special groups, otherwise...
+                elif self.is_running and chat_roles & self.OPERATIONAL_ROLES:
+                    # Batch update *.jpg in /images/
+                    if message.startswith(state.strs['v_photo_bulkupload']) and self.do_adm_auth(user_id):
+                        route = 'photo_bulkupload'
+                        self.start_bulkupload(update, parsed)
+
+                    # Reload keyword table
+                    # Disable bot
+                    # Enter/Exit photo upload mode
+                    # Handle ADM cmd/Common cmd/Fortune tell
+                    elif state.router.dispatch(update, parsed):
+                        route = parsed.route
+
+                    # other...
+                    else:
+                        route = 'response'
+                        self.handle_response(update, parsed)
+                elif self.is_running and chat_roles & ACL.RESTRICTED:
+                    route = state.router_restricted.dispatch(update, parsed)
+                elif self.is_running:
+                    self.logger.debug('Not handling, in motd_only chats?')
+                else:
+                    self.logger.debug('Not running...')
+
+            # upload photo, adm only
+            elif update.message.photo and self.is_accepting_photos and self.do_adm_auth(user_id):
+                route = 'photo_upload'
+                try:
+                    self.logger.debug('PhotoContent: %s', update.message.photo[-1].file_id)
+                    photo_mesg = update.message.photo[-1].file_id
+                    photo_res = self.bot.sendPhoto(chat_id = chat_id, photo = photo_mesg)
+                    photo_mesg = photo_res.photo[-1].file_id
+                    self.send_generic_mesg(chat_id, photo_mesg, photo_res.message_id)
+                except:
+                    nothing_todo = 1
+
+            #else:
+            #    self.logger.debug('NotHandleContent: ' + str(update.message));
+        except:
+            self.metrics.inc('errors')
+            if chat_id != None and mesg_id != None:
+                self.send_generic_mesg(chat_id, self.append_more_smiles('好像哪裡怪怪der '), mesg_id)
+            self.logger.exception('')
+
+        elapsed = time.perf_counter() - started
+        self.metrics.observe('update', elapsed, route or 'none')
+        log_update(self.logger, update.update_id, chat_id, route, elapsed)
+        return route
 
     def is_handle_motd(self,
                        mesg):
@@ -335,67 +592,50 @@ class AFXBot:
         """
         try:
             updates = self.bot.getUpdates(timeout = 10)
-            self.logger.debug('update length: {0}'.format(len(updates)))
+            self.logger.debug('update length: %s', len(updates))
             if len(updates) == 1:
                 self.LAST_UPDATE_ID = updates[-1].update_id
             else:
                 while(len(updates) > 1):
                     self.LAST_UPDATE_ID = updates[-1].update_id
                     updates = self.bot.getUpdates(offset=self.LAST_UPDATE_ID+1, timeout = 10)
-                    self.logger.debug('update length: {0}'.format(len(updates)))
+                    self.logger.debug('update length: %s', len(updates))
         except:
             self.logger.exception('!!! Get Last update ID Error !!!')
 
-    def json_serial(self,
-                    obj):
-        """
-        Returns:
-            String-serialized datetime or date object.
-        """
-        if isinstance(obj, datetime):
-            serial = obj.isoformat()
-            return serial
-
-        if isinstance(obj, date):
-            serial = obj.isoformat()
-            return serial
-        raise TypeError ("Type not serializable")
-
     def init_resp(self):
         """
         Read all keywords/symptoms from self.resp_db.
         """
         self.logger.debug('Initializing response...')
-        self.resp_db = sqlite3.connect(self.config['resp_db'])
-        self.resp_db.row_factory = sqlite3.Row
-        self.loc_db = sqlite3.connect(self.config['loc_db'])
-        self.loc_db.row_factory = sqlite3.Row
-        r = self.resp_db.cursor()
-        l = self.loc_db.cursor()
 
-        self.kw_list = list()
-        c.execute('SELECT keyword FROM resp GROUP BY keyword ORDER BY RANDOM() DESC;')
-        for kw in c:
-            self.kw_list.append(kw['keyword'])
+        # Opened once, shared by reloads, handlers and bulk uploads.
+        # Schemas are brought up to date on first open.
+        if not self.resp_db:
+            self.resp_db = open_db(self.config['resp_db'],
+                                   readers = self.config.get('db_readers', 4),
+                                   cache_kb = self.config.get('db_cache_kb', 16384))
+            migrate(self.resp_db, RESP_MIGRATIONS)
+        if not self.loc_db:
+            self.loc_db = open_db(self.config['loc_db'])
+            migrate(self.loc_db, LOC_MIGRATIONS)
 
-        self.kw_list_get = list()
-        c.execute('SELECT keyword FROM resp_get GROUP BY keyword ORDER BY RANDOM() DESC;')
-        for kw in c:
-            self.kw_list_get.append(kw['keyword'])
+        spaces = KeywordSpaces()
+        with self.resp_db.reader() as conn:
+            for row in conn.execute('SELECT IIDX, keyword, cont, gid FROM resp;'):
+                spaces.space(row['gid']).resp_index.add(row['IIDX'], row['keyword'], row['cont'])
 
-        self.symptom_tbl = dict()
-        c.execute('SELECT before, after FROM symptom ORDER BY LENGTH(before) DESC;')
-        for syms in c:
-            self.symptom_tbl[syms['before']] = syms['after']
+            for row in conn.execute('SELECT IIDX, keyword, cont, tag, gid FROM resp_get;'):
+                spaces.space(row['gid']).resp_get_index.add(row['IIDX'], row['keyword'], row['cont'], row['tag'])
 
-        self.symptom_get = dict()
-        c.execute('SELECT before, after FROM symptom_get ORDER BY LENGTH(before) DESC;')
-        for syms in c:
-            self.symptom_get[syms['before']] = syms['after']
+            for syms in conn.execute('SELECT before, after, gid FROM symptom ORDER BY LENGTH(before) DESC;'):
+                spaces.space(syms['gid']).symptom_tbl[syms['before']] = syms['after']
 
+            for syms in conn.execute('SELECT before, after, gid FROM symptom_get ORDER BY LENGTH(before) DESC;'):
+                spaces.space(syms['gid']).symptom_get[syms['before']] = syms['after']
 
-        self.unified_kw_list = self.kw_list + list(self.symptom_tbl.keys())
-        self.unified_get_list = self.kw_list_get + list(self.symptom_get.keys())
+        spaces.refresh()
+        self.kw_spaces = spaces
 
     def send_generic_mesg(self,
                           chat_id,
@@ -403,8 +643,9 @@ class AFXBot:
                           reply_to_message_id = None):
         """
         For sending simple messages only including text (in most cases.)
+        Queued to the send dispatcher, returns right away.
         """
-        self.bot.sendMessage(chat_id = chat_id, text = text, reply_to_message_id = reply_to_message_id)
+        self.dispatcher.send_message(chat_id, text, reply_to_message_id)
 
     def send_eatsnake_mesg(self,
                            chat_id,
@@ -444,7 +685,7 @@ class AFXBot:
         Returns:
             Presence of id in self.config['adm_ids'].
         """
-        return id in self.config['adm_ids']
+        return self.acl.has(id, ACL.ADM)
 
     def do_operational_auth(self,
                             id):
@@ -453,8 +694,7 @@ class AFXBot:
             Presence of id in self.config['operational_chats'],
                               self.config['adm_ids']
         """
-        return id in self.config['operational_chats'] \
-               or id in self.config['adm_ids']
+        return self.acl.has(id, self.OPERATIONAL_ROLES)
 
     def do_augmented_auth(self,
                           id):
@@ -465,10 +705,7 @@ class AFXBot:
                               self.config['restricted_chats'],
                               or self.config['motd_only_chats'].
         """
-        return id in self.config['operational_chats'] \
-               or id in self.config['adm_ids'] \
-               or id in self.config['restricted_chats'] \
-               or id in self.config['motd_only_chats']
+        return self.acl.has(id, self.AUGMENTED_ROLES)
 
     def append_more_smiles(self,
                            str,
@@ -481,337 +718,472 @@ class AFXBot:
         return str + '\U0001F603' * random.randint(rl, ru)
 
     def handle_adm_cmd(self,
-                                         update):
+                       update,
+                       parsed = None):
         """
         Handles all administrative commands.
 
         Args:
             update (telegram.update):
                 Update object to handle.
+            parsed (Optional[ParsedMessage]):
+                Tokenized message, parsed from update when not given.
         """
+        if not parsed:
+            parsed = ParsedMessage(update.message.text)
+
+        cmd_entity = parsed.toks[1].lower() if len(parsed.toks) > 1 else ''
+        self.logger.debug('cmd_entity: %s', cmd_entity)
+
+        handler = self.adm_handlers.get(cmd_entity)
+        if handler:
+            parsed.route = 'adm:' + cmd_entity
+            handler(update, parsed)
+        else:
+            self.send_generic_mesg(update.message.chat_id, 'adm what? owo', update.message.message_id)
+
+    def adm_begin_get(self,
+                      update,
+                      parsed):
+        """/adm begin_get: 憨包來吃圖"""
+        self.set_is_accepting_photos(True)
+
+    def adm_end_get(self,
+                    update,
+                    parsed):
+        """/adm end_get: 憨包吃飽沒"""
+        self.set_is_accepting_photos(False)
+
+    def adm_mk_get(self,
+                   update,
+                   parsed):
+        """/adm mk_get: make /get keyword -> photo"""
         chat_id = update.message.chat_id
-        mesg = update.message.text.strip()
         mesg_id = update.message.message_id
+        cmd_toks = parsed.toks
 
-        cmd_toks = [x.strip() for x in mesg.split(' ')]
-        while '' in cmd_toks:
-            cmd_toks.remove('')
+        # for multi-group.
+        gid = KeywordSpaces.gid_of(chat_id)
+        spaces = self.kw_spaces.of_chat(chat_id)
 
-        cmd_entity = cmd_toks[1].lower()
+        pic_id = cmd_toks[2]
+        kw = cmd_toks[3].lower()
+        if len(cmd_toks) > 4:
+            tag = cmd_toks[4].lower()
+        else:
+            tag = None
+        try:
+            self.logger.debug('Photo ID = %s', cmd_toks[2])
+            photo_res = self.bot.sendPhoto(chat_id = chat_id, reply_to_message_id = mesg_id, photo = cmd_toks[2]);
+            unified_kw = KeywordSpaces.resolve(spaces, kw, True)
+            if unified_kw != kw:
+                self.send_generic_mesg(chat_id, '({0} -> {1}) => {2}'.format(kw, unified_kw, pic_id), photo_res.message_id)
+                kw = unified_kw
+            else:
+                self.send_generic_mesg(chat_id, '{0}    => {1}'.format(kw, pic_id), photo_res.message_id)
 
-        c = self.resp_db.cursor()
-        self.logger.debug('cmd_entity: ' + cmd_entity)
+            c = self.resp_db.execute('''INSERT INTO resp_get (keyword, cont, tag, gid) VALUES (?, ?, ?, ?) ''', ( kw, pic_id, tag, gid))
+            self.kw_spaces.space(gid).add(c.lastrowid, kw, pic_id, tag, True)
+        except TelegramError:
+            self.send_generic_mesg(chat_id, 'ERROR ON : {0} => {1}'.format(kw, pic_id), photo_res.message_id)
 
+    def adm_getpic_id(self,
+                      update,
+                      parsed):
+        """/adm getpic_id: show photo of given file id"""
+        chat_id = update.message.chat_id
+        mesg_id = update.message.message_id
+        cmd_toks = parsed.toks
 
-        # 憨包來吃圖
-        if cmd_entity == 'begin_get':
-            self.set_is_accepting_photos(True)
+        pic_id = cmd_toks[2]
 
-        # 憨包吃飽沒
-        elif cmd_entity == 'end_get':
-            self.set_is_accepting_photos(False)
+        try:
+            photo_res = self.bot.sendPhoto(chat_id = chat_id, reply_to_message_id = mesg_id, photo = pic_id);
+        except TelegramError:
+            self.send_generic_mesg(chat_id, 'ERROR ON : {0}'.format(pic_id), photo_res.message_id)
+
+    def adm_ed_get(self,
+                   update,
+                   parsed):
+        """/adm ed_get: not implemented yet"""
+        not_implemented = 1
+
+    def adm_mk_get_sym(self,
+                       update,
+                       parsed):
+        """/adm mk_get_sym: make get symptom -> keyword"""
+        chat_id = update.message.chat_id
+        mesg_id = update.message.message_id
+        cmd_toks = parsed.toks
 
-        elif cmd_entity == 'mk_get':
-            # for multi-group.
-            gid = chat_id
-            if gid > 0:
-                gid = -1
+        if len(cmd_toks) > 3:
+            kw_before = cmd_toks[2].lower()
+            kw_after = cmd_toks[3].lower()
 
-            pic_id = cmd_toks[2]
-            kw = cmd_toks[3].lower()
-            if len(cmd_toks) > 4:
-                tag = cmd_toks[4].lower()
-            else:
-                tag = None
-            try:
-                self.logger.debug('Photo ID = ' + cmd_toks[2])
-                photo_res = self.bot.sendPhoto(chat_id = chat_id, reply_to_message_id = mesg_id, photo = cmd_toks[2]);
-                if kw in self.symptom_get.keys():
-                    self.send_generic_mesg(chat_id, '({0} -> {1}) => {2}'.format(kw, self.symptom_get[kw], pic_id), photo_res.message_id)
-                    kw = self.symptom_get[kw]
-                else:
-                    self.send_generic_mesg(chat_id, '{0}    => {1}'.format(kw, pic_id), photo_res.message_id)
+            self.send_generic_mesg(chat_id, 'Not implemented.\n({0} -> {1}) => …'.format(kw_before, kw_after), mesg_id)
+        else:
+            self.send_generic_mesg(chat_id, 'arglist err.', mesg_id)
 
-                c.execute('''INSERT INTO resp_get (keyword, cont, tag, gid) VALUES (?, ?, ?, ?) ''', ( kw, pic_id, tag, gid))
-                self.resp_db.commit()
-                self.init_resp()
-            except TelegramError:
-                self.send_generic_mesg(chat_id, 'ERROR ON : {0} => {1}'.format(kw, pic_id), photo_res.message_id)
+    def adm_ls_get(self,
+                   update,
+                   parsed):
+        """/adm ls_get [kw | page N]: list /get kw"""
+        chat_id = update.message.chat_id
+        mesg_id = update.message.message_id
+        cmd_toks = parsed.toks
 
-        elif cmd_entity == 'getpic_id':
-            pic_id = cmd_toks[2]
+        spaces = self.kw_spaces.of_chat(chat_id)
 
-            try:
-                photo_res = self.bot.sendPhoto(chat_id = chat_id, reply_to_message_id = mesg_id, photo = pic_id);
-            except TelegramError:
-                self.send_generic_mesg(chat_id, 'ERROR ON : {0}'.format(pic_id), photo_res.message_id)
-
-        elif cmd_entity == 'ed_get':
-            not_implemented = 1
-
-        # make get symptom -> keyword
-        elif cmd_entity == 'mk_get_sym':
-            if len(cmd_toks) > 3:
-                kw_before = cmd_toks[2].lower()
-                kw_after = cmd_toks[3].lower()
-            else:
-                not_implemented = 1
+        if len(cmd_toks) > 3 and cmd_toks[2].lower() == 'page' and cmd_toks[3].isdigit():
+            self.send_kw_page(chat_id, mesg_id, spaces, 'ls_get', int(cmd_toks[3]), True)
 
-        # list /get kw
-        elif cmd_entity == 'ls_get':
-            if len(cmd_toks) > 2:
-                outmesg = ''
-                kw = cmd_toks[2].lower()
+        elif len(cmd_toks) > 2:
+            outmesg = ''
+            kw = cmd_toks[2].lower()
 
-                if kw in self.symptom_get.keys():
-                    outmesg += '({0} -> {1}) => \n'.format(kw, self.symptom_get[kw])
-                    kw = self.symptom_get[kw]
+            unified_kw = KeywordSpaces.resolve(spaces, kw, True)
+            if unified_kw != kw:
+                outmesg += '({0} -> {1}) => \n'.format(kw, unified_kw)
+                kw = unified_kw
+            else:
+                outmesg += '{0} => \n'.format(kw)
+
+            with self.metrics.timer('db'):
+                rows = self.resp_db.fetchall('''SELECT IIDX, cont, tag FROM resp_get WHERE keyword = ? AND gid IN (?, -1) ORDER BY IIDX ASC;''',
+                                             (kw, KeywordSpaces.gid_of(chat_id)))
+            for conts in rows:
+                if not conts['tag']:
+                    outmesg += '/getid_' + str(conts['IIDX']) + ' : ' + conts['cont'][:8] + '...' + conts['cont'][-8:] + ' (N/A)\n'
                 else:
-                    outmesg += '{0} => \n'.format(kw)
+                    outmesg += '/getid_' + str(conts['IIDX']) + ' : ' + conts['cont'][:8] + '...' + conts['cont'][-8:] + '(' + conts['tag'] + ')\n'
 
-                c.execute('''SELECT IIDX, cont, tag FROM resp_get WHERE keyword = ? ORDER BY IIDX ASC;''', (kw, ))
-                for conts in c:
-                    if not conts['tag']:
-                        outmesg += '/getid_' + str(conts['IIDX']) + ' : ' + conts['cont'][:8] + '...' + conts['cont'][-8:] + ' (N/A)\n'
-                    else:
-                        outmesg += '/getid_' + str(conts['IIDX']) + ' : ' + conts['cont'][:8] + '...' + conts['cont'][-8:] + '(' + conts['tag'] + ')\n'
+            self.send_generic_mesg(chat_id, outmesg, mesg_id)
 
-                self.send_generic_mesg(chat_id, outmesg, mesg_id)
+        else:
+            self.send_kw_page(chat_id, mesg_id, spaces, 'ls_get', 1, True)
+
+    def send_kw_page(self,
+                     chat_id,
+                     mesg_id,
+                     spaces,
+                     cmd,
+                     page,
+                     is_get = False):
+        """
+        Send one page of the keywords visible in spaces, for /adm ls_kw and
+        /adm ls_get.
 
+        Args:
+            cmd (str):
+                'ls_kw' or 'ls_get', for the navigation hint.
+            page (int):
+                1-based page number, clamped to the last page.
+        """
+        page_size = max(1, int(self.config.get('ls_page_size', 50)))
+        pages = max(1, -(-KeywordSpaces.count(spaces, is_get) // page_size))
+        page = min(max(1, page), pages)
+
+        entries = itertools.islice(KeywordSpaces.listing(spaces, is_get, (page - 1) * page_size), page_size)
+        lines = ['Supported {0}keywords ({1}/{2}):'.format('/get ' if is_get else '', page, pages)]
+        for kw, after in entries:
+            if after is not None:
+                lines.append(kw + ' -> ' + after)
             else:
-                outmesg = 'Supported /get keywords:\n'
-                s_keys = self.symptom_get.keys()
-                for kw in self.unified_get_list:
-
-                    if kw in s_keys:
-                        outmesg = outmesg + kw + ' -> ' + self.symptom_get[kw] + '\n'
-                    else:
-                        outmesg = outmesg + kw + '\n'
+                lines.append(kw)
+        if page < pages:
+            lines.append('next: /adm {0} page {1}'.format(cmd, page + 1))
+
+        # Telegram rejects messages over 4096 characters.
+        outmesg = '\n'.join(lines)
+        if len(outmesg) > 4096:
+            outmesg = outmesg[:4095] + '…'
+        self.send_generic_mesg(chat_id, outmesg, mesg_id)
+
+    def adm_mk_kw(self,
+                  update,
+                  parsed):
+        """/adm mk_kw: make keyword -> content"""
+        chat_id = update.message.chat_id
+        mesg = parsed.text.strip()
+        mesg_id = update.message.message_id
+        cmd_toks = parsed.toks
 
-                self.send_generic_mesg(chat_id, outmesg, mesg_id)
+        if len(cmd_toks) > 3:
+            kw = cmd_toks[2].lower()
+            content = mesg[(mesg.find(cmd_toks[2]) + len(cmd_toks[2]) + 1):].strip()
 
-        # make keyword -> content
-        # ^/adm\s+mk_kw\s+([^\s]+)\s+(.+)$
-        elif cmd_entity == 'mk_kw':
-            if len(cmd_toks) > 3:
-                kw = cmd_toks[2].lower()
-                content = mesg[(mesg.find(cmd_toks[2]) + len(cmd_toks[2]) + 1):].strip()
+            unified_kw = KeywordSpaces.resolve(self.kw_spaces.of_chat(chat_id), kw)
+            if unified_kw != kw:
+                self.send_generic_mesg(chat_id, '({0} -> {1}) => {2}'.format(kw, unified_kw, content), mesg_id)
+                kw = unified_kw
+            else:
+                self.send_generic_mesg(chat_id, '{0}    => {1}'.format(kw, content), mesg_id)
 
-                if kw in self.symptom_tbl.keys():
-                    self.send_generic_mesg(chat_id, '({0} -> {1}) => {2}'.format(kw, self.symptom_tbl[kw], content), mesg_id)
-                    kw = self.symptom_tbl[kw]
-                else:
-                    self.send_generic_mesg(chat_id, '{0}    => {1}'.format(kw, content), mesg_id)
+            # Keywords are global (gid -1).
+            c = self.resp_db.execute('''INSERT INTO resp (keyword, cont) VALUES (?, ?) ''', ( kw, content, ))
+            self.kw_spaces.global_space.add(c.lastrowid, kw, content)
+        else:
+            self.send_generic_mesg(chat_id, 'arglist err.', mesg_id)
 
-                c.execute('''INSERT INTO resp (keyword, cont) VALUES (?, ?) ''', ( kw, content, ))
-                self.resp_db.commit()
-                self.init_resp()
-            else:
-                self.send_generic_mesg(chat_id, 'arglist err.', mesg_id)
-
-        # make symptom -> keyword
-        # ^/adm\s+mk_sym\s+([^\s]+)\s+([^\s]+).*$
-        elif cmd_entity == 'mk_sym':
-            if len(cmd_toks) > 3:
-                kw_before = cmd_toks[2].lower()
-                kw_after = cmd_toks[3].lower()
-
-                if kw_before in self.symptom_tbl.keys():
-                    self.send_generic_mesg(chat_id, 'Already exists: ({0} -> …) => …'.format(kw_before), mesg_id)
-                elif kw_before in self.kw_list:
-                    self.send_generic_mesg(chat_id, 'Already exists: {0} => …'.format(kw_before), mesg_id)
-                else:
-                    self.send_generic_mesg(chat_id, '{0}    => {1}'.format(kw_before, kw_after), mesg_id)
-                    c.execute('''INSERT INTO symptom (before, after) VALUES (?, ?) ''', ( kw_before, kw_after, ))
-                    self.resp_db.commit()
-                    self.init_resp()
-            else:
-                self.send_generic_mesg(chat_id, 'arglist err.', mesg_id)
+    def adm_mk_sym(self,
+                   update,
+                   parsed):
+        """/adm mk_sym: make symptom -> keyword"""
+        chat_id = update.message.chat_id
+        mesg_id = update.message.message_id
+        cmd_toks = parsed.toks
 
-         # make symptom -> keyword
-        # ^/adm\s+mk_sym\s+([^\s]+)\s+([^\s]+).*$
-        elif cmd_entity == 'mk_get_sym':
-            if len(cmd_toks) > 3:
-                kw_before = cmd_toks[2].lower()
-                kw_after = cmd_toks[3].lower()
+        if len(cmd_toks) > 3:
+            kw_before = cmd_toks[2].lower()
+            kw_after = cmd_toks[3].lower()
 
-                self.send_generic_mesg(chat_id, 'Not implemented.\n({0} -> {1}) => …'.format(kw_before, kw_after), mesg_id)
+            spaces = self.kw_spaces.of_chat(chat_id)
+            if KeywordSpaces.resolve(spaces, kw_before) != kw_before:
+                self.send_generic_mesg(chat_id, 'Already exists: ({0} -> …) => …'.format(kw_before), mesg_id)
+            elif KeywordSpaces.contains(spaces, kw_before):
+                self.send_generic_mesg(chat_id, 'Already exists: {0} => …'.format(kw_before), mesg_id)
             else:
-                self.send_generic_mesg(chat_id, 'arglist err.', mesg_id)
+                self.send_generic_mesg(chat_id, '{0}    => {1}'.format(kw_before, kw_after), mesg_id)
+                self.resp_db.execute('''INSERT INTO symptom (before, after) VALUES (?, ?) ''', ( kw_before, kw_after, ))
+                self.kw_spaces.global_space.add_symptom(kw_before, kw_after)
+        else:
+            self.send_generic_mesg(chat_id, 'arglist err.', mesg_id)
 
-        # todo: assign index for each kw -> cont pair.
-        elif cmd_entity == 'rm_kw':
-            if len(cmd_toks) > 2:
-                try:
-                    to_rm = int(cmd_toks[2].lower())
+    def adm_rm_kw(self,
+                  update,
+                  parsed):
+        """/adm rm_kw: remove keyword content by IIDX"""
+        chat_id = update.message.chat_id
+        mesg_id = update.message.message_id
+        cmd_toks = parsed.toks
 
-                    c.execute('''DELETE FROM resp WHERE IIDX = ? ''', ( to_rm, ))
-                    self.resp_db.commit()
-                    self.init_resp()
+        if len(cmd_toks) > 2:
+            try:
+                to_rm = int(cmd_toks[2].lower())
 
+                # Only rows visible in this chat.
+                owner = KeywordSpaces.owner(self.kw_spaces.of_chat(chat_id), to_rm)
+                if owner:
+                    self.resp_db.execute('''DELETE FROM resp WHERE IIDX = ? ''', ( to_rm, ))
+                    owner.remove(to_rm)
                     self.send_generic_mesg(chat_id, str(to_rm) + ' deleted.', mesg_id)
+                else:
+                    self.send_generic_mesg(chat_id, str(to_rm) + ' not found.', mesg_id)
 
-                except ValueError:
-                    self.send_generic_mesg(chat_id, 'arg err.', mesg_id)
+            except ValueError:
+                self.send_generic_mesg(chat_id, 'arg err.', mesg_id)
 
-            else:
-                self.send_generic_mesg(chat_id, 'arglist err.', mesg_id)
+        else:
+            self.send_generic_mesg(chat_id, 'arglist err.', mesg_id)
 
-        elif cmd_entity == 'rm_get':
-            if len(cmd_toks) > 2:
-                try:
-                    to_rm = int(cmd_toks[2].lower())
+    def adm_rm_get(self,
+                   update,
+                   parsed):
+        """/adm rm_get: remove /get content by IIDX"""
+        chat_id = update.message.chat_id
+        mesg_id = update.message.message_id
+        cmd_toks = parsed.toks
 
-                    c.execute('''DELETE FROM resp_get WHERE IIDX = ? ''', ( to_rm, ))
-                    self.resp_db.commit()
-                    self.init_resp()
+        if len(cmd_toks) > 2:
+            try:
+                to_rm = int(cmd_toks[2].lower())
 
+                # Only rows visible in this chat.
+                owner = KeywordSpaces.owner(self.kw_spaces.of_chat(chat_id), to_rm, True)
+                if owner:
+                    self.resp_db.execute('''DELETE FROM resp_get WHERE IIDX = ? ''', ( to_rm, ))
+                    owner.remove(to_rm, True)
                     self.send_generic_mesg(chat_id, str(to_rm) + ' deleted.', mesg_id)
+                else:
+                    self.send_generic_mesg(chat_id, str(to_rm) + ' not found.', mesg_id)
 
-                except ValueError:
-                    self.send_generic_mesg(chat_id, 'arg err.', mesg_id)
-
-            else:
-                self.send_generic_mesg(chat_id, 'arglist err.', mesg_id)
-
-        elif cmd_entity == 'rm_get_sym':
-            not_implemented = 1
-
-        # list keyword
-        elif cmd_entity == 'ls_kw':
-            s_keys = self.symptom_tbl.keys()
-            if len(cmd_toks) > 2:
-                outmesg = ''
+            except ValueError:
+                self.send_generic_mesg(chat_id, 'arg err.', mesg_id)
 
-                kw = cmd_toks[2].lower()
-                if kw in self.symptom_get.keys():
-                    outmesg += '({0} -> {1}) => \n'.format(kw, self.symptom_tbl[kw])
-                    kw = self.symptom_tbl[kw]
-                else:
-                    outmesg += '{0} => \n'.format(kw)
+        else:
+            self.send_generic_mesg(chat_id, 'arglist err.', mesg_id)
+
+    def adm_rm_get_sym(self,
+                       update,
+                       parsed):
+        """/adm rm_get_sym: not implemented yet"""
+        not_implemented = 1
+
+    def adm_ls_kw(self,
+                  update,
+                  parsed):
+        """/adm ls_kw [kw | page N]: list keyword"""
+        chat_id = update.message.chat_id
+        mesg_id = update.message.message_id
+        cmd_toks = parsed.toks
+        spaces = self.kw_spaces.of_chat(chat_id)
 
-                c.execute('''SELECT IIDX, cont FROM resp WHERE keyword = ? ORDER BY IIDX ASC;''', (kw, ))
-                for conts in c:
-                    outmesg += str(conts['IIDX']) + '. ' + conts['cont'] + '\n'
+        if len(cmd_toks) > 3 and cmd_toks[2].lower() == 'page' and cmd_toks[3].isdigit():
+            self.send_kw_page(chat_id, mesg_id, spaces, 'ls_kw', int(cmd_toks[3]))
 
-                self.send_generic_mesg(chat_id, outmesg, mesg_id)
+        elif len(cmd_toks) > 2:
+            outmesg = ''
 
+            kw = cmd_toks[2].lower()
+            unified_kw = KeywordSpaces.resolve(spaces, kw)
+            if unified_kw != kw:
+                outmesg += '({0} -> {1}) => \n'.format(kw, unified_kw)
+                kw = unified_kw
             else:
-                outmesg = 'Supported keywords:\n'
-                for kw in self.unified_kw_list:
+                outmesg += '{0} => \n'.format(kw)
 
-                    if kw in s_keys:
-                        outmesg = outmesg + kw + ' -> ' + self.symptom_tbl[kw] + '\n'
-                    else:
-                        outmesg = outmesg + kw + '\n'
+            with self.metrics.timer('db'):
+                rows = self.resp_db.fetchall('''SELECT IIDX, cont FROM resp WHERE keyword = ? AND gid IN (?, -1) ORDER BY IIDX ASC;''',
+                                             (kw, KeywordSpaces.gid_of(chat_id)))
+            for conts in rows:
+                outmesg += str(conts['IIDX']) + '. ' + conts['cont'] + '\n'
 
-                self.send_generic_mesg(chat_id, outmesg, mesg_id)
+            self.send_generic_mesg(chat_id, outmesg, mesg_id)
 
         else:
-            self.send_generic_mesg(chat_id, 'adm what? owo', mesg_id)
+            self.send_kw_page(chat_id, mesg_id, spaces, 'ls_kw', 1)
+
+    def adm_stats(self,
+                  update,
+                  parsed):
+        """/adm stats: show latencies (ms), counters and queue depths"""
+        self.send_generic_mesg(update.message.chat_id, self.metrics.render_text(), update.message.message_id)
+
+    def adm_reload(self,
+                   update,
+                   parsed):
+        """/adm reload: reload config and strings files"""
+        if self.reload_configuration():
+            self.send_generic_mesg(update.message.chat_id, 'Reloaded.', update.message.message_id)
+        else:
+            self.send_generic_mesg(update.message.chat_id, 'Reload failed, still running the old config.', update.message.message_id)
 
     def handle_cmd(self,
-                   update):
+                   update,
+                   parsed = None):
         """
         Handles all common commands.
 
         Args:
             update (telegram.update):
                 Update object to handle.
+            parsed (Optional[ParsedMessage]):
+                Tokenized message, parsed from update when not given.
         Returns:
             True when the command is handled, otherwise False.
         """
+        if not parsed:
+            parsed = ParsedMessage(update.message.text)
+
+        handler = self.cmd_handlers.get(parsed.cmd)
+        if not handler:
+            return False
+
+        parsed.route = 'cmd:' + parsed.cmd
+        return handler(update, parsed)
+
+    def cmd_get(self,
+                update,
+                parsed):
+        """/get keyword [tag]: send a random photo of keyword."""
         chat_id = update.message.chat_id
-        restricted = not self.do_operational_auth(chat_id)
-        mesg = update.message.text
         mesg_id = update.message.message_id
-        mesg_low = mesg.lower().replace('@afx_bot', '')
+        cmd_toks = parsed.toks
 
-        cmd_toks = [x.strip() for x in mesg.split(' ')]
-        while '' in cmd_toks:
-            cmd_toks.remove('')
+        if len(cmd_toks) < 2 or not self.do_operational_auth(chat_id):
+            return False
 
-        if mesg_low.startswith('/get ') and not restricted:
-            keyword = cmd_toks[1].lower()
+        keyword = cmd_toks[1].lower()
 
-            if len(cmd_toks) > 2:
-                tag = cmd_toks[2].lower()
-                self.logger.debug('keyword: ' + keyword)
-                self.logger.debug('tag: ' + tag)
-            else:
-                tag = None
-                self.logger.debug('keyword: ' + keyword)
+        if len(cmd_toks) > 2:
+            tag = cmd_toks[2].lower()
+            self.logger.debug('keyword: %s', keyword)
+            self.logger.debug('tag: %s', tag)
+        else:
+            tag = None
+            self.logger.debug('keyword: %s', keyword)
 
-            if keyword in self.symptom_get.keys():
-                keyword = self.symptom_get[keyword]
+        spaces = self.kw_spaces.of_chat(chat_id)
+        keyword = KeywordSpaces.resolve(spaces, keyword, True)
 
-            if keyword in self.kw_list_get:
-                c = self.resp_db.cursor()
-                x = None
+        if KeywordSpaces.contains(spaces, keyword, True):
+            x = self.metrics.timed('index', KeywordSpaces.pick, spaces, keyword, tag, True)
 
-                if tag :
-                    c.execute('''SELECT cont FROM resp_get WHERE keyword = ? AND tag = ? ORDER BY RANDOM() LIMIT 1;''', ( keyword, tag, ))
-                    x = c.fetchone()
+            if x:
+                self.dispatcher.call('sendPhoto', chat_id = chat_id, reply_to_message_id = mesg_id, photo = str(x))
+            else:
+                self.send_generic_mesg(chat_id, 'Something goes wrong! D:', mesg_id)
+        else:
+            self.send_generic_mesg(chat_id, self.append_more_smiles('You get nothing! '), mesg_id)
 
-                if not x:
-                    c.execute('''SELECT cont FROM resp_get WHERE keyword = ? ORDER BY RANDOM() LIMIT 1;''', ( keyword, ))
-                    x = c.fetchone()
+        return True
 
-                if x:
-                    self.bot.sendPhoto(chat_id = chat_id, reply_to_message_id = mesg_id, photo = str(x['cont']));
-                else:
-                    self.send_generic_mesg(chat_id, 'Something goes wrong! D:', mesg_id)
-            else:
-                self.send_generic_mesg(chat_id, self.append_more_smiles('You get nothing! '), mesg_id)
+    def cmd_getid(self,
+                  update,
+                  parsed):
+        """/getid_N, /getid N: get picture directly by given resp ID."""
+        chat_id = update.message.chat_id
+        mesg_id = update.message.message_id
 
-            return True
+        if not self.do_operational_auth(chat_id):
+            return False
 
-        # Get picture directly by given resp ID.
-        elif mesg_low.startswith('/getid') and not restricted:
-            if len(cmd_toks) > 1:
-                res_get_id = cmd_toks[1]
-            else:
-                res_get_id = mesg_low[7:]
+        if len(parsed.toks) > 1:
+            res_get_id = parsed.toks[1]
+        else:
+            res_get_id = parsed.cmd_arg
 
-            c = self.resp_db.cursor()
-            c.execute('''SELECT cont FROM resp_get WHERE IIDX = ? LIMIT 1;''', (res_get_id,))
-            x = c.fetchone()
+        try:
+            x = KeywordSpaces.get(self.kw_spaces.of_chat(chat_id), int(res_get_id), True)
+        except (TypeError, ValueError):
+            x = None
 
-            if x:
-                self.bot.sendPhoto(chat_id=chat_id, reply_to_message_id=mesg_id, photo=str(x['cont']));
-            else:
-                self.send_generic_mesg(chat_id, self.append_more_smiles('You get nothing! '), mesg_id)
+        if x:
+            self.dispatcher.call('sendPhoto', chat_id=chat_id, reply_to_message_id=mesg_id, photo=str(x))
+        else:
+            self.send_generic_mesg(chat_id, self.append_more_smiles('You get nothing! '), mesg_id)
 
-            return True
+        return True
 
-        elif mesg == '/roll@AFX_bot':
-            self.send_generic_mesg(chat_id, self.strs['r_roll_cmd_help'], mesg_id)
+    def cmd_roll(self,
+                 update,
+                 parsed):
+        """/roll: roll dice, or show help for /roll@AFX_bot."""
+        if parsed.text == '/roll@AFX_bot':
+            self.send_generic_mesg(update.message.chat_id, self.strs['r_roll_cmd_help'], update.message.message_id)
             return True
 
-        elif mesg_low.startswith('/roll ') or mesg_low == '/roll':
-            return self.handle_roll(update)
+        return self.handle_roll(update)
 
-        elif mesg == '/crash':
-            raise Exception('Crash!')
-
-        return False
+    def cmd_crash(self,
+                  update,
+                  parsed):
+        """/crash"""
+        if parsed.text != '/crash':
+            return False
+        raise Exception('Crash!')
 
     def handle_response(self,
-                      update):
+                        update,
+                        parsed = None):
         """
         Handles all typical responses.
 
         Args:
             update (telegram.update):
                 Update object to handle.
+            parsed (Optional[ParsedMessage]):
+                Tokenized message, parsed from update when not given.
         Returns:
             True when the command is handled, otherwise False.
         """
+        if not parsed:
+            parsed = ParsedMessage(update.message.text)
+
         chat_id = update.message.chat_id
-        mesg = update.message.text
         mesg_id = update.message.message_id
         user_id = update.message.from_user.id
-        mesg_low = mesg.lower()
+        mesg_low = parsed.low
 
         # hardcoded...
         if    'ass' in mesg_low and not 'pass' in mesg_low:
@@ -827,26 +1199,23 @@ class AFXBot:
             return True
 
 
-        random.shuffle(self.unified_kw_list)
-        s_keys = self.symptom_tbl.keys()
+        # Only this group's keywords and the global ones.
+        spaces = self.kw_spaces.of_chat(chat_id)
+        hits = KeywordSpaces.find_all(spaces, mesg_low)
+        if not hits:
+            return False
 
-        # convert kw
-        for kw in self.unified_kw_list:
-            if kw in mesg_low:
-                if kw in s_keys:
-                    unified_kw = self.symptom_tbl[kw]
-                    self.logger.debug('keyword: ' + kw + ' -> ' + unified_kw)
-                else:
-                    unified_kw = kw
-                    self.logger.debug('keyword: ' + kw )
+        # random keyword wins
+        kw = random.choice(hits)
+        unified_kw = KeywordSpaces.resolve(spaces, kw)
+        self.logger.debug('keyword: %s -> %s', kw, unified_kw)
 
-                c = self.resp_db.cursor()
-                c.execute('''SELECT cont FROM resp WHERE keyword = ? ORDER BY RANDOM() LIMIT 1;''', ( unified_kw, ))
-                x = c.fetchone()
-                self.send_generic_mesg(chat_id, str(x['cont']), mesg_id)
-                return True
+        x = self.metrics.timed('index', KeywordSpaces.pick, spaces, unified_kw)
+        if not x:
+            return False
 
-        return False
+        self.send_generic_mesg(chat_id, str(x), mesg_id)
+        return True
 
     def handle_roll(self,
                                     update):
@@ -866,55 +1235,14 @@ class AFXBot:
         else:
             d_cmd = mesg_low[6:].strip()
 
-        # XdYsZ
-        res = re.match('([0-9]+)d([0-9]+)s([0-9]+)', d_cmd)
-        if res:
-            dn = int(res.group(1))
-            dt = int(res.group(2))
-            ds = int(res.group(3))
-            dstr = '('
-            succ = 0
-
-            if dn > 100: dn = 100
-
-            for i in range(dn):
-                val = random.randint(1, dt)
-                if val >= ds: succ += 1
-                dstr += str(val) + ', '
-
-            dstr = '{0}d{1}s{2} : {3}) >= {2}, 成功 {4} 次'.format(dn, dt, ds, dstr[:-2], succ);
-            self.send_generic_mesg(chat_id, dstr, mesg_id)
+        # XdY[kN][rN][!][sZ | +-M]
+        try:
+            pool = self.dice.parse(d_cmd)
+        except ValueError:
+            self.send_generic_mesg(chat_id, self.strs['r_roll_cmd_help'], mesg_id)
             return True
-
-        # XdY[+-Z]
-        res = re.match('([0-9]+)d([0-9]+)([+-][0-9]+)?', d_cmd)
-        if res:
-            dn = int(res.group(1))
-            dt = int(res.group(2))
-            if res.group(3):
-                dm = int(res.group(3))
-            else:
-                dm =    0;
-
-            dstr = '('
-            sum = 0
-
-            if dn > 100: dn = 100
-
-            for i in range(dn):
-                val = random.randint(1, dt)
-                sum += val
-                dstr += str(val) + ', '
-
-            if dm == 0:
-                dstr = '{0}d{1} : {2}) = {3}'.format(dn, dt, dstr[:-2], sum);
-            else:
-                if dm > 0:
-                    dm_str = '+' + str(dm)
-                else:
-                    dm_str = str(dm)
-                dstr = '{0}d{1}{2} : {3}) {2} = {4} {2} = {5}'.format(dn, dt, dm_str, dstr[:-2], sum, sum+dm);
-            self.send_generic_mesg(chat_id, dstr, mesg_id)
+        if pool:
+            self.send_generic_mesg(chat_id, self.dice.describe(self.dice.roll(pool)), mesg_id)
             return True
 
         # X[-Y]
@@ -961,9 +1289,21 @@ class AFXBot:
         user_id = update.message.from_user.id
         type = self.match_fortune_type(mesg)
 
+        today = date.today()
+        fstr = self.fortune_cache.get(user_id, today, type, lambda: self.tell_fortune(user_id, today, type))
+        self.send_generic_mesg(chat_id, fstr, mesg_id)
+
+    def tell_fortune(self,
+                     user_id,
+                     today,
+                     type):
+        """
+        Returns:
+            Fortune of user_id for type as told on today.
+        """
         md5 = hashlib.md5()
 
-        fortune_date = date.today()
+        fortune_date = today
         date_offset = self.fortune_types[type]
         if date_offset >= 0:
             fortune_date = fortune_date+timedelta(days=date_offset)
@@ -973,8 +1313,7 @@ class AFXBot:
         f_data = bytearray(str(user_id) + datetime.strftime(fortune_date, self.strs['x_fortune_salt_str']), 'utf-8')
 
         md5.update(f_data)
-        fstr = '{0}運勢：{1}'.format(type, self.fortune_strs[int(md5.digest()[12]) % len(self.fortune_strs)])
-        self.send_generic_mesg(chat_id, fstr, mesg_id)
+        return '{0}運勢：{1}'.format(type, self.fortune_strs[int(md5.digest()[12]) % len(self.fortune_strs)])
 
     def handle_motd(self,
                                     update):
@@ -995,30 +1334,42 @@ class AFXBot:
         mesg = update.message.text.replace('@afx_bot', '')
         mesg_low = mesg.lower()
 
-        schat_id = str(chat_id)
         motd_update_match_res = re.match('^/motd[\s\n]+(.+)', mesg, re.IGNORECASE | re.DOTALL)
+        motd_date_match_res = re.match('^/motd\s+([0-9]{4}-[0-9]{2}-[0-9]{2})$', mesg_low.strip())
+        motd_history_match_res = re.match('^/motd\s+history(\s+[0-9]+)?$', mesg_low.strip())
 
         if mesg_low == '/motd':    # print motd
             self.send_motd(chat_id, mesg_id)
+        elif motd_date_match_res:    # motd of a given date
+            try:
+                motd_date = datetime.strptime(motd_date_match_res.group(1), '%Y-%m-%d').date()
+            except ValueError:
+                self.send_generic_mesg(chat_id, 'Invalid date.', mesg_id)
+                return
+
+            motd = self.motd_store.get_on(chat_id, motd_date)
+            if motd:
+                self.send_generic_mesg(chat_id, self.strs['r_motd_ok'].format(date = motd_date_match_res.group(1), motd = motd[1]), mesg_id)
+            else:
+                self.send_generic_mesg(chat_id, self.strs['r_motd_no'], mesg_id)
+        elif motd_history_match_res:    # motds of the last N days
+            days = int(motd_history_match_res.group(1)) if motd_history_match_res.group(1) else 7
+            days = min(max(days, 1), self.MOTD_HISTORY_MAX_DAYS)
+
+            motds = self.motd_store.history(chat_id, days)
+            if motds:
+                outmesg = '\n\n'.join('{0}: {1}'.format(datetime.strftime(d, '%Y-%m-%d'), m) for d, m in motds)
+                self.send_generic_mesg(chat_id, outmesg, mesg_id)
+            else:
+                self.send_generic_mesg(chat_id, self.strs['r_motd_no'], mesg_id)
         elif motd_update_match_res:
             motd_cmd = motd_update_match_res.group(1).strip()
 
-            if not schat_id in self.motds.keys():
-                self.motds[schat_id] = dict()
-
-            self.motds[schat_id]['msg'] = motd_cmd
-            self.motds[schat_id]['date'] = date.today()
-
-            today_str = datetime.strftime(self.motds[schat_id]['date'], '%Y-%m-%d')
-            self.logger.info('MOTD: \n'+self.motds[schat_id]['msg'])
+            # Written to disk by the store's next flush.
+            self.motd_store.set(chat_id, motd_cmd)
 
-            try:
-                self.logger.info('writing MOTD contents')
-                with open('motd.json', 'w') as f:
-                    json.dump(self.motds, f, default=self.json_serial)
-                    f.close()
-            except Exception as ex:
-                logging.exception('!!! EXCEPTION HAS OCCURRED !!!')
+            today_str = datetime.strftime(date.today(), '%Y-%m-%d')
+            self.logger.info('MOTD: \n%s', motd_cmd)
 
             self.send_generic_mesg(chat_id, self.strs['r_motd_updated'].format(date = today_str), mesg_id)
         else:
@@ -1038,19 +1389,18 @@ class AFXBot:
             mesg_id (int):
                 Message ID of given update to handle.
         """
-        schat_id = str(chat_id)
-
-        if schat_id in self.motds.keys():
-            motd_date_str = datetime.strftime(self.motds[schat_id]['date'], '%Y-%m-%d')
-        else:
-            motd_date_str = '????-??-??'
+        motd = self.motd_store.get(chat_id)
 
-        if not schat_id in self.motds.keys():
+        if not motd:
             self.send_generic_mesg(chat_id, self.strs['r_motd_no'], mesg_id)
-        elif self.motds[schat_id]['date'] != date.today():
-            self.send_generic_mesg(chat_id, self.strs['r_motd_old'].format(date = motd_date_str, motd = self.motds[schat_id]['msg']), mesg_id)
+            return
+
+        motd_date, motd_msg = motd
+        motd_date_str = datetime.strftime(motd_date, '%Y-%m-%d')
+        if motd_date != date.today():
+            self.send_generic_mesg(chat_id, self.strs['r_motd_old'].format(date = motd_date_str, motd = motd_msg), mesg_id)
         else:
-            self.send_generic_mesg(chat_id, self.strs['r_motd_ok'].format(date = motd_date_str, motd = self.motds[schat_id]['msg']), mesg_id)
+            self.send_generic_mesg(chat_id, self.strs['r_motd_ok'].format(date = motd_date_str, motd = motd_msg), mesg_id)
 
     def handle_washsnake(self,
                          update):
@@ -1064,57 +1414,50 @@ class AFXBot:
         Returns:
             True when anti-flood response is sent, otherwise False.
         """
-        # Must convert id's into string for dict storage.
         chat_id = update.message.chat_id
         message = update.message.text
         date = update.message.date
         mesg_id = update.message.message_id
         user_id = update.message.from_user.id
 
-        schat_id = str(chat_id)
-        suser_id = str(user_id)
         washsnake_content = message.lower().strip()
-        if not str(chat_id) in self.wash_record.keys():
-            self.wash_record[schat_id] = dict()
+        washsnake_entry = self.wash_record.get(chat_id, user_id, date)
 
         # random angry...
-        if random.randint(1, 1000) >= 995 and chat_id in self.config['invasive_washsnake_chats']:
-            self.logger.debug('random angry triggered for {0} - {1}'.format(chat_id, mesg_id))
+        if random.randint(1, 1000) >= 995 and self.acl.has(chat_id, ACL.INVASIVE_WASHSNAKE):
+            self.logger.debug('random angry triggered for %s - %s', chat_id, mesg_id)
             self.send_generic_mesg(chat_id, random.choice(self.strs['r_invasive_random_angry_strs']), mesg_id)
-        elif not suser_id in self.wash_record[schat_id].keys():
-            self.logger.debug('new washsnake content for ' + suser_id)
-            self.wash_record[schat_id][suser_id] = WashSnake(date, washsnake_content)
+        elif not washsnake_entry:
+            self.logger.debug('new washsnake content for %s', user_id)
+            self.wash_record.put(chat_id, user_id, WashSnake(date, washsnake_content))
         else:
             # check
-            washsnake_entry = self.wash_record[schat_id][suser_id];
             if washsnake_entry.content == washsnake_content:
                 # same content, check time
                 time_delta = date - washsnake_entry.firsttime
-                self.logger.debug('washsnake_entry.firsttime = ' + str(washsnake_entry.firsttime))
-                self.logger.debug('date = ' + str(date))
-                self.logger.debug('time_delta = ' + str(time_delta))
+                self.logger.debug('washsnake_entry.firsttime = %s', washsnake_entry.firsttime)
+                self.logger.debug('date = %s', date)
+                self.logger.debug('time_delta = %s', time_delta)
 
-                if time_delta < timedelta(seconds=60):
-                    self.logger.debug('wash ++ for ' + str(update.message))
-                    self.wash_record[schat_id][suser_id].repeattimes += 1;
+                if time_delta < self.wash_record.ttl:
+                    self.logger.debug('wash ++ for %s', update.message)
+                    washsnake_entry.repeattimes += 1;
                     if washsnake_entry.repeattimes >= 2:
                         if not washsnake_entry.responded:
                             # WASH SNAKE!!
-                            if chat_id in self.config['invasive_washsnake_chats'] or self.do_adm_auth(user_id):
+                            if self.acl.has(chat_id, ACL.INVASIVE_WASHSNAKE) or self.do_adm_auth(user_id):
                                 self.send_generic_mesg(chat_id, random.choice(self.wash_snake_strs_unified), mesg_id)
                             else:
                                 self.send_generic_mesg(chat_id, random.choice(self.strs['r_wash_snake_strs']), mesg_id)
-                            self.wash_record[schat_id][suser_id].responded = True
+                            washsnake_entry.responded = True
 
                         return True
                 else:
                     # reset wash snake counter...
-                    self.wash_record[schat_id][suser_id].responded = False
-                    self.wash_record[schat_id][suser_id].firsttime = update.message.date
-                    self.wash_record[schat_id][suser_id].repeattimes = 0
+                    self.wash_record.put(chat_id, user_id, WashSnake(date, washsnake_content))
             else:
-                self.logger.debug('update wash for ' + suser_id)
-                self.wash_record[schat_id][suser_id] = WashSnake(update.message.date, washsnake_content)
+                self.logger.debug('update wash for %s', user_id)
+                self.wash_record.put(chat_id, user_id, WashSnake(date, washsnake_content))
 
         return False
 
@@ -1145,93 +1488,211 @@ class AFXBot:
         """Assign flag to is_running."""
         self.is_running = flag
 
+    def start_bulkupload(self,
+                         update,
+                         parsed):
+        """
+        Start uploading images/*.jpg into resp_get in the background.
+
+        `v_photo_bulkupload [keyword [tag]]` files every photo under keyword,
+        otherwise under its file name without a trailing number (cat_2.jpg -> cat).
+        """
+        chat_id = update.message.chat_id
+        mesg_id = update.message.message_id
+
+        if self.bulkupload and self.bulkupload.is_alive():
+            self.send_generic_mesg(chat_id, self.bulkupload.progress_text(), mesg_id)
+            return
+
+        fl = sorted(Path(self.config.get('bulkupload_dir', 'images')).glob('*.jpg'))
+        if len(fl) == 0:
+            self.send_generic_mesg(chat_id, self.strs['vr_photo_bulkupload_no_file'], mesg_id)
+            return
+
+        args = parsed.text[len(self.strs['v_photo_bulkupload']):].lower().split()
+        keyword = args[0] if args else None
+        tag = args[1] if len(args) > 1 else None
+
+        # for multi-group.
+        gid = KeywordSpaces.gid_of(chat_id)
+
+        self.bulkupload = BulkUpload(self.bot,
+                                     self.resp_db,
+                                     fl,
+                                     chat_id,
+                                     lambda path: self.bulkupload_keyword(chat_id, path, keyword, tag),
+                                     lambda rows: self.add_uploaded_photos(gid, rows),
+                                     gid = gid,
+                                     workers = self.config.get('bulkupload_workers', 4),
+                                     reply_to_message_id = mesg_id)
+        self.bulkupload.start()
+
+    def bulkupload_keyword(self,
+                           chat_id,
+                           path,
+                           keyword = None,
+                           tag = None):
+        """
+        Returns:
+            (keyword, tag) of an uploaded file, symptoms resolved.
+        """
+        if not keyword:
+            keyword = re.sub('[_-]?[0-9]+$', '', path.stem.lower()) or path.stem.lower()
+        return KeywordSpaces.resolve(self.kw_spaces.of_chat(chat_id), keyword, True), tag
+
+    def add_uploaded_photos(self,
+                            gid,
+                            rows):
+        """
+        Add rows written by a bulk upload to the keyword space of gid.
+
+        Args:
+            rows (list of (IIDX, keyword, file_id, tag)):
+                New resp_get rows.
+        """
+        space = self.kw_spaces.space(gid)
+        for iidx, kw, file_id, tag in rows:
+            space.add(iidx, kw, file_id, tag, True)
+
     def set_is_accepting_photos(self,
                                       flag):
         """Assign flag to is_accepting_photos."""
         self.is_accepting_photos = flag
 
-    @staticmethod
-    def execute_callbacks(bcblist,
-                          update):
-        """Run registered callbacks."""
-        for bcb in bcblist:
-            if bcb.execute(update):
-                return True
-        return False
+    def register_callbacks(self,
+                           strs = None,
+                           tables = None):
+        """
+        Register callbacks and compile the routing tables.
 
-    def register_callbacks(self):
-        """Register callbacks."""
+        Arguments:
+            strs (Optional[dict]):
+                L10N strings providing the callback keywords, self.strs by default.
+            tables (Optional[dict]):
+                Tables made by build_callbacks() to install instead.
+        """
+        if tables is None:
+            tables = self.build_callbacks(strs)
+        self.state = self.state.replace(tables = tables)
+
+    def build_callbacks(self,
+                        strs = None):
+        """
+        Build callbacks and routing tables without touching the running
+        ones, so a failure (e.g. a missing string) leaves them as they are.
+
+        Returns:
+            dict of attribute name -> table, for register_callbacks().
+        """
+        if not strs:
+            strs = self.strs
 
         # For restricted chats, only restricted commands and fortune teller works.
-        self.bot_callbacks_restricted = [
+        bot_callbacks_restricted = [
             self.BotCallback('call_cmd_handler_bcb',
                              self,
                              {'q_kw': '/'},
                              False,
-                             lambda update: self.handle_cmd(update)),
+                             lambda update, parsed: self.handle_cmd(update, parsed)),
 
             self.BotCallback('call_fortune_teller_bcb',
                              self,
                              { },
                              False,
-                             lambda update: self.handle_fortune_tell(update),
+                             lambda update, parsed: self.handle_fortune_tell(update),
                              lambda update: self.match_fortune_type(update.message.text))
         ]
 
         # For regular chats.
-        self.bot_callbacks = [
+        bot_callbacks = [
             self.BotCallback('reload_kw_bcb',
                              self,
-                             {'q_kw': self.strs['a_reload_kwlist_kw'],
-                              'r_ok': self.strs['ar_reload_kwlist_ok'],
-                              'r_ng': self.strs['ar_reload_kwlist_ng']},
+                             {'q_kw': strs['a_reload_kwlist_kw'],
+                              'r_ok': strs['ar_reload_kwlist_ok'],
+                              'r_ng': strs['ar_reload_kwlist_ng']},
                              True,
-                             lambda update: self.init_resp()),
+                             lambda update, parsed: self.init_resp()),
 
             self.BotCallback('set_running_f_bcb',
                              self,
-                             {'q_kw': self.strs['s_status_f_kw'],
-                              'r_ok': self.strs['sr_status_f_ok'],
-                              'r_ng': self.strs['sr_status_f_ng']},
+                             {'q_kw': strs['s_status_f_kw'],
+                              'r_ok': strs['sr_status_f_ok'],
+                              'r_ng': strs['sr_status_f_ng']},
                              True,
-                             lambda update: self.set_is_running(False)),
+                             lambda update, parsed: self.set_is_running(False)),
 
             self.BotCallback('set_imgupload_t_bcb',
                              self,
-                             {'q_kw': self.strs['s_imgupload_t_kw'],
-                              'r_ok': self.strs['sr_imgupload_t_ok'],
-                              'r_ng': self.strs['sr_imgupload_t_ng']},
+                             {'q_kw': strs['s_imgupload_t_kw'],
+                              'r_ok': strs['sr_imgupload_t_ok'],
+                              'r_ng': strs['sr_imgupload_t_ng']},
                              True,
-                             lambda update: self.set_is_accepting_photos(True)),
+                             lambda update, parsed: self.set_is_accepting_photos(True)),
 
             self.BotCallback('set_imgupload_f_bcb',
                              self,
-                             {'q_kw': self.strs['s_imgupload_f_kw'],
-                              'r_ok': self.strs['sr_imgupload_f_ok'],
-                              'r_ng': self.strs['sr_imgupload_f_ng']},
+                             {'q_kw': strs['s_imgupload_f_kw'],
+                              'r_ok': strs['sr_imgupload_f_ok'],
+                              'r_ng': strs['sr_imgupload_f_ng']},
                              True,
-                             lambda update: self.set_is_accepting_photos(False)),
+                             lambda update, parsed: self.set_is_accepting_photos(False)),
 
             self.BotCallback('call_adm_cmd_handler_bcb',
                              self,
                              {'q_kw': '/adm'},
                              True,
-                             lambda update: self.handle_adm_cmd(update)),
+                             lambda update, parsed: self.handle_adm_cmd(update, parsed)),
 
             self.BotCallback('call_cmd_handler_bcb',
                              self,
                              {'q_kw': '/'},
                              False,
-                             lambda update: self.handle_cmd(update)),
+                             lambda update, parsed: self.handle_cmd(update, parsed)),
 
             self.BotCallback('call_fortune_teller_bcb',
                              self,
                              { },
                              False,
-                             lambda update: self.handle_fortune_tell(update),
+                             lambda update, parsed: self.handle_fortune_tell(update),
                              lambda update: self.match_fortune_type(update.message.text))
         ]
 
+        # Compiled once: keyword prefix trie for callbacks, hash maps for commands.
+        router_restricted = CallbackRouter(bot_callbacks_restricted, self.metrics)
+        router = CallbackRouter(bot_callbacks, self.metrics)
+
+        cmd_handlers = {
+            '/get': self.cmd_get,
+            '/getid': self.cmd_getid,
+            '/roll': self.cmd_roll,
+            '/crash': self.cmd_crash,
+        }
+
+        adm_handlers = {
+            'begin_get': self.adm_begin_get,
+            'end_get': self.adm_end_get,
+            'mk_get': self.adm_mk_get,
+            'getpic_id': self.adm_getpic_id,
+            'ed_get': self.adm_ed_get,
+            'mk_get_sym': self.adm_mk_get_sym,
+            'ls_get': self.adm_ls_get,
+            'mk_kw': self.adm_mk_kw,
+            'mk_sym': self.adm_mk_sym,
+            'rm_kw': self.adm_rm_kw,
+            'rm_get': self.adm_rm_get,
+            'rm_get_sym': self.adm_rm_get_sym,
+            'ls_kw': self.adm_ls_kw,
+            'stats': self.adm_stats,
+            'reload': self.adm_reload,
+        }
+
+        return {'bot_callbacks_restricted': bot_callbacks_restricted,
+                'bot_callbacks': bot_callbacks,
+                'router_restricted': router_restricted,
+                'router': router,
+                'cmd_handlers': cmd_handlers,
+                'adm_handlers': adm_handlers}
+
     class BotCallback:
         """
         This object describes a conditional callback.
@@ -1250,8 +1711,8 @@ class AFXBot:
                 'q_kw': Keyword to match in message text.
                 'r_ok': Response message when the handler ran successfully.
                 'r_ng': Response message when the handler encountered permssion denied.
-            handler_callback (func(update)):
-                The Handler that will be called.
+            handler_callback (func(update, parsed)):
+                The Handler that will be called with the update and its ParsedMessage.
             cond_callback (Optional[func(update)]):
                 The callback function will be called for checking whether to run or not.
         """
@@ -1271,32 +1732,38 @@ class AFXBot:
             self.cond_callback = cond_callback
 
 
-        def execute(self, update):
-            """Execute defined callback function."""
-            mesg = update.message.text
+        def matches(self,
+                    update,
+                    parsed):
+            """Check whether this callback applies to update."""
+            if 'q_kw' in self.strs.keys():
+                return parsed.text.startswith(self.strs['q_kw'])
+            return self.cond_callback(update)
+
+        def run(self,
+                update,
+                parsed):
+            """Run the handler, checking privilege first."""
             chat_id = update.message.chat_id
             mesg_id = update.message.message_id
             user_id = update.message.from_user.id
 
-            if 'q_kw' in self.strs.keys():
-                cond = mesg.startswith(self.strs['q_kw'])
-            else:
-                cond = self.cond_callback(update)
-
-            if cond:
-                if (self.bot.do_adm_auth(user_id) and self.need_adm) or not self.need_adm:
-                    if self.handler_callback:
-                        self.handler_callback(update)
+            if (self.bot.do_adm_auth(user_id) and self.need_adm) or not self.need_adm:
+                if self.handler_callback:
+                    self.handler_callback(update, parsed)
 
-                    if 'r_ok' in self.strs.keys():
-                        self.bot.send_generic_mesg(chat_id, self.strs['r_ok'], mesg_id)
-
-                    return True
-                else:
-                    if 'r_ok' in self.strs.keys():
-                        self.bot.send_generic_mesg(chat_id, self.strs['r_ng'], mesg_id)
+                if 'r_ok' in self.strs.keys():
+                    self.bot.send_generic_mesg(chat_id, self.strs['r_ok'], mesg_id)
+            else:
+                if 'r_ng' in self.strs.keys():
+                    self.bot.send_generic_mesg(chat_id, self.strs['r_ng'], mesg_id)
 
-                    return True
+        def execute(self, update):
+            """Execute defined callback function."""
+            parsed = ParsedMessage(update.message.text)
+            if self.matches(update, parsed):
+                self.run(update, parsed)
+                return True
             else:
                 return False
 
@@ -21,19 +21,33 @@
 __author__ = 'Anfauglir'
 
 import argparse
+import atexit
 import http
 import json
 import logging
 import os
 import random
+import re
 import requests
 import sqlite3
 import string
 import time
 import telegram
+import threading
 import urllib
+from acl import ACL
+from asyncrunner import AsyncUpdateRunner
+from botstate import BotState, pin_state, state_property, unpin_state
 from collections import OrderedDict
+from configwatch import FileWatcher
+from dbpool import open_db
 from locdbhelper import locDBHelper
+from logutil import log_update, setup_logging
+from metrics import Metrics, MetricsServer
+from migrate import LOC_MIGRATIONS, migrate
+from router import CallbackRouter, ParsedMessage
+from senddispatcher import SendDispatcher
+from webhook import WebhookServer
 
 
 class Eatsnakebot:
@@ -41,6 +55,26 @@ class Eatsnakebot:
     This object represents a working Telegram bot.
 
     """
+
+    # Roles of chats allowed to eatsnake, and to reach the bot at all.
+    OPERATIONAL_ROLES = ACL.ADM | ACL.OPERATIONAL
+    AUGMENTED_ROLES = ACL.ADM | ACL.OPERATIONAL | ACL.RESTRICTED
+
+    # Config keys only read at start-up, reported by reload_configuration() when changed.
+    RESTART_KEYS = ('bot_token', 'send_chat_rate', 'send_chat_burst', 'send_global_rate', 'async_workers',
+                    'webhook_url', 'webhook_listen', 'webhook_port', 'webhook_path', 'webhook_secret',
+                    'webhook_queue_size', 'webhook_workers', 'metrics_listen', 'metrics_port',
+                    'config_watch_interval')
+
+    # Read through the BotState pinned by the update being handled, see handle_update().
+    config = state_property('config')
+    strs = state_property('strs')
+    acl = state_property('acl')
+    bot_callbacks_restricted = state_property('bot_callbacks_restricted')
+    bot_callbacks = state_property('bot_callbacks')
+    router_restricted = state_property('router_restricted')
+    router = state_property('router')
+
     def __init__(self,
                  conf_file_name = None,
                  **kwargs):
@@ -49,34 +83,50 @@ class Eatsnakebot:
         self.NOW_HANDLING_UPDATE_ID = None
         self.logger = logging.getLogger()
         self.bot = None
-        self.config = None
-        self.strs = None
+        self.conf_file_name = None
         self.loc_list = []
 
+        # Config, strings, ACL and routing tables, replaced as one by reloads.
+        self.state = None
+        self.pinned_state = threading.local()
+
+        # Config reloads, by /adm reload or the file watcher.
+        self.reload_lock = threading.Lock()
+        self.config_watcher = None
+
         # Bot state
         self.is_running = True
         self.is_accepting_photos = False
 
+        # Stage/route latencies, counters and queue depths.
+        self.metrics = Metrics()
+        self.metrics_server = None
+
         # Parse command line params
-        self.log_fmt_str = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
         arg_parser = argparse.ArgumentParser(description = 'Eatsnakebot, a simple Telegram bot in Python.')
-        arg_parser.add_argument('-l', '--logfile', help='Logfile Name', action='store_true')
+        arg_parser.add_argument('-l', '--logfile', help='Logfile path, rotated at 10 MB')
+        arg_parser.add_argument('--log-level', default='INFO', help='DEBUG, INFO, WARNING, ...')
+        arg_parser.add_argument('--log-json', help='JSON lines with update_id, chat_id, route and latency', action='store_true')
+        arg_parser.add_argument('--log-sample', help='Fraction of records below WARNING kept', type=float, default=1.0)
 
         args = arg_parser.parse_args()
 
         self.init_configuration(conf_file_name)
         self.init_l10n_strings()
 
-        if args.logfile:
-            logging.basicConfig( level=logging.DEBUG, format=self.log_fmt_str, filename=args.logfile)
-        else:
-            logging.basicConfig( level=logging.DEBUG, format=self.log_fmt_str)
+        self.log_listener = setup_logging(args.logfile, args.log_level, args.log_json, args.log_sample)
+        atexit.register(self.log_listener.stop)
         self.logger = logging.getLogger('NTUEatsnakebot')
-        self.logger.setLevel(logging.DEBUG)
 
         # Telegram Bot Authorization Token
         self.bot = telegram.Bot(self.config['bot_token'])
         self.api_url = "https://api.telegram.org/bot{}/".format(self.config['bot_token'])
+        self.dispatcher = SendDispatcher(self,
+                                         self.config.get('send_chat_rate', 1.0),
+                                         self.config.get('send_chat_burst', 3),
+                                         self.config.get('send_global_rate', 30.0),
+                                         metrics = self.metrics)
+        self.metrics.gauge('send_queue_depth', self.dispatcher.pending)
         self.register_callbacks()
         self.recognition_list = [132592798]
 
@@ -92,20 +142,12 @@ class Eatsnakebot:
         """
         # Load Configuration
         if not file_name:
-            file_name = os.path.join(path, "config.json")
+            file_name = 'config.json'
+        self.conf_file_name = file_name
 
         try:
-            with open(file_name, 'r', encoding = 'utf8') as f:
-                self.config = json.loads(f.read())
-
-            # Check Configuration
-            configs_check = ['strings_json', 'bot_token', 'loc_db', 'adm_ids']
-            for c in configs_check:
-                self.check_config_entry(c)
-
-            list_configs_check = ['operational_chats', 'restricted_chats']
-            for c in list_configs_check:
-                self.check_config_entry_of_list(c)
+            config = self.load_configuration(file_name)
+            self.state = BotState(config, acl = ACL(config))
 
             self.init_locdb()
             self.logger.debug('bot initialization successful')
@@ -118,6 +160,28 @@ class Eatsnakebot:
         except:
             raise
 
+    def load_configuration(self,
+                           file_name):
+        """
+        Read and check a configuration file without touching the running bot.
+
+        Returns:
+            Configuration dict.
+        """
+        with open(file_name, 'r', encoding = 'utf8') as f:
+            config = json.loads(f.read())
+
+        # Check Configuration
+        configs_check = ['strings_json', 'bot_token', 'loc_db', 'adm_ids']
+        for c in configs_check:
+            self.check_config_entry(config, c)
+
+        list_configs_check = ['operational_chats', 'restricted_chats']
+        for c in list_configs_check:
+            self.check_config_entry_of_list(config, c)
+
+        return config
+
     def init_l10n_strings(self,
                           file_name = None):
         """
@@ -134,33 +198,68 @@ class Eatsnakebot:
                 raise Exception('L10N file not specified in neither config nor argument!')
 
         try:
-            with open(self.config['strings_json'], 'r', encoding = 'utf8') as f:
-                self.strs = json.loads(f.read())
+            strs = self.load_l10n_strings(file_name)
         except:
             logging.exception('L10N Strings read error!')
             raise
 
+        self.state = self.state.replace(strs = strs)
+
+    def load_l10n_strings(self,
+                          file_name):
+        """
+        Read and check a L10N strings file without touching the running bot.
+
+        Returns:
+            Strings dict.
+        """
+        with open(file_name, 'r', encoding = 'utf8') as f:
+            strs = json.loads(f.read())
+
+        # Read directly by handle_update(); callback keywords are checked by register_callbacks().
+        for k in ['q_status_kw', 'qr_status_t', 'qr_status_f', 's_status_t_kw', 'sr_status_t_ok', 'q_eatsnake_kws']:
+            if k not in strs:
+                logging.error('strs[\'{0}\'] is missing!'.format(k))
+                raise ValueError
+
+        return strs
+
     def check_config_entry(self,
+                           config,
                            name):
         """
         Check whether the config is sane.
         """
-        if not self.config[name]:
+        if not config.get(name):
             logging.error('config[\'{0}\'] is missing!'.format(name))
             raise ValueError
 
     def check_config_entry_of_list(self,
+                                   config,
                                    name):
         """
         Check whether the list in config is sane, or init a empty one.
         """
-        if not self.config[name]:
-            self.config[name] = []
+        if not config.get(name):
+            config[name] = []
 
     def run(self):
         """
         Run the bot: start the loop to fetch updates and handle.
         """
+        self.start_metrics_server()
+        self.start_config_watcher()
+
+        # Updates pushed by Telegram when config['webhook_url'] is set.
+        if self.config.get('webhook_url'):
+            self.run_webhook()
+            return
+
+        # Concurrent handling when config['async_workers'] is set.
+        if self.config.get('async_workers'):
+            AsyncUpdateRunner(self, self.config['async_workers'], metrics = self.metrics).run()
+            return
+
         self.get_latest_update_id()
         self.recoverStatus = False
 
@@ -187,6 +286,93 @@ class Eatsnakebot:
                 logging.exception('!!! EXCEPTION HAS OCCURRED !!!')
                 self.recover()
 
+    def run_webhook(self):
+        """
+        Register config['webhook_url'] with config['webhook_secret'] and serve
+        updates pushed to it at config['webhook_path'].
+        """
+        server = WebhookServer(self,
+                               self.config.get('webhook_listen', '127.0.0.1'),
+                               self.config.get('webhook_port', 8443),
+                               self.config.get('webhook_path'),
+                               self.config.get('webhook_secret'),
+                               self.config.get('webhook_queue_size', 1000),
+                               self.config.get('webhook_workers', 1))
+        self.metrics.gauge('webhook_queue_depth', server.queue.qsize)
+        self.bot.setWebhook(self.config['webhook_url'], secret_token = self.config['webhook_secret'])
+        try:
+            server.serve_forever()
+        finally:
+            server.stop()
+
+    def reload_configuration(self):
+        """
+        Reload configuration and L10N strings while the bot keeps serving.
+
+        Everything is read, checked and built aside into a new BotState,
+        which replaces self.state in one assignment once all of it
+        succeeded, so a broken file leaves the bot as it was and updates in
+        flight keep the state they pinned. Changes to RESTART_KEYS are
+        logged and left out until a restart.
+
+        Returns:
+            True when reloaded, otherwise False.
+        """
+        with self.reload_lock:
+            try:
+                config = self.load_configuration(self.conf_file_name)
+                strs = self.load_l10n_strings(config['strings_json'])
+                acl = ACL(config)
+                tables = self.build_callbacks(strs)
+            except Exception:
+                self.logger.exception('Reload failed, keeping the running configuration')
+                return False
+
+            # Keep the running values, so config describes what is in effect.
+            running = self.state.config
+            not_applied = [k for k in self.RESTART_KEYS if config.get(k) != running.get(k)]
+            for k in not_applied:
+                if k in running:
+                    config[k] = running[k]
+                else:
+                    del config[k]
+            if not_applied:
+                self.logger.warning('Changed config not applied until restart: {0}'.format(', '.join(not_applied)))
+            if any(config.get(k) != running.get(k) for k in ('loc_db', 'loc_weight_by')):
+                self.logger.warning('loc_db/loc_weight_by changed, applied on the next keyword list reload')
+
+            # Everything is built, swap it in.
+            self.state = BotState(config, strs, acl, tables)
+
+        self.logger.info('Configuration reloaded from {0}'.format(self.conf_file_name))
+        return True
+
+    def start_config_watcher(self):
+        """
+        Reload when the config or strings file changes, polled every
+        config['config_watch_interval'] seconds if set.
+        """
+        interval = self.config.get('config_watch_interval')
+        if not interval or self.config_watcher:
+            return
+
+        self.config_watcher = FileWatcher(lambda: [self.conf_file_name, self.config['strings_json']],
+                                          self.reload_configuration,
+                                          interval)
+        self.config_watcher.start()
+
+    def start_metrics_server(self):
+        """
+        Serve Prometheus-text metrics on localhost when config['metrics_port'] is set.
+        """
+        if not self.config.get('metrics_port') or self.metrics_server:
+            return
+
+        self.metrics_server = MetricsServer(self.metrics,
+                                            self.config.get('metrics_listen', '127.0.0.1'),
+                                            self.config['metrics_port'])
+        self.metrics_server.start()
+
     def recover(self):
         """
         Recover the bot in next loop.
@@ -202,66 +388,121 @@ class Eatsnakebot:
         Fetch updates from server for further processes.
         """
         # Request updates after the last updated_id
-        for update in self.bot.getUpdates(offset = self.LAST_UPDATE_ID, timeout = 10):
-            self.logger.info('Update: ' + str(update));
-            # chat_id is required to reply any message
-            if update.edited_message:
-                # Does NOT reply to edited messages
-                nothing_todo = 1
-            else:
-                chat_id = update.message.chat_id
-                message = update.message.text
-                mesg_id = update.message.message_id
-                user_id = update.message.from_user.id
-                self.NOW_HANDLING_UPDATE_ID = update.update_id
-                self.logger.debug('Now handling update: {0}'.format(self.NOW_HANDLING_UPDATE_ID))
+        updates = self.metrics.timed('fetch', self.bot.getUpdates, offset = self.LAST_UPDATE_ID, timeout = 10)
+        for update in updates:
+            self.handle_update(update)
 
-                try:
-                    if message:
-                        # YOU SHALL NOT PASS!
-                        # Only authorized group chats and users (admins) can access this bot.
-                        if not self.do_augmented_auth(update.message.chat.id):
-                            if '__FOR_RECOGNITION__' in message and not update.message.chat.id in self.recognition_list:
-                                self.send_generic_mesg(chat_id, 'Please contact moderator to add following id into ACL.')
-                                self.send_generic_mesg(chat_id, str(update.message.chat.id))
-                                self.recognition_list.append(update.message.chat.id)
-                            else:
-                                self.logger.info('Access denied from: ' + str(update.message.chat.id))
-
-                        # Status querying.
-                        elif self.strs['q_status_kw'] in message:
-                            if self.is_running:
-                                self.send_generic_mesg(chat_id, self.strs['qr_status_t'], mesg_id)
-                            else:
-                                self.send_generic_mesg(chat_id, self.strs['qr_status_f'], mesg_id)
-
-                        # Only admins can re-enable bot.
-                        elif not self.is_running and message.startswith(self.strs['s_status_t_kw']) and self.do_adm_auth(user_id):
-                            self.send_generic_mesg(chat_id, self.strs['sr_status_t_ok'], mesg_id)
-                            self.init_locdb()
-                            self.is_running = True
-
-                        # Handle adm commands/common commands/eatsnake requests
-                        elif self.is_running and self.do_operational_auth(update.message.chat.id):
-                            # So, eatsnake?
-                            if self.execute_callbacks(self.bot_callbacks, update):
-                                nothing_todo = 1
-                            # other...
-                            else:
-                                self.handle_response(update)
-                        elif self.is_running:
-                            self.logger.debug('Not handling updates.')
+            # Updates global offset to get the new updates
+            self.LAST_UPDATE_ID = update.update_id + 1
+
+    def handle_update(self,
+                      update):
+        """
+        Handle a single update.
+
+        Args:
+            update (telegram.update):
+                Update object to handle.
+        Returns:
+            Name of the route which handled the update, or None.
+        """
+        # Config, strings, ACL and routes stay the ones of this state for the whole update.
+        state = pin_state(self)
+        try:
+            return self.dispatch_update(update, state)
+        finally:
+            unpin_state(self)
+
+    def dispatch_update(self,
+                        update,
+                        state):
+        """
+        Route a single update, see handle_update().
+
+        Args:
+            update (telegram.update):
+                Update object to handle.
+            state (BotState):
+                State pinned for this update.
+        Returns:
+            Name of the route which handled the update, or None.
+        """
+        self.logger.debug('Update: %s', update)
+        route = None
+        chat_id = None
+        started = time.perf_counter()
+        self.metrics.inc('updates')
+        # chat_id is required to reply any message
+        if update.edited_message:
+            # Does NOT reply to edited messages
+            nothing_todo = 1
+        else:
+            chat_id = update.message.chat_id
+            message = update.message.text
+            mesg_id = update.message.message_id
+            user_id = update.message.from_user.id
+            self.NOW_HANDLING_UPDATE_ID = update.update_id
+            self.logger.debug('Now handling update: %s', self.NOW_HANDLING_UPDATE_ID)
+
+            try:
+                # Every role of the chat in one lookup.
+                chat_roles = self.metrics.timed('auth', state.acl.roles_of, update.message.chat.id)
+
+                if message:
+                    # YOU SHALL NOT PASS!
+                    # Only authorized group chats and users (admins) can access this bot.
+                    if not chat_roles & self.AUGMENTED_ROLES:
+                        if '__FOR_RECOGNITION__' in message and not update.message.chat.id in self.recognition_list:
+                            self.send_generic_mesg(chat_id, 'Please contact moderator to add following id into ACL.')
+                            self.send_generic_mesg(chat_id, str(update.message.chat.id))
+                            self.recognition_list.append(update.message.chat.id)
                         else:
-                            self.logger.debug('Not running...')
+                            self.logger.info('Access denied from: %s', update.message.chat.id)
 
-                except:
-                    if chat_id != None and mesg_id != None:
-                        self.send_generic_mesg(chat_id, self.append_more_smiles('好像哪裡怪怪der '), mesg_id)
-                    self.logger.exception('')
+                    # Status querying.
+                    elif state.strs['q_status_kw'] in message:
+                        route = 'status'
+                        if self.is_running:
+                            self.send_generic_mesg(chat_id, state.strs['qr_status_t'], mesg_id)
+                        else:
+                            self.send_generic_mesg(chat_id, state.strs['qr_status_f'], mesg_id)
+
+                    # Only admins can re-enable bot.
+                    elif not self.is_running and message.startswith(state.strs['s_status_t_kw']) and self.do_adm_auth(user_id):
+                        route = 'set_running_t'
+                        self.send_generic_mesg(chat_id, state.strs['sr_status_t_ok'], mesg_id)
+                        self.init_locdb()
+                        self.is_running = True
+
+                    # Handle adm commands/common commands/eatsnake requests
+                    elif self.is_running and chat_roles & self.OPERATIONAL_ROLES:
+                        # So, eatsnake?
+                        parsed = ParsedMessage(message)
+                        if state.router.dispatch(update, parsed):
+                            route = parsed.route
+                        # other...
+                        elif self.handle_response(update):
+                            route = 'response'
+                    elif self.is_running:
+                        self.logger.debug('Not handling updates.')
+                    else:
+                        self.logger.debug('Not running...')
 
-                # Updates global offset to get the new updates
-                self.LAST_UPDATE_ID = self.NOW_HANDLING_UPDATE_ID + 1
+                # Shared location: eatsnake around there.
+                elif update.message.location and self.is_running and chat_roles & self.OPERATIONAL_ROLES:
+                    route = 'eatsnake_nearby'
+                    self.handle_eatsnake_nearby(update)
 
+            except:
+                self.metrics.inc('errors')
+                if chat_id != None and mesg_id != None:
+                    self.send_generic_mesg(chat_id, self.append_more_smiles('好像哪裡怪怪der '), mesg_id)
+                self.logger.exception('')
+
+        elapsed = time.perf_counter() - started
+        self.metrics.observe('update', elapsed, route or 'none')
+        log_update(self.logger, update.update_id, chat_id, route, elapsed)
+        return route
 
     def get_latest_update_id(self):
         """
@@ -269,14 +510,14 @@ class Eatsnakebot:
         """
         try:
             updates = self.bot.getUpdates(timeout = 10)
-            self.logger.debug('update length: {0}'.format(len(updates)))
+            self.logger.debug('update length: %s', len(updates))
             if len(updates) == 1:
                 self.LAST_UPDATE_ID = updates[-1].update_id
             else:
                 while(len(updates) > 1):
                     self.LAST_UPDATE_ID = updates[-1].update_id
                     updates = self.bot.getUpdates(offset=self.LAST_UPDATE_ID+1, timeout = 10)
-                    self.logger.debug('update length: {0}'.format(len(updates)))
+                    self.logger.debug('update length: %s', len(updates))
         except:
             self.logger.exception('!!! Get Last update ID Error !!!')
 
@@ -285,10 +526,10 @@ class Eatsnakebot:
         Read all entries from self.loc_db.
         """
         self.logger.debug('Initializing geolocation database...')
-        self.loc_db = locDBHelper(self.config['loc_db'])
-        # c = self.loc_db.cur
-
-        # TODO: use cursor to set type filters
+        # 'pricerange' or a list of tags to bias picks, uniform when unset.
+        # Tag and price filters are indexed by the helper itself.
+        migrate(open_db(self.config['loc_db']), LOC_MIGRATIONS)
+        self.loc_db = locDBHelper(self.config['loc_db'], self.config.get('loc_weight_by'))
 
 
     def send_generic_mesg(self,
@@ -297,8 +538,9 @@ class Eatsnakebot:
                           reply_to_message_id = None):
         """
         For sending simple messages only including text (in most cases.)
+        Queued to the send dispatcher, returns right away.
         """
-        self.bot.sendMessage(chat_id = chat_id, text = text, reply_to_message_id = reply_to_message_id)
+        self.dispatcher.send_message(chat_id, text, reply_to_message_id)
 
     def match_eatsnake(self,
                        update):
@@ -306,6 +548,41 @@ class Eatsnakebot:
         eatsnakekws = self.strs['q_eatsnake_kws']
         return True if any(x in mesg for x in eatsnakekws) else False
 
+    def parse_eatsnake_filters(self,
+                               mesg):
+        """
+        Parse filters following an eatsnake keyword, e.g. "吃蛇 拉麵 <200".
+
+        Known tags are collected; "<N", "<=N", ">N", ">=N" and "N-M" set the price range.
+        Any other word is ignored so casual chatting still gets a plain pick.
+
+        Returns:
+            (tags, price_min, price_max)
+        """
+        tags = []
+        price_min = None
+        price_max = None
+
+        for tok in mesg.lower().split():
+            res = re.match('^([<>])=?([0-9]+)$', tok)
+            if res:
+                if res.group(1) == '<':
+                    price_max = int(res.group(2))
+                else:
+                    price_min = int(res.group(2))
+                continue
+
+            res = re.match('^([0-9]+)-([0-9]+)$', tok)
+            if res:
+                price_min = int(res.group(1))
+                price_max = int(res.group(2))
+                continue
+
+            if self.loc_db.has_tag(tok):
+                tags.append(tok)
+
+        return tags, price_min, price_max
+
     def handle_eatsnake(self,
                         update):
         """
@@ -322,27 +599,81 @@ class Eatsnakebot:
         mesg_id = update.message.message_id
         user_id = update.message.from_user.id
 
+        # Generate a choice
+        tags, price_min, price_max = self.parse_eatsnake_filters(mesg)
+        if tags or price_min is not None or price_max is not None:
+            choice = self.metrics.timed('db', self.loc_db.get_filtered_choice, tags, price_min, price_max)
+            if not choice:
+                self.send_generic_mesg(chat_id, self.append_more_smiles('沒有符合條件的蛇 '), mesg_id)
+                return
+        else:
+            choice = self.metrics.timed('db', self.loc_db.get_choice, weighted = True)
+
+        self.send_choice(chat_id, choice, mesg_id, user_id)
+
+    def handle_eatsnake_nearby(self,
+                               update):
+        """
+        Handles shared locations: picks among restaurants near the given location.
+
+        Args:
+            update (telegram.update):
+                Update object to handle.
+        """
+        chat_id = update.message.chat_id
+        mesg_id = update.message.message_id
+        user_id = update.message.from_user.id
+        location = update.message.location
+
+        # Within eatsnake_nearby_radius meters if configured, otherwise among the k nearest.
+        radius = self.config.get('eatsnake_nearby_radius')
+        k = None if radius else self.config.get('eatsnake_nearby_k', 10)
+
+        res = self.metrics.timed('db', self.loc_db.get_nearby_choice, location.latitude, location.longitude, k, radius)
+        if not res:
+            self.send_generic_mesg(chat_id, self.append_more_smiles('附近沒有蛇可以吃 '), mesg_id)
+            return
+
+        distance, choice = res
+        self.send_choice(chat_id, choice, mesg_id, user_id, distance)
+
+    def send_choice(self,
+                    chat_id,
+                    choice,
+                    mesg_id,
+                    user_id,
+                    distance = None):
+        """
+        Send a restaurant choice along with its location.
+
+        Args:
+            choice (sqlite3.Row):
+                Restaurant row to send.
+            distance (Optional[float]):
+                Distance in meters from the requested location.
+        """
         # Put it into l10n file or dbhelper later?
         attr = [('name', "店家名稱"), ('pricerange', "價位"), ('mincharge', "低消"),
                 ('address', "地址"), ('optime', "營業時間"), ('tags', "關鍵字"), ('other', "其他")]
         attr = OrderedDict(attr)
 
-        # Generate a choice
         outmesg = "吃這間如何？ " + '\U0001F40D'
-        choice = self.loc_db.get_choice()
+        keys = choice.keys()
         for x in attr:
-            if choice[x] and choice[x] != '':
+            if x in keys and choice[x] and choice[x] != '':
                 outmesg += '\n' + attr[x] + '：' + str(choice[x])
+        if distance is not None:
+            outmesg += '\n距離：{0:.0f}m'.format(distance)
 
         # Maybe not neat enough, but not gonna it for now :(
         lat = choice['latitude'] if choice['latitude'] else 25.017356
         lng = choice['longitude'] if choice['longitude'] else 121.539755
 
         self.send_generic_mesg(chat_id, outmesg, mesg_id)
-        self.bot.sendLocation(chat_id = chat_id, latitude = lat, longitude = lng)
+        self.dispatcher.call('sendLocation', chat_id = chat_id, latitude = lat, longitude = lng)
 
         # Hardcoded extras...
-        if (user_id == 77414661 && random.randint(0, 99) < 10):
+        if (user_id == 77414661 and random.randint(0, 99) < 10):
             self.send_generic_mesg(chat_id, "看看你的肚子，還吃？", mesg_id)
 
     def do_adm_auth(self,
@@ -351,7 +682,7 @@ class Eatsnakebot:
         Returns:
             Presence of id in self.config['adm_ids'].
         """
-        return id in self.config['adm_ids']
+        return self.acl.has(id, ACL.ADM)
 
     def do_operational_auth(self,
                             id):
@@ -360,8 +691,7 @@ class Eatsnakebot:
             Presence of id in self.config['operational_chats'],
                               self.config['adm_ids']
         """
-        return id in self.config['operational_chats'] \
-               or id in self.config['adm_ids']
+        return self.acl.has(id, self.OPERATIONAL_ROLES)
 
     def do_augmented_auth(self,
                           id):
@@ -371,9 +701,7 @@ class Eatsnakebot:
                               self.config['adm_ids'],
                               self.config['restricted_chats'],
         """
-        return id in self.config['operational_chats'] \
-               or id in self.config['adm_ids'] \
-               or id in self.config['restricted_chats'] \
+        return self.acl.has(id, self.AUGMENTED_ROLES)
 
     def append_more_smiles(self,
                            str,
@@ -386,27 +714,25 @@ class Eatsnakebot:
         return str + '\U0001F603' * random.randint(rl, ru)
 
     def handle_adm_cmd(self,
-                       update):
+                       update,
+                       parsed = None):
         """
         Handles all administrative commands.
 
         Args:
             update (telegram.update):
                 Update object to handle.
+            parsed (Optional[ParsedMessage]):
+                Tokenized message, parsed from update when not given.
         """
         chat_id = update.message.chat_id
-        try:
-            mesg = update.message.text.strip()
-        except:
-            mesg = update.edited_message.text.strip()
         mesg_id = update.message.message_id
+        if not parsed:
+            parsed = ParsedMessage((update.message or update.edited_message).text)
 
-        cmd_toks = [x.strip() for x in mesg.split(' ')]
-        while '' in cmd_toks:
-            cmd_toks.remove('')
-
-        cmd_entity = cmd_toks[1].lower()
-        self.logger.debug('cmd_entity: ' + cmd_entity)
+        cmd_toks = parsed.toks
+        cmd_entity = cmd_toks[1].lower() if len(cmd_toks) > 1 else ''
+        self.logger.debug('cmd_entity: %s', cmd_entity)
         try:
             if cmd_entity == 'awoo':
                 self.send_generic_mesg(chat_id, "Awoo? owo", mesg_id)
@@ -439,6 +765,15 @@ class Eatsnakebot:
                         self.send_generic_mesg(chat_id, self.strs['r_adm_rm_ng'], mesg_id)
                 except:
                     self.send_generic_mesg(chat_id, self.strs['r_adm_rm_ng'], mesg_id)
+            elif cmd_entity == 'stats':
+                # Latencies (ms), counters and queue depths
+                self.send_generic_mesg(chat_id, self.metrics.render_text(), mesg_id)
+            elif cmd_entity == 'reload':
+                # Reload config and strings files
+                if self.reload_configuration():
+                    self.send_generic_mesg(chat_id, 'Reloaded.', mesg_id)
+                else:
+                    self.send_generic_mesg(chat_id, 'Reload failed, still running the old config.', mesg_id)
             elif cmd_entity == 'help':
                 # Show help message
                 try:
@@ -456,38 +791,36 @@ class Eatsnakebot:
             self.send_generic_mesg(chat_id, self.strs['i_adm_error'], mesg_id)
 
     def handle_cmd(self,
-                   update):
+                   update,
+                   parsed = None):
         """
         Handles all common commands.
 
         Args:
             update (telegram.update):
                 Update object to handle.
+            parsed (Optional[ParsedMessage]):
+                Tokenized message, parsed from update when not given.
         Returns:
             True when the command is handled, otherwise False.
         """
         chat_id = update.message.chat_id
         restricted = not self.do_operational_auth(chat_id)
-        try:
-            mesg = update.message.text
-        except:
-            mesg = update.edited_message.text
         mesg_id = update.message.message_id
-        mesg_low = mesg.lower().replace('@NTUEatsnakebot', '')
+        if not parsed:
+            parsed = ParsedMessage((update.message or update.edited_message).text)
 
         if chat_id > 0:
             # Private message commands
-            cmd_toks = [x.strip() for x in mesg.split(' ')]
-            while '' in cmd_toks:
-                cmd_toks.remove('')
-            if mesg == '/sheeturl':
+            cmd_toks = parsed.toks
+            if parsed.cmd == '/sheeturl':
                 self.send_generic_mesg(chat_id, self.config['locdb_sheet_url'], mesg_id)
-            elif mesg == '/crash':
+            elif parsed.cmd == '/crash':
                 raise Exception('Crash!')
-            elif mesg.beginswith('/help ') or mesg_low == '/help':
+            elif parsed.cmd == '/help':
                 # Show help messages
-                if cmd_toks[1] in self.strs['i_cmd_cmdlist']:
-                    self.send_generic_mesg(chat_id, self.strs['i_cmd_help_{}'.format(cmd_toks[1])], mesg_id)
+                if len(cmd_toks) > 1 and cmd_toks[1] in self.strs['i_cmd_cmdlist']:
+                    outmesg = self.strs['i_cmd_help_{}'.format(cmd_toks[1])]
                 else:
                     outmesg = 'Available commands: {}.\nsend \"/help [command name]\" to show specific command usage.'.format(self.strs['i_cmd_cmdlist'])
                 self.send_generic_mesg(chat_id, outmesg, mesg_id)
@@ -524,7 +857,7 @@ class Eatsnakebot:
         snakesticker = "CAADBAADQQsAArdZUgKNmzWicXfDmAI"
 
         if chat_id < 0 and '蛇' in mesg:
-            self.bot.sendSticker(chat_id, snakesticker, reply_to_message_id = mesg_id)
+            self.dispatcher.call('sendSticker', chat_id = chat_id, sticker = snakesticker, reply_to_message_id = mesg_id)
             return True
         # only do things when receiving eatsnake requests for now...
         return False
@@ -539,82 +872,107 @@ class Eatsnakebot:
         """Assign flag to is_accepting_photos."""
         self.is_accepting_photos = flag
 
-    @staticmethod
-    def execute_callbacks(bcblist,
-                          update):
-        """Run registered callbacks."""
-        for bcb in bcblist:
-            if bcb.execute(update):
-                return True
-        return False
+    def register_callbacks(self,
+                           strs = None,
+                           tables = None):
+        """
+        Register callbacks and compile the routing tables.
+
+        Arguments:
+            strs (Optional[dict]):
+                L10N strings providing the callback keywords, self.strs by default.
+            tables (Optional[dict]):
+                Tables made by build_callbacks() to install instead.
+        """
+        if tables is None:
+            tables = self.build_callbacks(strs)
+        self.state = self.state.replace(tables = tables)
+
+    def build_callbacks(self,
+                        strs = None):
+        """
+        Build callbacks and routing tables without touching the running
+        ones, so a failure (e.g. a missing string) leaves them as they are.
 
-    def register_callbacks(self):
-        """Register callbacks."""
+        Returns:
+            dict of attribute name -> table, for register_callbacks().
+        """
+        if not strs:
+            strs = self.strs
 
         # For restricted chats, only restricted commands works.
-        self.bot_callbacks_restricted = [
+        bot_callbacks_restricted = [
             self.BotCallback('call_cmd_handler_bcb',
                              self,
                              {'q_kw': '/'},
                              False,
-                             lambda update: self.handle_cmd(update)),
+                             lambda update, parsed: self.handle_cmd(update, parsed)),
 
         ]
 
         # For regular chats.
-        self.bot_callbacks = [
+        bot_callbacks = [
             self.BotCallback('reload_kw_bcb',
                              self,
-                             {'q_kw': self.strs['a_reload_kwlist_kw'],
-                              'r_ok': self.strs['ar_reload_kwlist_ok'],
-                              'r_ng': self.strs['ar_reload_kwlist_ng']},
+                             {'q_kw': strs['a_reload_kwlist_kw'],
+                              'r_ok': strs['ar_reload_kwlist_ok'],
+                              'r_ng': strs['ar_reload_kwlist_ng']},
                              True,
-                             lambda update: self.init_locdb()),
+                             lambda update, parsed: self.init_locdb()),
 
             self.BotCallback('set_running_f_bcb',
                              self,
-                             {'q_kw': self.strs['s_status_f_kw'],
-                              'r_ok': self.strs['sr_status_f_ok'],
-                              'r_ng': self.strs['sr_status_f_ng']},
+                             {'q_kw': strs['s_status_f_kw'],
+                              'r_ok': strs['sr_status_f_ok'],
+                              'r_ng': strs['sr_status_f_ng']},
                              True,
-                             lambda update: self.set_is_running(False)),
+                             lambda update, parsed: self.set_is_running(False)),
 
             self.BotCallback('set_imgupload_t_bcb',
                              self,
-                             {'q_kw': self.strs['s_imgupload_t_kw'],
-                              'r_ok': self.strs['sr_imgupload_t_ok'],
-                              'r_ng': self.strs['sr_imgupload_t_ng']},
+                             {'q_kw': strs['s_imgupload_t_kw'],
+                              'r_ok': strs['sr_imgupload_t_ok'],
+                              'r_ng': strs['sr_imgupload_t_ng']},
                              True,
-                             lambda update: self.set_is_accepting_photos(True)),
+                             lambda update, parsed: self.set_is_accepting_photos(True)),
 
             self.BotCallback('set_imgupload_f_bcb',
                              self,
-                             {'q_kw': self.strs['s_imgupload_f_kw'],
-                              'r_ok': self.strs['sr_imgupload_f_ok'],
-                              'r_ng': self.strs['sr_imgupload_f_ng']},
+                             {'q_kw': strs['s_imgupload_f_kw'],
+                              'r_ok': strs['sr_imgupload_f_ok'],
+                              'r_ng': strs['sr_imgupload_f_ng']},
                              True,
-                             lambda update: self.set_is_accepting_photos(False)),
+                             lambda update, parsed: self.set_is_accepting_photos(False)),
 
             self.BotCallback('call_adm_cmd_handler_bcb',
                              self,
                              {'q_kw': '/adm'},
                              True,
-                             lambda update: self.handle_adm_cmd(update)),
+                             lambda update, parsed: self.handle_adm_cmd(update, parsed)),
 
             self.BotCallback('call_cmd_handler_bcb',
                              self,
                              {'q_kw': '/'},
                              False,
-                             lambda update: self.handle_cmd(update)),
+                             lambda update, parsed: self.handle_cmd(update, parsed)),
 
             self.BotCallback('call_eatsnake_handler_bcb',
                              self,
                              {},
                              False,
-                             lambda update: self.handle_eatsnake(update),
+                             lambda update, parsed: self.handle_eatsnake(update),
                              lambda update: self.match_eatsnake(update)),
         ]
 
+        # Compiled once: keyword prefix trie for callbacks.
+        router_restricted = CallbackRouter(bot_callbacks_restricted, self.metrics)
+        router = CallbackRouter(bot_callbacks, self.metrics)
+
+        return {'bot_callbacks_restricted': bot_callbacks_restricted,
+                'bot_callbacks': bot_callbacks,
+                'router_restricted': router_restricted,
+                'router': router}
+
     class BotCallback:
         """
         This object describes a conditional callback.
@@ -633,8 +991,8 @@ class Eatsnakebot:
                 'q_kw': Keyword to match in message text.
                 'r_ok': Response message when the handler ran successfully.
                 'r_ng': Response message when the handler encountered permssion denied.
-            handler_callback (func(update)):
-                The Handler that will be called.
+            handler_callback (func(update, parsed)):
+                The Handler that will be called with the update and its ParsedMessage.
             cond_callback (Optional[func(update)]):
                 The callback function will be called for checking whether to run or not.
         """
@@ -654,33 +1012,38 @@ class Eatsnakebot:
             self.cond_callback = cond_callback
 
 
-        def execute(self, update):
-            """Execute defined callback function."""
-            mesg = update.message.text
+        def matches(self,
+                    update,
+                    parsed):
+            """Check whether this callback applies to update."""
+            if 'q_kw' in self.strs.keys():
+                return parsed.text.startswith(self.strs['q_kw'])
+            return self.cond_callback(update)
+
+        def run(self,
+                update,
+                parsed):
+            """Run the handler, checking privilege first."""
             chat_id = update.message.chat_id
             mesg_id = update.message.message_id
             user_id = update.message.from_user.id
-            cond = None
 
-            if 'q_kw' in self.strs.keys():
-                cond = mesg.startswith(self.strs['q_kw'])
-            else:
-                cond = self.cond_callback(update)
-
-            if cond:
-                if (self.bot.do_adm_auth(user_id) and self.need_adm) or not self.need_adm:
-                    if self.handler_callback:
-                        self.handler_callback(update)
+            if (self.bot.do_adm_auth(user_id) and self.need_adm) or not self.need_adm:
+                if self.handler_callback:
+                    self.handler_callback(update, parsed)
 
-                    if 'r_ok' in self.strs.keys():
-                        self.bot.send_generic_mesg(chat_id, self.strs['r_ok'], mesg_id)
-
-                    return True
-                else:
-                    if 'r_ng' in self.strs.keys():
-                        self.bot.send_generic_mesg(chat_id, self.strs['r_ng'], mesg_id)
+                if 'r_ok' in self.strs.keys():
+                    self.bot.send_generic_mesg(chat_id, self.strs['r_ok'], mesg_id)
+            else:
+                if 'r_ng' in self.strs.keys():
+                    self.bot.send_generic_mesg(chat_id, self.strs['r_ng'], mesg_id)
 
-                    return True
+        def execute(self, update):
+            """Execute defined callback function."""
+            parsed = ParsedMessage(update.message.text)
+            if self.matches(update, parsed):
+                self.run(update, parsed)
+                return True
             else:
                 return False
 
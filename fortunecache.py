@@ -0,0 +1,73 @@
+import threading
+
+class FortuneCache:
+    """
+    This object memoizes fortune-tell results for the current day.
+
+    A result only depends on the user, the day and the fortune type, so it
+    is computed once per (user_id, date, type) and answered from memory
+    afterwards. The whole cache is dropped when the date rolls over, or when
+    the strings it was computed from are reloaded.
+
+    Attributes:
+        hits (int):
+            Lookups answered from the cache.
+        misses (int):
+            Lookups that had to compute the result.
+    """
+
+    def __init__(self,
+                 max_entries = 65536):
+        """
+        Arguments:
+            max_entries (int):
+                Entries kept per day; once reached the day starts over, so a
+                flood of distinct users cannot grow the cache unbounded.
+        """
+        self.max_entries = max_entries
+        self.day = None
+        # (user_id, date, type) -> result
+        self.entries = dict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self,
+            user_id,
+            day,
+            type,
+            compute):
+        """
+        Arguments:
+            day (datetime.date):
+                Today, a different day than the cached one clears the cache.
+            compute (func()):
+                Computes the result on a miss.
+        Returns:
+            Result for (user_id, day, type).
+        """
+        key = (user_id, day, type)
+        with self.lock:
+            if day != self.day:
+                self.entries = dict()
+                self.day = day
+            result = self.entries.get(key)
+            if result is not None:
+                self.hits += 1
+                return result
+            self.misses += 1
+
+        result = compute()
+        with self.lock:
+            if day == self.day:
+                if len(self.entries) >= self.max_entries:
+                    self.entries = dict()
+                self.entries[key] = result
+        return result
+
+    def clear(self):
+        with self.lock:
+            self.entries = dict()
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,134 @@
+import logging
+import threading
+from collections import Counter, deque
+
+class KeywordMatcher:
+    """
+    This object finds every registered keyword inside a message in one pass.
+
+    It is an Aho-Corasick automaton over the keyword vocabulary: a trie of
+    all keywords plus failure links, so scanning a message costs
+    O(len(message) + hits) regardless of the vocabulary size.
+
+    Keywords can be added or removed one at a time; the automaton is only
+    rebuilt on the next scan, so a burst of admin writes costs one rebuild.
+    A keyword is reference-counted, so a word added both as a keyword and as
+    a symptom keeps matching until both are removed.
+
+    Scans may run on several threads while keywords change: a rebuilt
+    automaton is swapped in as a whole, never modified in place.
+    """
+
+    def __init__(self,
+                 keywords = None):
+        self.logger = logging.getLogger("KeywordMatcher")
+        self.lock = threading.Lock()
+        self.compile(keywords or [])
+
+    def compile(self,
+                keywords):
+        """
+        Build the automaton from scratch.
+
+        Args:
+            keywords (iterable of str):
+                Keywords to match, already lower-cased.
+        """
+        refs = Counter(kw for kw in keywords if kw)
+        automaton = self._build(refs)
+        with self.lock:
+            self.refs = refs
+            self.automaton = automaton
+            self.is_stale = False
+
+    def add(self,
+            kw):
+        """
+        Add a keyword, or one more reference to it; takes effect on the next scan.
+        """
+        if not kw:
+            return
+        with self.lock:
+            self.refs[kw] += 1
+            if self.refs[kw] == 1:
+                self.is_stale = True
+
+    def remove(self,
+               kw):
+        """
+        Drop one reference to a keyword; when none is left, it stops
+        matching on the next scan.
+        """
+        with self.lock:
+            if self.refs[kw] > 1:
+                self.refs[kw] -= 1
+            elif kw in self.refs:
+                del self.refs[kw]
+                self.is_stale = True
+
+    def _build(self,
+               keywords):
+        # goto[s] maps a character to the next state, out[s] holds the
+        # keywords ending at state s or reached from it by fail links.
+        goto = [dict()]
+        out = [[]]
+        for kw in keywords:
+            s = 0
+            for ch in kw:
+                nxt = goto[s].get(ch)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto.append(dict())
+                    out.append([])
+                    goto[s][ch] = nxt
+                s = nxt
+            out[s].append(kw)
+
+        # Breadth-first pass to set failure links.
+        fail = [0] * len(goto)
+        queue = deque(goto[0].values())
+        while queue:
+            s = queue.popleft()
+            for ch, nxt in goto[s].items():
+                queue.append(nxt)
+                f = fail[s]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                fail[nxt] = goto[f].get(ch, 0)
+                out[nxt] = out[nxt] + out[fail[nxt]]
+
+        self.logger.debug('linked {0} keywords into {1} states'.format(len(keywords), len(goto)))
+        return (goto, fail, out)
+
+    def find_all(self,
+                 text):
+        """
+        Returns:
+            List of distinct keywords found in text, in order of first appearance.
+        """
+        if self.is_stale:
+            with self.lock:
+                if self.is_stale:
+                    self.automaton = self._build(list(self.refs))
+                    self.is_stale = False
+
+        goto, fail, out = self.automaton
+
+        hits = []
+        seen = set()
+        s = 0
+        for ch in text:
+            while s and ch not in goto[s]:
+                s = fail[s]
+            s = goto[s].get(ch, 0)
+            for kw in out[s]:
+                if kw not in seen:
+                    seen.add(kw)
+                    hits.append(kw)
+        return hits
+
+    def __contains__(self, kw):
+        return kw in self.refs
+
+    def __len__(self):
+        return len(self.refs)
@@ -0,0 +1,353 @@
+import bisect
+import random
+import threading
+from kwmatcher import KeywordMatcher
+from respindex import RespIndex
+
+class KeywordSpace:
+    """
+    This object holds the keyword tables of one gid: resp and resp_get
+    contents, symptoms, keyword lists and the matcher over them.
+
+    Attributes:
+        kw_list, kw_list_get (list of str):
+            Keywords having resp / resp_get contents in this space.
+        unified_kw_list, unified_get_list (list of str):
+            The same plus the symptoms of this space.
+        sorted_kw_list, sorted_get_list (list of str):
+            unified_kw_list / unified_get_list kept sorted (with bisect) for
+            paged listings.
+        version (int):
+            Bumped whenever the keyword lists or symptoms change.
+        lock (threading.RLock):
+            Held while contents change and while they are picked from, so
+            admin writes on one thread never race picks on another.
+    """
+
+    def __init__(self,
+                 gid,
+                 lock = None):
+        self.gid = gid
+        self.lock = lock or threading.RLock()
+        self.version = 0
+        # is_get -> (versions, listing) of the spaces a chat with this one first sees
+        self.visible = dict()
+        self.resp_index = RespIndex()
+        self.resp_get_index = RespIndex()
+        self.symptom_tbl = dict()
+        self.symptom_get = dict()
+        self.refresh()
+
+    def index(self,
+              is_get = False):
+        return self.resp_get_index if is_get else self.resp_index
+
+    def symptoms(self,
+                 is_get = False):
+        return self.symptom_get if is_get else self.symptom_tbl
+
+    def refresh(self):
+        """
+        Rebuild keyword lists and the keyword matcher from the in-memory indexes.
+        """
+        self.kw_list = self.resp_index.keywords()
+        self.kw_list_get = self.resp_get_index.keywords()
+
+        self.unified_kw_list = self.kw_list + list(self.symptom_tbl.keys())
+        self.unified_get_list = self.kw_list_get + list(self.symptom_get.keys())
+        self.sorted_kw_list = sorted(self.unified_kw_list)
+        self.sorted_get_list = sorted(self.unified_get_list)
+        self.version += 1
+
+        # Compile keywords/symptoms once so handle_response scans each message in one pass.
+        self.kw_matcher = KeywordMatcher(self.unified_kw_list)
+
+    def sorted_list(self,
+                    is_get = False):
+        return self.sorted_get_list if is_get else self.sorted_kw_list
+
+    def patch(self,
+              keyword,
+              was_present,
+              is_get = False):
+        """
+        Patch keyword lists (and the matcher) after rows of one keyword changed.
+
+        Args:
+            keyword (str):
+                Keyword whose rows were added or removed.
+            was_present (bool):
+                Whether keyword had any content before the change.
+            is_get (bool):
+                True for resp_get, False for resp.
+        """
+        is_present = keyword in self.index(is_get)
+        if is_get:
+            kw_list, unified_list = self.kw_list_get, self.unified_get_list
+        else:
+            kw_list, unified_list = self.kw_list, self.unified_kw_list
+
+        if is_present == was_present:
+            return
+
+        self.version += 1
+        sorted_list = self.sorted_list(is_get)
+        if is_present:
+            kw_list.append(keyword)
+            unified_list.append(keyword)
+            bisect.insort(sorted_list, keyword)
+            if not is_get:
+                self.kw_matcher.add(keyword)
+        else:
+            kw_list.remove(keyword)
+            unified_list.remove(keyword)
+            del sorted_list[bisect.bisect_left(sorted_list, keyword)]
+            if not is_get:
+                self.kw_matcher.remove(keyword)
+
+    def add(self,
+            iidx,
+            keyword,
+            cont,
+            tag = None,
+            is_get = False):
+        """
+        Add a row to the index and keyword lists.
+        """
+        with self.lock:
+            was_present = keyword in self.index(is_get)
+            self.index(is_get).add(iidx, keyword, cont, tag)
+            self.patch(keyword, was_present, is_get)
+
+    def remove(self,
+               iidx,
+               is_get = False):
+        """
+        Returns:
+            Keyword of the removed row, or None when iidx is not in this space.
+        """
+        with self.lock:
+            keyword = self.index(is_get).remove(iidx)
+            if keyword:
+                self.patch(keyword, True, is_get)
+            return keyword
+
+    def add_symptom(self,
+                    kw_before,
+                    kw_after):
+        """
+        Add a symptom -> keyword entry to symptom_tbl, the unified list and the matcher.
+        """
+        with self.lock:
+            self.version += 1
+            if kw_before in self.symptom_tbl:
+                self.symptom_tbl[kw_before] = kw_after
+                return
+            self.symptom_tbl[kw_before] = kw_after
+            self.unified_kw_list.append(kw_before)
+            bisect.insort(self.sorted_kw_list, kw_before)
+            self.kw_matcher.add(kw_before)
+
+class KeywordSpaces:
+    """
+    This object partitions keyword tables by gid.
+
+    Rows with gid -1 form the global space, every other gid (a group chat
+    id) its own space holding only that group's rows. A chat sees its
+    group's space plus the global one: the global tables exist once and are
+    shared by reference, so groups never copy them, and a group only pays
+    for its own vocabulary on top.
+    """
+
+    GLOBAL = -1
+
+    def __init__(self):
+        # One lock for all spaces, as a chat reads two of them at once.
+        self.lock = threading.RLock()
+        self.by_gid = {self.GLOBAL: KeywordSpace(self.GLOBAL, self.lock)}
+
+    @classmethod
+    def gid_of(cls,
+               chat_id):
+        """
+        Returns:
+            gid rows written from chat_id belong to, GLOBAL for private chats.
+        """
+        return cls.GLOBAL if chat_id > 0 else chat_id
+
+    @property
+    def global_space(self):
+        return self.by_gid[self.GLOBAL]
+
+    def space(self,
+              gid):
+        """
+        Returns:
+            KeywordSpace of gid, created when missing.
+        """
+        sp = self.by_gid.get(gid)
+        if sp is None:
+            with self.lock:
+                sp = self.by_gid.get(gid)
+                if sp is None:
+                    sp = self.by_gid[gid] = KeywordSpace(gid, self.lock)
+        return sp
+
+    def of_chat(self,
+                chat_id):
+        """
+        Returns:
+            Spaces visible in chat_id, the group's own first.
+        """
+        sp = self.by_gid.get(self.gid_of(chat_id))
+        glob = self.by_gid[self.GLOBAL]
+        if sp is None or sp is glob:
+            return (glob, )
+        return (sp, glob)
+
+    def refresh(self):
+        for sp in self.by_gid.values():
+            sp.refresh()
+
+    @staticmethod
+    def resolve(spaces,
+                keyword,
+                is_get = False):
+        """
+        Returns:
+            Keyword the symptom keyword stands for (the group's symptoms
+            first), or keyword itself.
+        """
+        for sp in spaces:
+            after = sp.symptoms(is_get).get(keyword)
+            if after is not None:
+                return after
+        return keyword
+
+    @staticmethod
+    def visible(spaces,
+                is_get = False):
+        """
+        Returns:
+            List of (keyword or symptom, keyword the symptom stands for or
+            None) visible in spaces: the group's own sorted first, then the
+            global ones, each once. Merged from the sorted lists after a
+            change and kept until the next, so pages are slices of it.
+        """
+        first = spaces[0]
+        versions = tuple(sp.version for sp in spaces)
+        cached = first.visible.get(is_get)
+        if cached and cached[0] == versions:
+            return cached[1]
+
+        with first.lock:
+            versions = tuple(sp.version for sp in spaces)
+            seen = set()
+            out = []
+            for sp in spaces:
+                syms = sp.symptoms(is_get)
+                for kw in sp.sorted_list(is_get):
+                    if kw not in seen:
+                        seen.add(kw)
+                        out.append((kw, syms.get(kw)))
+            first.visible[is_get] = (versions, out)
+            return out
+
+    @staticmethod
+    def count(spaces,
+              is_get = False):
+        """
+        Returns:
+            Number of entries listing(spaces, is_get) yields.
+        """
+        return len(KeywordSpaces.visible(spaces, is_get))
+
+    @staticmethod
+    def listing(spaces,
+                is_get = False,
+                start = 0):
+        """
+        Walk visible(spaces, is_get) from entry `start` on; entries before
+        it are skipped by index, not visited.
+
+        Yields:
+            (keyword or symptom, keyword the symptom stands for or None).
+        """
+        entries = KeywordSpaces.visible(spaces, is_get)
+        for i in range(start, len(entries)):
+            yield entries[i]
+
+    @staticmethod
+    def owner(spaces,
+              iidx,
+              is_get = False):
+        """
+        Returns:
+            Space of spaces holding row iidx, or None.
+        """
+        for sp in spaces:
+            if sp.index(is_get).get(iidx) is not None:
+                return sp
+        return None
+
+    @staticmethod
+    def find_all(spaces,
+                 text):
+        """
+        Returns:
+            Keywords and symptoms of spaces found in text.
+        """
+        if len(spaces) == 1:
+            return spaces[0].kw_matcher.find_all(text)
+        hits = []
+        for sp in spaces:
+            hits.extend(kw for kw in sp.kw_matcher.find_all(text) if kw not in hits)
+        return hits
+
+    @staticmethod
+    def contains(spaces,
+                 keyword,
+                 is_get = False):
+        return any(keyword in sp.index(is_get) for sp in spaces)
+
+    @staticmethod
+    def pick(spaces,
+             keyword,
+             tag = None,
+             is_get = False):
+        """
+        Returns:
+            A random content of keyword over all spaces (restricted to tag
+            when such contents exist in any), or None.
+        """
+        with spaces[0].lock:
+            buckets = None
+            if tag:
+                buckets = [b for b in (sp.index(is_get).by_tag.get((keyword, tag)) for sp in spaces) if b]
+            if not buckets:
+                buckets = [b for b in (sp.index(is_get).by_kw.get(keyword) for sp in spaces) if b]
+            if not buckets:
+                return None
+            if len(buckets) == 1:
+                return buckets[0].pick()
+
+            # Uniform over the contents of every bucket.
+            i = random.randrange(sum(len(b) for b in buckets))
+            for b in buckets:
+                if i < len(b):
+                    return b.conts[i]
+                i -= len(b)
+
+    @staticmethod
+    def get(spaces,
+            iidx,
+            is_get = False):
+        """
+        Returns:
+            Content of row iidx in spaces, or None.
+        """
+        for sp in spaces:
+            cont = sp.index(is_get).get(iidx)
+            if cont is not None:
+                return cont
+        return None
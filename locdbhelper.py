@@ -1,22 +1,359 @@
+import bisect
+import heapq
+import itertools
 import json
 import logging
-import sqlite3
+import math
+import random
+import re
+import threading
+from dbpool import open_db
+
+def parse_price(value):
+    """
+    Returns:
+        Leading integer of a pricerange value ("150", "100-200", "~300"), or None.
+    """
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    res = re.search('[0-9]+', str(value))
+    return int(res.group(0)) if res else None
+
+def row_tags(row):
+    """
+    Returns:
+        List of distinct lower-cased tags of a restaurant row, from either the
+        free-text `tags` column or the `tag1`..`tag3` columns.
+    """
+    keys = row.keys()
+    if 'tags' in keys:
+        raw = [row['tags']]
+    else:
+        raw = [row[k] for k in ('tag1', 'tag2', 'tag3') if k in keys]
+
+    tags = []
+    for r in raw:
+        if r:
+            tags += [t.strip().lower() for t in re.split('[,，、/\\s]+', str(r)) if t.strip()]
+    return list(dict.fromkeys(tags))
+
+def haversine(lat1, lng1, lat2, lng2):
+    """
+    Returns:
+        Great-circle distance between two coordinates in meters.
+    """
+    p1 = math.radians(lat1)
+    p2 = math.radians(lat2)
+    dp = p2 - p1
+    dl = math.radians(lng2 - lng1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * 6371000 * math.asin(math.sqrt(a))
 
 class locDBHelper:
     """
     This object handles direct database access.
     """
 
+    # Cell size of the spatial grid in degrees (about 1.1km of latitude).
+    GRID_DEG = 0.01
+    # Rings of cells walked by get_nearby before it scans all rows instead.
+    MAX_RINGS = 64
+
     def __init__(self,
-                 dbname = "loc_db.sqlite"):
+                 dbname = "loc_db.sqlite",
+                 weight_by = None):
+        """
+        Arguments:
+            dbname (str):
+                Path of the restaurant database.
+            weight_by (Optional[str or list]):
+                Bias of weighted picks: 'pricerange' favors cheaper places,
+                a list of tags favors places carrying any of them.
+        """
         self.dbname = dbname
-        self.conn = sqlite3.connect(dbname)
-        self.conn.row_factory = sqlite3.Row
-        self.cur = self.conn.cursor()
+        self.db = open_db(dbname)
         self.logger = logging.getLogger("locDBHelper")
+        # Held by pool changes and the picks reading the pool and its indexes.
+        self.lock = threading.RLock()
+        # A single tag is a one-tag list, not a string to iterate.
+        if isinstance(weight_by, str) and weight_by != 'pricerange':
+            weight_by = [weight_by]
+        self.weight_by = weight_by
 
         if not self.dbname:
-            setup()
+            self.setup()
+
+        self.load_pool()
+
+    def load_pool(self):
+        """
+        Load all restaurant rows into memory so picks never hit the database.
+        """
+        with self.lock:
+            self.pool = []
+            self.slots = dict()
+            self.cum_weights = None
+            # (cell_lat, cell_lng) -> set of names located in that cell, their
+            # count and the bounding box of cells ever used (never shrunk)
+            self.grid = dict()
+            self.indexed = 0
+            self.grid_box = None
+            # tag -> set of names, and (price, name) sorted by price
+            self.tag_index = dict()
+            self.price_index = []
+
+            with self.db.reader() as conn:
+                for row in conn.execute("SELECT rowid AS rid, * FROM restaurants"):
+                    self._pool_add(row, False)
+            # Sorted once here rather than insorted per row.
+            self.price_index.sort()
+
+            self.logger.debug("{0} restaurants loaded.".format(len(self.pool)))
+
+    def _pool_add(self, row, keep_sorted = True):
+        self.slots[row['name']] = len(self.pool)
+        self.pool.append(row)
+        self.cum_weights = None
+
+        cell = self._cell_of(row)
+        if cell:
+            self.grid.setdefault(cell, set()).add(row['name'])
+            self.indexed += 1
+            if self.grid_box is None:
+                self.grid_box = (cell[0], cell[1], cell[0], cell[1])
+            else:
+                x0, y0, x1, y1 = self.grid_box
+                self.grid_box = (min(x0, cell[0]), min(y0, cell[1]), max(x1, cell[0]), max(y1, cell[1]))
+
+        for t in row_tags(row):
+            self.tag_index.setdefault(t, set()).add(row['name'])
+
+        price = parse_price(row['pricerange'])
+        if price is not None:
+            if keep_sorted:
+                bisect.insort(self.price_index, (price, row['name']))
+            else:
+                self.price_index.append((price, row['name']))
+
+    def _pool_remove(self, name):
+        i = self.slots.pop(name, None)
+        if i is None:
+            return None
+
+        row = self.pool[i]
+        last = self.pool.pop()
+        if i < len(self.pool):
+            self.pool[i] = last
+            self.slots[last['name']] = i
+        self.cum_weights = None
+
+        cell = self._cell_of(row)
+        if cell:
+            self.grid[cell].discard(name)
+            self.indexed -= 1
+            if not self.grid[cell]:
+                del self.grid[cell]
+
+        for t in row_tags(row):
+            names = self.tag_index.get(t)
+            if names is None:
+                continue
+            names.discard(name)
+            if not names:
+                del self.tag_index[t]
+
+        price = parse_price(row['pricerange'])
+        if price is not None:
+            i = bisect.bisect_left(self.price_index, (price, name))
+            if i < len(self.price_index) and self.price_index[i] == (price, name):
+                del self.price_index[i]
+        return row
+
+    def _cell_of(self, row):
+        try:
+            lat = float(row['latitude'])
+            lng = float(row['longitude'])
+        except (TypeError, ValueError):
+            return None
+        return (math.floor(lat / self.GRID_DEG), math.floor(lng / self.GRID_DEG))
+
+    def _ring(self, cell, r):
+        """Yield grid cells at Chebyshev distance r from cell."""
+        cx, cy = cell
+        if r == 0:
+            yield cell
+            return
+        for dx in range(-r, r + 1):
+            yield (cx + dx, cy - r)
+            yield (cx + dx, cy + r)
+        for dy in range(-r + 1, r):
+            yield (cx - r, cy + dy)
+            yield (cx + r, cy + dy)
+
+    def get_nearby(self,
+                   lat,
+                   lng,
+                   k = None,
+                   radius = None):
+        """
+        Look up restaurants around a coordinate through the spatial grid.
+
+        Rings of cells are walked outwards, up to the farthest cell holding
+        a restaurant. When that (or radius) is more than MAX_RINGS away,
+        e.g. for a coordinate far from every restaurant, all rows are
+        scanned instead.
+
+        Arguments:
+            lat, lng (float):
+                Coordinate to search around.
+            k (Optional[int]):
+                Return at most the k nearest restaurants.
+            radius (Optional[float]):
+                Only return restaurants within radius meters.
+
+        Returns:
+            List of (distance in meters, row), nearest first.
+        """
+        with self.lock:
+            cell = (math.floor(lat / self.GRID_DEG), math.floor(lng / self.GRID_DEG))
+            # Shortest distance covered by one ring of cells, to know when to stop.
+            ring_m = self.GRID_DEG * 111320 * max(math.cos(math.radians(abs(lat) + self.GRID_DEG)), 0.01)
+            if not self.grid_box:
+                return []
+
+            x0, y0, x1, y1 = self.grid_box
+            reach = max(abs(cell[0] - x0), abs(cell[0] - x1), abs(cell[1] - y0), abs(cell[1] - y1))
+            if radius is not None:
+                reach = min(reach, int(radius / ring_m) + 2)
+            if reach > self.MAX_RINGS:
+                return self._scan_nearby(lat, lng, k, radius)
+
+            found = []
+            seen = 0
+            r = 0
+            while seen < self.indexed and r <= reach:
+                # Every cell beyond this ring is at least r * ring_m away.
+                bound = max(r - 1, 0) * ring_m
+                if radius is not None and bound > radius:
+                    break
+                if k and len(found) >= k:
+                    found.sort(key = lambda x: x[0])
+                    if found[k - 1][0] <= bound:
+                        break
+
+                for c in self._ring(cell, r):
+                    for name in self.grid.get(c, ()):
+                        row = self.pool[self.slots[name]]
+                        seen += 1
+                        d = haversine(lat, lng, float(row['latitude']), float(row['longitude']))
+                        if radius is None or d <= radius:
+                            found.append((d, row))
+                r += 1
+
+            found.sort(key = lambda x: x[0])
+            return found[:k] if k else found
+
+    def _scan_nearby(self,
+                     lat,
+                     lng,
+                     k = None,
+                     radius = None):
+        found = []
+        for row in self.pool:
+            if self._cell_of(row) is None:
+                continue
+            d = haversine(lat, lng, float(row['latitude']), float(row['longitude']))
+            if radius is None or d <= radius:
+                found.append((d, row))
+        if k:
+            return heapq.nsmallest(k, found, key = lambda x: x[0])
+        found.sort(key = lambda x: x[0])
+        return found
+
+    def get_nearby_choice(self,
+                          lat,
+                          lng,
+                          k = None,
+                          radius = None):
+        """
+        Returns:
+            (distance in meters, row) picked at random among get_nearby(), or None.
+        """
+        found = self.get_nearby(lat, lng, k, radius)
+        if not found:
+            return None
+        return random.choice(found)
+
+    def weight_of(self,
+                  row):
+        """
+        Returns:
+            Weight of row in weighted picks.
+        """
+        if self.weight_by == 'pricerange':
+            price = parse_price(row['pricerange'])
+            return 100.0 / (100 + price) if price is not None else 0.5
+        elif self.weight_by:
+            favored = [t.lower() for t in self.weight_by]
+            return 4.0 if any(t in favored for t in row_tags(row)) else 1.0
+        return 1.0
+
+    def has_tag(self,
+                tag):
+        """
+        Returns:
+            True when any restaurant carries tag.
+        """
+        return tag.lower() in self.tag_index
+
+    def get_filtered_choice(self,
+                            tags = None,
+                            price_min = None,
+                            price_max = None):
+        """
+        Pick a restaurant carrying all given tags within a price range.
+
+        Arguments:
+            tags (Optional[list of str]):
+                Tags that must all be present.
+            price_min, price_max (Optional[int]):
+                Inclusive bounds on the parsed pricerange.
+
+        Returns:
+            A randomly selected matching row, or None.
+        """
+        with self.lock:
+            lo = bisect.bisect_left(self.price_index, (price_min, '')) if price_min is not None else 0
+            hi = bisect.bisect_right(self.price_index, (price_max, '\U0010ffff')) if price_max is not None else len(self.price_index)
+            has_price = price_min is not None or price_max is not None
+
+            if not tags:
+                if not has_price:
+                    return self.get_choice()
+                if lo >= hi:
+                    return None
+                return self.pool[self.slots[self.price_index[random.randrange(lo, hi)][1]]]
+
+            sets = sorted((self.tag_index.get(t.lower(), set()) for t in tags), key = len)
+            names = set(sets[0])
+            for other in sets[1:]:
+                names &= other
+                if not names:
+                    return None
+
+            if has_price:
+                names = [n for n in names if self._price_in(n, price_min, price_max)]
+            if not names:
+                return None
+            return self.pool[self.slots[random.choice(list(names))]]
+
+    def _price_in(self, name, price_min, price_max):
+        price = parse_price(self.pool[self.slots[name]]['pricerange'])
+        if price is None:
+            return False
+        return (price_min is None or price >= price_min) and (price_max is None or price <= price_max)
 
     # It's always important to set the table before we have something
     def setup(self):
@@ -32,8 +369,7 @@ class locDBHelper:
                                                             latitude REAL, \
                                                             longitude REAL, \
                                                             others TEXT)"
-            self.conn.execute(cmmd)
-            self.conn.commit()
+            self.db.execute(cmmd)
         except:
             self.logger.exception("Failed to create table or table already exists.")
 
@@ -49,11 +385,14 @@ class locDBHelper:
                  tag = None,
                  oths = None):
         try:
-            cmmd = "INSERT INTO restaurants (name, pricerange, mincharge, address, optime, latitude, longitude, tag, oths) \
+            cmmd = "INSERT INTO restaurants (name, pricerange, mincharge, address, optime, latitude, longitude, tags, others) \
                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
             args = (rname, prange, mch, addr, opt, lat, lng, tag, oths)
-            self.cur.execute(cmmd, args)
-            self.conn.commit()
+            with self.db.writer() as conn:
+                rid = conn.execute(cmmd, args).lastrowid
+                row = conn.execute("SELECT rowid AS rid, * FROM restaurants WHERE rowid = ?", (rid, )).fetchone()
+            with self.lock:
+                self._pool_add(row)
             return True
         except:
             return False
@@ -61,22 +400,33 @@ class locDBHelper:
     def remove_item(self, name):
         cmmd = "DELETE FROM restaurants WHERE name = (?)"
         args = (name, )
-        self.cur.execute(cmmd, args)
-        self.conn.commit()
+        self.db.execute(cmmd, args)
+        with self.lock:
+            self._pool_remove(name)
 
     # Main function that fetches a choice randomly
-    def get_choice(self):
+    def get_choice(self,
+                   weighted = False):
         """
+        Arguments:
+            weighted (bool):
+                Bias the pick by self.weight_by instead of a uniform pick.
+
         Returns:
             Dict() of a randomly selected choice.
 
         """
-        try:
-            cmmd = "SELECT * FROM restaurants ORDER BY RANDOM() LIMIT 1"
-            c = self.cur
-            c.execute(cmmd)
-            row = c.fetchone()
-            return row
+        with self.lock:
+            try:
+                if not self.pool:
+                    return None
 
-        except:
-            self.logger.exception("Failed to make a decision D:")
+                if weighted and self.weight_by:
+                    if self.cum_weights is None:
+                        self.cum_weights = list(itertools.accumulate(self.weight_of(r) for r in self.pool))
+                    return random.choices(self.pool, cum_weights = self.cum_weights)[0]
+
+                return self.pool[random.randrange(len(self.pool))]
+
+            except:
+                self.logger.exception("Failed to make a decision D:")
@@ -0,0 +1,124 @@
+import json
+import logging
+import logging.handlers
+import queue
+import random
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Structured fields picked from a record's `extra`, when present.
+FIELDS = ('update_id', 'chat_id', 'route', 'latency_ms')
+
+class JsonFormatter(logging.Formatter):
+    """
+    This object formats records as one compact JSON object per line.
+    """
+
+    def format(self,
+               record):
+        out = {'ts': round(record.created, 3),
+               'level': record.levelname,
+               'logger': record.name,
+               'msg': record.getMessage()}
+        for k in FIELDS:
+            v = getattr(record, k, None)
+            if v is not None:
+                out[k] = v
+        if record.exc_info:
+            out['exc'] = self.formatException(record.exc_info)
+        return json.dumps(out, ensure_ascii = False, default = str)
+
+class SampleFilter(logging.Filter):
+    """
+    This object keeps a `rate` fraction of records below WARNING, and every
+    record from WARNING up.
+    """
+
+    def __init__(self,
+                 rate = 1.0):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self,
+               record):
+        return record.levelno >= logging.WARNING or self.rate >= 1.0 or random.random() < self.rate
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    This object hands records to a bounded queue without blocking the logging
+    thread: records are formatted by the listener thread, and dropped (and
+    counted) when the queue is full.
+    """
+
+    def __init__(self,
+                 q):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self,
+                record):
+        # Same process, the listener formats the record as it is.
+        return record
+
+    def enqueue(self,
+                record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def setup_logging(logfile = None,
+                  level = 'INFO',
+                  json_format = False,
+                  sample_rate = 1.0,
+                  max_bytes = 10 * 1024 * 1024,
+                  backup_count = 5,
+                  queue_size = 10000):
+    """
+    Route the root logger through a queue to a stream or rotating file handler.
+
+    Arguments:
+        logfile (Optional[str]):
+            Path of the log file, rotated at max_bytes with backup_count
+            old files kept; stderr when not given.
+        json_format (bool):
+            Emit JSON lines (see JsonFormatter) instead of text.
+        sample_rate (float):
+            Fraction of records below WARNING kept.
+    Returns:
+        The started logging.handlers.QueueListener; stop() it to flush on exit.
+    """
+    if logfile:
+        target = logging.handlers.RotatingFileHandler(logfile, maxBytes = max_bytes,
+                                                      backupCount = backup_count, encoding = 'utf8')
+    else:
+        target = logging.StreamHandler()
+    target.setFormatter(JsonFormatter() if json_format else logging.Formatter(TEXT_FORMAT))
+
+    handler = DroppingQueueHandler(queue.Queue(queue_size))
+    handler.addFilter(SampleFilter(sample_rate))
+
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    root.addHandler(handler)
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+
+    listener = logging.handlers.QueueListener(handler.queue, target)
+    listener.start()
+    return listener
+
+def log_update(logger,
+               update_id,
+               chat_id,
+               route,
+               seconds):
+    """
+    Log one handled update with its structured fields, skipped entirely
+    unless INFO is enabled.
+    """
+    if not logger.isEnabledFor(logging.INFO):
+        return
+    latency_ms = round(seconds * 1000, 3)
+    logger.info('update %s chat %s route %s %sms', update_id, chat_id, route, latency_ms,
+                extra = {'update_id': update_id, 'chat_id': chat_id, 'route': route, 'latency_ms': latency_ms})
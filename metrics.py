@@ -0,0 +1,221 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class Histogram:
+    """
+    This object keeps the latest `size` samples of a latency in a ring,
+    plus the total count and sum since start.
+    """
+    __slots__ = ('samples', 'size', 'pos', 'count', 'sum')
+
+    def __init__(self,
+                 size = 1024):
+        self.samples = []
+        self.size = size
+        self.pos = 0
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        if len(self.samples) < self.size:
+            self.samples.append(value)
+        else:
+            self.samples[self.pos] = value
+            self.pos = (self.pos + 1) % self.size
+        self.count += 1
+        self.sum += value
+
+    def quantiles(self, qs = (0.5, 0.95, 0.99)):
+        """
+        Returns:
+            List of the given quantiles over the kept samples.
+        """
+        s = sorted(self.samples)
+        if not s:
+            return [0.0 for q in qs]
+        return [s[min(int(q * len(s)), len(s) - 1)] for q in qs]
+
+class Metrics:
+    """
+    This object collects stage and route latencies, counters and queue depths.
+
+    Latencies are histograms keyed by (stage, route); gauges are callables
+    read when the metrics are rendered.
+    """
+
+    QUANTILES = (0.5, 0.95, 0.99)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = dict()
+        self.counters = dict()
+        self.gauges = dict()
+        self.started = time.time()
+
+    def observe(self,
+                stage,
+                seconds,
+                route = None):
+        """
+        Record a latency sample of stage (for route, when given).
+        """
+        key = (stage, route)
+        with self.lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = Histogram()
+            h.observe(seconds)
+
+    @contextmanager
+    def timer(self,
+              stage,
+              route = None):
+        """
+        Time the enclosed block as a sample of stage.
+        """
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - t, route)
+
+    def timed(self,
+              stage,
+              func,
+              *args,
+              **kwargs):
+        """
+        Call func(*args, **kwargs), timed as a sample of stage.
+
+        Returns:
+            What func returns.
+        """
+        with self.timer(stage):
+            return func(*args, **kwargs)
+
+    def inc(self,
+            name,
+            n = 1):
+        """
+        Increase counter name by n.
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self,
+              name,
+              func):
+        """
+        Register func() as the current value of gauge name.
+        """
+        self.gauges[name] = func
+
+    def snapshot(self):
+        """
+        Returns:
+            (histograms as {(stage, route): (count, sum, quantiles)}, counters, gauges)
+        """
+        with self.lock:
+            hists = {k: (h.count, h.sum, h.quantiles(self.QUANTILES)) for k, h in self.histograms.items()}
+            counters = dict(self.counters)
+
+        gauges = dict()
+        for name, func in self.gauges.items():
+            try:
+                gauges[name] = func()
+            except Exception:
+                gauges[name] = float('nan')
+        return hists, counters, gauges
+
+    @staticmethod
+    def _label(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def render_prometheus(self):
+        """
+        Returns:
+            Metrics in Prometheus text exposition format.
+        """
+        hists, counters, gauges = self.snapshot()
+        lines = ['# TYPE eatsnake_stage_seconds summary']
+        for (stage, route), (count, total, qv) in sorted(hists.items(), key = lambda x: (x[0][0], str(x[0][1]))):
+            labels = 'stage="{0}"'.format(self._label(stage))
+            if route is not None:
+                labels += ',route="{0}"'.format(self._label(route))
+            for q, v in zip(self.QUANTILES, qv):
+                lines.append('eatsnake_stage_seconds{{{0},quantile="{1}"}} {2:.6f}'.format(labels, q, v))
+            lines.append('eatsnake_stage_seconds_count{{{0}}} {1}'.format(labels, count))
+            lines.append('eatsnake_stage_seconds_sum{{{0}}} {1:.6f}'.format(labels, total))
+
+        for name, value in sorted(counters.items()):
+            lines.append('# TYPE eatsnake_{0}_total counter'.format(name))
+            lines.append('eatsnake_{0}_total {1}'.format(name, value))
+
+        for name, value in sorted(gauges.items()):
+            lines.append('# TYPE eatsnake_{0} gauge'.format(name))
+            lines.append('eatsnake_{0} {1}'.format(name, value))
+
+        lines.append('eatsnake_uptime_seconds {0:.0f}'.format(time.time() - self.started))
+        return '\n'.join(lines) + '\n'
+
+    def render_text(self):
+        """
+        Returns:
+            Short human-readable summary for chat, latencies in milliseconds.
+        """
+        hists, counters, gauges = self.snapshot()
+        lines = ['uptime: {0:.0f}s'.format(time.time() - self.started)]
+        lines += ['{0}: {1}'.format(k, v) for k, v in sorted(counters.items())]
+        lines += ['{0}: {1}'.format(k, v) for k, v in sorted(gauges.items())]
+        for (stage, route), (count, total, qv) in sorted(hists.items(), key = lambda x: (x[0][0], str(x[0][1]))):
+            name = stage if route is None else '{0}[{1}]'.format(stage, route)
+            lines.append('{0}: n={1} p50={2:.1f} p95={3:.1f} p99={4:.1f}'.format(name, count, *[v * 1000 for v in qv]))
+        return '\n'.join(lines)
+
+class MetricsServer:
+    """
+    This object serves Metrics.render_prometheus() on http://listen:port/metrics.
+    """
+
+    def __init__(self,
+                 metrics,
+                 listen = '127.0.0.1',
+                 port = 9464):
+        self.metrics = metrics
+        self.logger = logging.getLogger("MetricsServer")
+        server = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+
+                body = server.metrics.render_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                server.logger.debug(format % args)
+
+        self.httpd = ThreadingHTTPServer((listen, port), MetricsHandler)
+        self.httpd.daemon_threads = True
+
+    def start(self):
+        """
+        Serve in a background thread.
+        """
+        t = threading.Thread(target = self.httpd.serve_forever, name = 'MetricsServer', daemon = True)
+        t.start()
+        self.logger.info('metrics on {0}:{1}'.format(*self.httpd.server_address))
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,94 @@
+import logging
+
+class SchemaVersionError(Exception):
+    """
+    The database was written by a newer schema than this code knows.
+    """
+
+def has_table(conn,
+              name):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name, )).fetchone() is not None
+
+def columns_of(conn,
+               table):
+    return [row[1] for row in conn.execute('PRAGMA table_info({0})'.format(table))]
+
+def resp_v1(conn):
+    """
+    Normalize types: gid as INTEGER (-1 for none and private chats), empty tags as NULL.
+    """
+    for table in ('resp', 'resp_get', 'symptom', 'symptom_get'):
+        if not has_table(conn, table):
+            continue
+        # Whole numbers stored as text or real, e.g. '-100' or -100.0.
+        conn.execute('''UPDATE {0} SET gid = CAST(gid AS INTEGER)
+                         WHERE typeof(gid) IN ('text', 'real') AND TRIM(gid) GLOB '*[0-9]*'
+                           AND CAST(gid AS REAL) = CAST(CAST(gid AS INTEGER) AS REAL)'''.format(table))
+        conn.execute("UPDATE {0} SET gid = -1 WHERE typeof(gid) != 'integer' OR gid > 0".format(table))
+    if has_table(conn, 'resp_get'):
+        conn.execute("UPDATE resp_get SET tag = NULL WHERE TRIM(tag) = ''")
+
+def resp_v2(conn):
+    """
+    Index the columns handlers look rows up by.
+    """
+    for table, name, cols in (('resp', 'resp_keyword', 'keyword'),
+                              ('resp_get', 'resp_get_keyword_tag', 'keyword, tag'),
+                              ('symptom', 'symptom_before', 'before'),
+                              ('symptom_get', 'symptom_get_before', 'before')):
+        if has_table(conn, table):
+            conn.execute('CREATE INDEX IF NOT EXISTS {0} ON {1} ({2})'.format(name, table, cols))
+
+def loc_v1(conn):
+    """
+    Normalize types: coordinates as REAL, empty coordinates and tags as NULL.
+
+    Tags are either a free-text `tags` column or `tag1`..`tag3` (as in
+    loc_db_example.sqlite), only the columns present are touched.
+    """
+    if not has_table(conn, 'restaurants'):
+        return
+    cols = columns_of(conn, 'restaurants')
+    for col in ('latitude', 'longitude'):
+        if col in cols:
+            conn.execute("UPDATE restaurants SET {0} = NULL WHERE TRIM({0}) = ''".format(col))
+            conn.execute("UPDATE restaurants SET {0} = CAST({0} AS REAL) WHERE typeof({0}) IN ('text', 'integer')".format(col))
+    for col in ('tags', 'tag1', 'tag2', 'tag3'):
+        if col in cols:
+            conn.execute("UPDATE restaurants SET {0} = NULL WHERE TRIM({0}) = ''".format(col))
+
+# Migration i brings a database from user_version i to i + 1.
+RESP_MIGRATIONS = [resp_v1, resp_v2]
+LOC_MIGRATIONS = [loc_v1]
+
+def migrate(db,
+            migrations):
+    """
+    Bring db to the latest schema version, tracked by PRAGMA user_version.
+
+    Each pending migration runs in its own transaction together with its
+    version bump, so an interrupted run resumes from the last one applied.
+
+    Arguments:
+        db (DBPool):
+            Database to migrate.
+        migrations (list of func(conn)):
+            RESP_MIGRATIONS or LOC_MIGRATIONS.
+    Returns:
+        Schema version of db.
+    Raises:
+        SchemaVersionError: when db is newer than the last migration.
+    """
+    logger = logging.getLogger("migrate")
+    with db.writer() as conn:
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if version > len(migrations):
+        raise SchemaVersionError('{0}: schema version {1} is newer than {2}, refusing to start'.format(
+            db.dbname, version, len(migrations)))
+
+    for v in range(version, len(migrations)):
+        with db.writer() as conn:
+            migrations[v](conn)
+            conn.execute('PRAGMA user_version = {0}'.format(v + 1))
+        logger.info('{0}: migrated to schema version {1} ({2})'.format(db.dbname, v + 1, migrations[v].__name__))
+    return len(migrations)
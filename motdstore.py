@@ -0,0 +1,227 @@
+import json
+import logging
+import threading
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+
+class MotdStore:
+    """
+    This object keeps the MOTDs of each chat in SQLite, written behind.
+
+    The latest MOTD of a chat is in `motd`, every MOTD ever set in
+    `motd_history`, indexed on (chat_id, date) for date and range lookups.
+
+    set() only updates memory and marks the chat dirty; a background thread
+    writes pending MOTDs in one transaction every `flush_interval` seconds,
+    so a crash loses at most the last interval. The latest MOTDs are read on
+    first use and kept in an LRU of `cache_size` chats, so the common /motd
+    query of an active chat never touches disk.
+    """
+
+    def __init__(self,
+                 db,
+                 flush_interval = 5.0,
+                 legacy_json = None,
+                 cache_size = 1024):
+        """
+        Arguments:
+            db (DBPool):
+                Database holding the MOTD tables, e.g. open_db('motd.sqlite');
+                left open by close(), it may be shared.
+            legacy_json (Optional[str]):
+                motd.json of older versions, imported when the table is empty.
+        """
+        self.db = db
+        self.dbname = db.dbname
+        self.flush_interval = flush_interval
+        self.logger = logging.getLogger("MotdStore")
+
+        with self.db.writer() as conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS motd (chat_id INTEGER PRIMARY KEY,
+                                                            date TEXT NOT NULL,
+                                                            msg TEXT NOT NULL)''')
+            conn.execute('''CREATE TABLE IF NOT EXISTS motd_history (IIDX INTEGER PRIMARY KEY,
+                                                                    chat_id INTEGER NOT NULL,
+                                                                    date TEXT NOT NULL,
+                                                                    msg TEXT NOT NULL)''')
+            conn.execute('CREATE INDEX IF NOT EXISTS motd_history_chat_date ON motd_history (chat_id, date)')
+            # Databases from before the history: start it with the latest MOTDs.
+            if not conn.execute('SELECT 1 FROM motd_history LIMIT 1').fetchone():
+                conn.execute('INSERT INTO motd_history (chat_id, date, msg) SELECT chat_id, date, msg FROM motd')
+
+        # LRU of chat_id -> (date, msg), or None for chats known to have no MOTD.
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        # chat_id -> (date, msg) and [(chat_id, date, msg)] not written yet.
+        self.dirty = dict()
+        self.pending_history = []
+        self.lock = threading.Lock()
+        # Serializes flushes with history reads, which merge pending entries.
+        self.flush_lock = threading.Lock()
+
+        if legacy_json:
+            self.import_json(legacy_json)
+
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target = self.run, name = 'MotdStore', daemon = True)
+        self.thread.start()
+
+    def import_json(self,
+                    file_name):
+        """
+        Import MOTDs from a motd.json file if the table is still empty.
+
+        Returns:
+            Number of MOTDs imported.
+        """
+        if self.db.fetchone('SELECT 1 FROM motd LIMIT 1'):
+            return 0
+
+        try:
+            with open(file_name, 'r', encoding = 'utf8') as f:
+                motds = json.loads(f.read())
+        except FileNotFoundError:
+            return 0
+        except ValueError:
+            self.logger.exception('MOTD read error!')
+            return 0
+
+        rows = [(int(k), v['date'], v['msg']) for k, v in motds.items()]
+        with self.db.writer() as conn:
+            conn.executemany('INSERT OR REPLACE INTO motd (chat_id, date, msg) VALUES (?, ?, ?)', rows)
+            conn.executemany('INSERT INTO motd_history (chat_id, date, msg) VALUES (?, ?, ?)', rows)
+        self.logger.info('{0} MOTDs imported from {1}'.format(len(rows), file_name))
+        return len(rows)
+
+    def get(self,
+            chat_id):
+        """
+        Returns:
+            (date, msg) of the latest MOTD of chat_id, or None.
+        """
+        with self.lock:
+            if chat_id in self.dirty:
+                return self.dirty[chat_id]
+            if chat_id in self.cache:
+                self.cache.move_to_end(chat_id)
+                return self.cache[chat_id]
+
+        row = self.db.fetchone('SELECT date, msg FROM motd WHERE chat_id = ?', (chat_id, ))
+        entry = (self.parse_date(row[0]), row[1]) if row else None
+
+        with self.lock:
+            # A set() may have raced with the read, it wins.
+            if chat_id in self.dirty:
+                return self.dirty[chat_id]
+            self._cache_put(chat_id, entry)
+            return entry
+
+    def get_on(self,
+               chat_id,
+               day):
+        """
+        Returns:
+            (date, msg) of the last MOTD chat_id set on day, or None.
+        """
+        found = self.history_between(chat_id, day, day)
+        return found[-1] if found else None
+
+    def history(self,
+                chat_id,
+                days):
+        """
+        Returns:
+            List of (date, msg) set by chat_id within the last `days` days, oldest first.
+        """
+        today = date.today()
+        return self.history_between(chat_id, today - timedelta(days = days - 1), today)
+
+    def history_between(self,
+                        chat_id,
+                        first,
+                        last):
+        """
+        Returns:
+            List of (date, msg) set by chat_id from first to last (dates,
+            inclusive), oldest first; a range scan on (chat_id, date).
+        """
+        with self.flush_lock:
+            rows = self.db.fetchall('''SELECT date, msg FROM motd_history
+                                        WHERE chat_id = ? AND date BETWEEN ? AND ?
+                                        ORDER BY date, IIDX''',
+                                    (chat_id, first.strftime('%Y-%m-%d'), last.strftime('%Y-%m-%d')))
+            # Under flush_lock too, so a flush cannot move entries in between.
+            with self.lock:
+                pending = [(d, m) for c, d, m in self.pending_history if c == chat_id and first <= d <= last]
+
+        found = [(self.parse_date(r[0]), r[1]) for r in rows] + pending
+        # Pending ones are the newest, a stable sort keeps them last within a day.
+        found.sort(key = lambda x: x[0])
+        return found
+
+    @staticmethod
+    def parse_date(value):
+        return datetime.strptime(value, '%Y-%m-%d').date()
+
+    def _cache_put(self, chat_id, entry):
+        self.cache[chat_id] = entry
+        self.cache.move_to_end(chat_id)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last = False)
+
+    def set(self,
+            chat_id,
+            msg,
+            day = None):
+        """
+        Set the MOTD of chat_id, written to disk by the next flush.
+        """
+        entry = (day or date.today(), msg)
+        with self.lock:
+            self._cache_put(chat_id, entry)
+            self.dirty[chat_id] = entry
+            self.pending_history.append((chat_id, entry[0], msg))
+
+    def flush(self):
+        """
+        Write pending MOTDs in one transaction.
+
+        Returns:
+            Number of MOTDs written.
+        """
+        with self.flush_lock:
+            with self.lock:
+                if not self.dirty:
+                    return 0
+                dirty = dict(self.dirty)
+                history = list(self.pending_history)
+
+            rows = [(chat_id, day.strftime('%Y-%m-%d'), msg) for chat_id, (day, msg) in dirty.items()]
+            # Rolled back on errors, everything then stays pending for the next flush.
+            with self.db.writer() as conn:
+                conn.executemany('INSERT OR REPLACE INTO motd (chat_id, date, msg) VALUES (?, ?, ?)', rows)
+                conn.executemany('INSERT INTO motd_history (chat_id, date, msg) VALUES (?, ?, ?)',
+                                 [(chat_id, day.strftime('%Y-%m-%d'), msg) for chat_id, day, msg in history])
+
+            # Written: drop what was taken, keeping whatever was set meanwhile.
+            with self.lock:
+                for chat_id, entry in dirty.items():
+                    if self.dirty.get(chat_id) is entry:
+                        del self.dirty[chat_id]
+                del self.pending_history[:len(history)]
+        return len(rows)
+
+    def run(self):
+        while not self.stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                self.logger.exception('MOTD flush failed')
+
+    def close(self):
+        """
+        Stop the flush thread and write what is pending.
+        """
+        self.stopped.set()
+        self.thread.join()
+        self.flush()
@@ -0,0 +1,139 @@
+import random
+
+class RespIndex:
+    """
+    This object keeps keyword -> contents of a response table in memory.
+
+    Every keyword (and keyword + tag pair) owns a bucket of parallel arrays,
+    so picking a random content is a single random index and a removal by
+    IIDX is a swap with the bucket's last entry.
+    """
+
+    class Bucket:
+        """
+        Contents sharing one key, stored as parallel arrays.
+        """
+        __slots__ = ('iidxs', 'conts', 'slots')
+
+        def __init__(self):
+            self.iidxs = []
+            self.conts = []
+            self.slots = dict()
+
+        def add(self, iidx, cont):
+            self.slots[iidx] = len(self.iidxs)
+            self.iidxs.append(iidx)
+            self.conts.append(cont)
+
+        def remove(self, iidx):
+            i = self.slots.pop(iidx)
+            last = len(self.iidxs) - 1
+            if i != last:
+                self.iidxs[i] = self.iidxs[last]
+                self.conts[i] = self.conts[last]
+                self.slots[self.iidxs[i]] = i
+            self.iidxs.pop()
+            self.conts.pop()
+
+        def pick(self):
+            return self.conts[random.randrange(len(self.conts))]
+
+        def __len__(self):
+            return len(self.iidxs)
+
+    def __init__(self):
+        self.by_kw = dict()
+        self.by_tag = dict()
+        # IIDX -> (keyword, tag, cont)
+        self.rows = dict()
+
+    def add(self,
+            iidx,
+            keyword,
+            cont,
+            tag = None):
+        """
+        Add a row to the index.
+
+        Args:
+            iidx (int):
+                Row IIDX in the response table.
+            keyword (str):
+                Keyword of the row.
+            cont (str):
+                Content of the row.
+            tag (Optional[str]):
+                Tag of the row, for resp_get.
+        """
+        if iidx in self.rows:
+            self.remove(iidx)
+
+        self.rows[iidx] = (keyword, tag, cont)
+        self.by_kw.setdefault(keyword, self.Bucket()).add(iidx, cont)
+        if tag:
+            self.by_tag.setdefault((keyword, tag), self.Bucket()).add(iidx, cont)
+
+    def remove(self,
+               iidx):
+        """
+        Remove a row from the index.
+
+        Returns:
+            Keyword of the removed row, or None when iidx is unknown.
+        """
+        row = self.rows.pop(iidx, None)
+        if not row:
+            return None
+
+        keyword, tag, cont = row
+        self._remove_from(self.by_kw, keyword, iidx)
+        if tag:
+            self._remove_from(self.by_tag, (keyword, tag), iidx)
+        return keyword
+
+    @staticmethod
+    def _remove_from(buckets, key, iidx):
+        bucket = buckets[key]
+        bucket.remove(iidx)
+        if not bucket:
+            del buckets[key]
+
+    def pick(self,
+             keyword,
+             tag = None):
+        """
+        Returns:
+            A random content of keyword (restricted to tag when such contents exist),
+            or None when keyword has no content.
+        """
+        if tag:
+            bucket = self.by_tag.get((keyword, tag))
+            if bucket:
+                return bucket.pick()
+
+        bucket = self.by_kw.get(keyword)
+        if bucket:
+            return bucket.pick()
+        return None
+
+    def get(self,
+            iidx):
+        """
+        Returns:
+            Content of the row iidx, or None.
+        """
+        row = self.rows.get(iidx)
+        return row[2] if row else None
+
+    def keywords(self):
+        """
+        Returns:
+            List of keywords having at least one content.
+        """
+        return list(self.by_kw.keys())
+
+    def __contains__(self, keyword):
+        return keyword in self.by_kw
+
+    def __len__(self):
+        return len(self.rows)
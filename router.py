@@ -0,0 +1,126 @@
+class ParsedMessage:
+    """
+    This object holds a message text tokenized once for every handler.
+
+    Attributes:
+        text (str):
+            Original message text.
+        low (str):
+            Lower-cased text.
+        toks (list of str):
+            Non-empty tokens split by spaces.
+        cmd (str or None):
+            Lower-cased command of a message starting with '/', without the
+            '@botname' suffix or a '_argument' suffix (as in /getid_123).
+        cmd_arg (str or None):
+            The '_argument' suffix of the command, if any.
+        route (str or None):
+            Name of the route which handled the message, set by the router and handlers.
+    """
+    __slots__ = ('text', 'low', 'toks', 'cmd', 'cmd_arg', 'route')
+
+    def __init__(self,
+                 text):
+        self.text = text
+        self.low = text.lower()
+        self.toks = [x.strip() for x in text.split(' ') if x.strip()]
+        self.cmd = None
+        self.cmd_arg = None
+        self.route = None
+
+        if self.toks and self.toks[0].startswith('/'):
+            cmd = self.toks[0].lower().split('@', 1)[0]
+            if '_' in cmd:
+                cmd, self.cmd_arg = cmd.split('_', 1)
+            self.cmd = cmd
+
+class CallbackRouter:
+    """
+    This object picks the callback to run for a message in a single pass.
+
+    Callbacks with a 'q_kw' string are compiled into a prefix trie over their
+    keywords, so finding every keyword the message starts with costs the
+    length of the longest keyword. The first registered callback wins, as
+    with the sequential chain: condition callbacks registered before the best
+    keyword match are still checked in order.
+    """
+
+    # Trie node key marking the end of a keyword.
+    END = None
+
+    def __init__(self,
+                 callbacks,
+                 metrics = None):
+        """
+        Arguments:
+            callbacks (list of BotCallback):
+                Callbacks in priority order.
+            metrics (Optional[Metrics]):
+                Receives 'route' latencies of matching (handlers not included).
+        """
+        self.callbacks = callbacks
+        self.metrics = metrics
+        self.trie = dict()
+        self.conds = []
+
+        for i, bcb in enumerate(callbacks):
+            if 'q_kw' in bcb.strs.keys():
+                node = self.trie
+                for ch in bcb.strs['q_kw']:
+                    node = node.setdefault(ch, dict())
+                # Keep the earliest callback for duplicated keywords.
+                node.setdefault(self.END, i)
+            else:
+                self.conds.append((i, bcb))
+
+    def match_prefix(self,
+                     text):
+        """
+        Returns:
+            Index of the first registered callback whose keyword starts text, or None.
+        """
+        best = None
+        node = self.trie
+        for ch in text:
+            node = node.get(ch)
+            if node is None:
+                break
+            i = node.get(self.END)
+            if i is not None and (best is None or i < best):
+                best = i
+        return best
+
+    def match(self,
+              update,
+              parsed):
+        """
+        Returns:
+            The callback to run for update, or None.
+        """
+        best = self.match_prefix(parsed.text)
+        for i, bcb in self.conds:
+            if best is not None and i > best:
+                break
+            if bcb.cond_callback(update):
+                return bcb
+        return self.callbacks[best] if best is not None else None
+
+    def dispatch(self,
+                 update,
+                 parsed):
+        """
+        Run the matching callback.
+
+        Returns:
+            Name of the route which handled update, or None when nothing matched.
+        """
+        if self.metrics:
+            bcb = self.metrics.timed('route', self.match, update, parsed)
+        else:
+            bcb = self.match(update, parsed)
+        if not bcb:
+            return None
+
+        parsed.route = bcb.name
+        bcb.run(update, parsed)
+        return parsed.route
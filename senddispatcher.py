@@ -0,0 +1,231 @@
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+
+class TokenBucket:
+    """
+    This object is a token bucket refilled at `rate` tokens per second.
+    """
+    __slots__ = ('rate', 'capacity', 'tokens', 'stamp')
+
+    def __init__(self,
+                 rate,
+                 capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait_time(self, now):
+        """
+        Returns:
+            Seconds until a token is available, 0 when one is.
+        """
+        self.refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+class SendDispatcher:
+    """
+    This object sends outbound messages from a dedicated thread.
+
+    Handlers enqueue and return right away. Sending is limited by a token
+    bucket per chat and a global one, honors Telegram's retry_after on
+    flood errors, and merges consecutive short text replies to the same
+    chat (and the same replied message) into one message.
+
+    Attributes:
+        owner (object):
+            Object holding the telegram.Bot as `owner.bot`; looked up on every
+            send so a re-created Bot is picked up.
+    """
+
+    # Telegram's limit on a single text message.
+    MAX_TEXT_LEN = 4096
+    # Seconds between sweeps of idle chat buckets and expired blocks.
+    PRUNE_INTERVAL = 60.0
+
+    def __init__(self,
+                 owner,
+                 chat_rate = 1.0,
+                 chat_burst = 3,
+                 global_rate = 30.0,
+                 coalesce_len = 512,
+                 metrics = None):
+        """
+        Arguments:
+            metrics (Optional[Metrics]):
+                Receives 'send' latencies and 'replies'/'send_errors' counts.
+        """
+        self.owner = owner
+        self.metrics = metrics
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.coalesce_len = coalesce_len
+        self.logger = logging.getLogger("SendDispatcher")
+
+        # chat_id -> deque of jobs; chats with pending jobs only.
+        self.queues = OrderedDict()
+        self.buckets = dict()
+        # chat_id -> monotonic time before which the chat must not be sent to.
+        self.blocked_until = dict()
+        self.pruned = time.monotonic()
+        self.cond = threading.Condition()
+
+        self.thread = threading.Thread(target = self.run, name = 'SendDispatcher', daemon = True)
+        self.thread.start()
+
+    def send_message(self,
+                     chat_id,
+                     text,
+                     reply_to_message_id = None):
+        """
+        Enqueue a text message.
+        """
+        self._enqueue(chat_id, ('text', text, reply_to_message_id))
+
+    def call(self,
+             method,
+             **kwargs):
+        """
+        Enqueue any other Bot API call (e.g. 'sendPhoto'), kept in order with
+        the text messages of kwargs['chat_id'].
+
+        Args:
+            method (str):
+                Name of the telegram.Bot method to call.
+        """
+        self._enqueue(kwargs['chat_id'], ('call', method, kwargs))
+
+    def pending(self):
+        """
+        Returns:
+            Number of jobs waiting to be sent.
+        """
+        with self.cond:
+            return sum(len(q) for q in self.queues.values())
+
+    def _enqueue(self, chat_id, job):
+        with self.cond:
+            self.queues.setdefault(chat_id, deque()).append(job)
+            self.cond.notify()
+
+    def _next_job(self):
+        """
+        Returns:
+            (chat_id, job) ready to be sent, or (None, seconds to wait).
+        """
+        now = time.monotonic()
+        if now - self.pruned >= self.PRUNE_INTERVAL:
+            self._prune(now)
+
+        wait = self.global_bucket.wait_time(now)
+        if wait:
+            return None, wait
+
+        wait = None
+        for chat_id in list(self.queues.keys()):
+            blocked = self.blocked_until.get(chat_id, 0) - now
+            if blocked > 0:
+                wait = blocked if wait is None else min(wait, blocked)
+                continue
+
+            bucket = self.buckets.get(chat_id)
+            if not bucket:
+                bucket = self.buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            chat_wait = bucket.wait_time(now)
+            if chat_wait:
+                wait = chat_wait if wait is None else min(wait, chat_wait)
+                continue
+
+            # Round-robin: move the served chat to the back.
+            queue = self.queues.pop(chat_id)
+            job = self._coalesce(queue)
+            if queue:
+                self.queues[chat_id] = queue
+            bucket.take()
+            self.global_bucket.take()
+            return chat_id, job
+
+        return None, wait
+
+    def _prune(self, now):
+        """
+        Forget chats with nothing queued whose bucket has refilled (a new
+        bucket starts full, so nothing changes for them) and expired blocks.
+        """
+        for chat_id, bucket in list(self.buckets.items()):
+            if chat_id not in self.queues:
+                bucket.refill(now)
+                if bucket.tokens >= bucket.capacity:
+                    del self.buckets[chat_id]
+        for chat_id in [c for c, t in self.blocked_until.items() if t <= now]:
+            del self.blocked_until[chat_id]
+        self.pruned = now
+
+    def _coalesce(self, queue):
+        job = queue.popleft()
+        if job[0] != 'text' or len(job[1]) > self.coalesce_len:
+            return job
+
+        texts = [job[1]]
+        length = len(job[1])
+        while queue:
+            nxt = queue[0]
+            if nxt[0] != 'text' or nxt[2] != job[2] or len(nxt[1]) > self.coalesce_len \
+               or length + 1 + len(nxt[1]) > self.MAX_TEXT_LEN:
+                break
+            queue.popleft()
+            texts.append(nxt[1])
+            length += 1 + len(nxt[1])
+
+        return ('text', '\n'.join(texts), job[2])
+
+    def _requeue(self, chat_id, job):
+        with self.cond:
+            queue = self.queues.pop(chat_id, deque())
+            queue.appendleft(job)
+            self.queues[chat_id] = queue
+
+    def _send(self, chat_id, job):
+        bot = self.owner.bot
+        if job[0] == 'text':
+            bot.sendMessage(chat_id = chat_id, text = job[1], reply_to_message_id = job[2])
+        else:
+            getattr(bot, job[1])(**job[2])
+
+    def run(self):
+        while True:
+            with self.cond:
+                chat_id, job = self._next_job()
+                while chat_id is None:
+                    self.cond.wait(job)
+                    chat_id, job = self._next_job()
+
+            t = time.perf_counter()
+            try:
+                self._send(chat_id, job)
+                if self.metrics:
+                    self.metrics.observe('send', time.perf_counter() - t)
+                    self.metrics.inc('replies')
+            except Exception as ex:
+                if self.metrics:
+                    self.metrics.inc('send_errors')
+                retry_after = getattr(ex, 'retry_after', None)
+                if retry_after:
+                    # Flood control: hold this chat back and retry the same job.
+                    self.logger.warning('flood control on {0}, retry after {1}s'.format(chat_id, retry_after))
+                    self.blocked_until[chat_id] = time.monotonic() + retry_after
+                    self._requeue(chat_id, job)
+                else:
+                    self.logger.exception('Failed to send to {0}'.format(chat_id))
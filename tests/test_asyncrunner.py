@@ -0,0 +1,115 @@
+import threading
+import unittest
+from types import SimpleNamespace
+
+from asyncrunner import AsyncUpdateRunner
+
+def make_update(update_id,
+                chat_id):
+    return SimpleNamespace(update_id = update_id,
+                           message = SimpleNamespace(chat_id = chat_id),
+                           edited_message = None)
+
+class FakeServer:
+    """
+    Serves getUpdates like Telegram: a fetch with an offset confirms (drops)
+    every update before it. Stops the runner once it has nothing left.
+    """
+
+    def __init__(self,
+                 updates,
+                 batch = 5):
+        self.updates = list(updates)
+        self.batch = batch
+        self.offsets = []
+        self.runner = None
+        self.lock = threading.Lock()
+
+    def getUpdates(self,
+                   offset = None,
+                   timeout = None):
+        with self.lock:
+            self.offsets.append(offset)
+            if offset is not None:
+                self.updates = [u for u in self.updates if u.update_id >= offset]
+            if not self.updates:
+                self.runner.stop()
+            return self.updates[:self.batch]
+
+    def confirmed(self):
+        with self.lock:
+            return max([o for o in self.offsets if o is not None] or [0])
+
+class FakeBot:
+
+    def __init__(self,
+                 server):
+        self.bot = server
+        self.LAST_UPDATE_ID = None
+        self.handled = []
+        self.confirmed_at = dict()
+        self.lock = threading.Lock()
+
+    def get_latest_update_id(self):
+        pass
+
+    def handle_update(self,
+                      update):
+        with self.lock:
+            self.confirmed_at[update.update_id] = self.bot.confirmed()
+            self.handled.append((update.message.chat_id, update.update_id))
+
+class AsyncUpdateRunnerTest(unittest.TestCase):
+
+    def run_updates(self,
+                    updates,
+                    batch = 5):
+        server = FakeServer(updates, batch)
+        bot = FakeBot(server)
+        runner = AsyncUpdateRunner(bot, workers = 4, timeout = 0)
+        server.runner = runner
+        runner.run()
+        return server, bot
+
+    def test_handles_every_update_in_chat_order(self):
+        updates = [make_update(i, -(i % 3)) for i in range(1, 31)]
+        server, bot = self.run_updates(updates)
+
+        self.assertEqual(sorted(i for c, i in bot.handled), list(range(1, 31)))
+        for chat in (0, -1, -2):
+            ids = [i for c, i in bot.handled if c == chat]
+            self.assertEqual(ids, sorted(ids))
+        self.assertEqual(bot.LAST_UPDATE_ID, 31)
+
+    def test_batch_confirmed_only_after_handling(self):
+        updates = [make_update(i, -i) for i in range(1, 13)]
+        server, bot = self.run_updates(updates, batch = 4)
+
+        # No fetch had confirmed an update before it was handled.
+        for update_id, confirmed in bot.confirmed_at.items():
+            self.assertLessEqual(confirmed, update_id)
+        self.assertEqual(server.offsets, [None, 5, 9, 13])
+
+    def test_fetch_error_retries_same_offset(self):
+        server = FakeServer([make_update(1, -1)])
+        bot = FakeBot(server)
+        runner = AsyncUpdateRunner(bot, workers = 1, timeout = 0)
+        server.runner = runner
+
+        get_updates = server.getUpdates
+        failures = [True]
+
+        def flaky(offset = None, timeout = None):
+            if failures:
+                failures.pop()
+                raise IOError('connection reset')
+            return get_updates(offset, timeout)
+
+        server.getUpdates = flaky
+        runner.run()
+
+        self.assertEqual(bot.handled, [(-1, 1)])
+        self.assertEqual(server.offsets, [None, 2])
+
+if __name__ == '__main__':
+    unittest.main()
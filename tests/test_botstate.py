@@ -0,0 +1,72 @@
+import threading
+import unittest
+
+from acl import ACL
+from botstate import BotState, pin_state, state_property, unpin_state
+
+class StatefulBot:
+    config = state_property('config')
+    strs = state_property('strs')
+    router = state_property('router')
+
+    def __init__(self,
+                 state):
+        self.state = state
+        self.pinned_state = threading.local()
+
+def make_state(n):
+    config = {'adm_ids': [n]}
+    return BotState(config, {'k': 's{0}'.format(n)}, ACL(config), {'router': 'r{0}'.format(n)})
+
+class BotStateTest(unittest.TestCase):
+
+    def test_immutable(self):
+        state = make_state(1)
+        with self.assertRaises(AttributeError):
+            state.config = {}
+        with self.assertRaises(TypeError):
+            state.config['adm_ids'] = []
+        with self.assertRaises(TypeError):
+            state.tables['router'] = None
+        self.assertEqual(state.router, 'r1')
+        with self.assertRaises(AttributeError):
+            state.adm_handlers
+
+    def test_replace_builds_new_state(self):
+        state = make_state(1)
+        other = state.replace(strs = {'k': 'x'})
+
+        self.assertEqual(state.strs['k'], 's1')
+        self.assertEqual(other.strs['k'], 'x')
+        self.assertIs(other.acl, state.acl)
+        self.assertEqual(other.router, 'r1')
+
+    def test_pinned_state_survives_swap(self):
+        bot = StatefulBot(make_state(1))
+        pinned = threading.Event()
+        swapped = threading.Event()
+        seen = []
+
+        def handle():
+            pin_state(bot)
+            try:
+                seen.append((bot.config['adm_ids'][0], bot.strs['k']))
+                pinned.set()
+                swapped.wait()
+                seen.append((bot.config['adm_ids'][0], bot.strs['k'], bot.router))
+            finally:
+                unpin_state(bot)
+            seen.append(bot.strs['k'])
+
+        t = threading.Thread(target = handle)
+        t.start()
+        pinned.wait()
+        bot.state = make_state(2)
+        self.assertEqual(bot.strs['k'], 's2')
+        swapped.set()
+        t.join()
+
+        self.assertEqual(seen, [(1, 's1'), (1, 's1', 'r1'), 's2'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import threading
+import unittest
+
+from kwmatcher import KeywordMatcher
+
+class KeywordMatcherTest(unittest.TestCase):
+
+    def test_find_all(self):
+        m = KeywordMatcher(['he', 'she', 'his', 'hers'])
+        self.assertEqual(m.find_all('ushers'), ['she', 'he', 'hers'])
+        self.assertEqual(m.find_all('nothing'), [])
+
+    def test_add_remove_reference_counted(self):
+        m = KeywordMatcher(['cat'])
+        m.add('cat')
+        m.add('dog')
+        self.assertEqual(m.find_all('cat dog'), ['cat', 'dog'])
+
+        m.remove('cat')
+        self.assertEqual(m.find_all('cat dog'), ['cat', 'dog'])
+        m.remove('cat')
+        self.assertEqual(m.find_all('cat dog'), ['dog'])
+        self.assertNotIn('cat', m)
+
+    def test_scans_while_keywords_change(self):
+        m = KeywordMatcher(['base'])
+        errors = []
+        done = threading.Event()
+
+        def scan():
+            try:
+                while not done.is_set():
+                    self.assertIn('base', m.find_all('a base of kw1 kw2 kw3'))
+            except Exception as ex:
+                errors.append(ex)
+
+        scanners = [threading.Thread(target = scan) for i in range(4)]
+        for t in scanners:
+            t.start()
+        for i in range(300):
+            m.add('kw{0}'.format(i))
+            if i % 3 == 0:
+                m.remove('kw{0}'.format(i // 2))
+        done.set()
+        for t in scanners:
+            t.join()
+
+        self.assertEqual(errors, [])
+
+if __name__ == '__main__':
+    unittest.main()
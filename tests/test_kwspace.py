@@ -0,0 +1,65 @@
+import itertools
+import unittest
+
+from kwspace import KeywordSpaces
+
+class KeywordSpacesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.spaces = KeywordSpaces()
+        glob = self.spaces.global_space
+        for i in range(10):
+            glob.add(i, 'k{0:02d}'.format(i), 'global')
+        glob.add_symptom('zz', 'k01')
+        group = self.spaces.space(-5)
+        for i in range(4):
+            group.add(100 + i, 'k{0:02d}'.format(i * 2), 'group')
+        group.add(200, 'a', 'group')
+
+    def pages(self,
+              spaces,
+              size):
+        pages = []
+        start = 0
+        while start < KeywordSpaces.count(spaces):
+            pages.append(list(itertools.islice(KeywordSpaces.listing(spaces, False, start), size)))
+            start += size
+        return pages
+
+    def test_pages_list_shared_keywords_once(self):
+        spaces = self.spaces.of_chat(-5)
+        listed = [kw for page in self.pages(spaces, 3) for kw, after in page]
+
+        self.assertEqual(listed, ['a', 'k00', 'k02', 'k04', 'k06',
+                                  'k01', 'k03', 'k05', 'k07', 'k08', 'k09', 'zz'])
+        self.assertEqual(KeywordSpaces.count(spaces), len(listed))
+        self.assertIn(('zz', 'k01'), KeywordSpaces.visible(spaces))
+
+    def test_listing_follows_changes(self):
+        spaces = self.spaces.of_chat(-5)
+        self.assertEqual(KeywordSpaces.count(spaces), 12)
+
+        self.spaces.global_space.remove(9)
+        self.spaces.space(-5).add(300, 'b', 'group')
+        listed = [kw for kw, after in KeywordSpaces.listing(spaces)]
+        self.assertEqual(listed[:2], ['a', 'b'])
+        self.assertNotIn('k09', listed)
+        self.assertEqual(KeywordSpaces.count(spaces), 12)
+
+    def test_symptom_keeps_matching_without_its_keyword(self):
+        glob = self.spaces.global_space
+        glob.add(400, 'kitty', 'cont')
+        glob.add_symptom('kitty', 'k00')
+        glob.remove(400)
+
+        spaces = self.spaces.of_chat(7)
+        self.assertEqual(KeywordSpaces.find_all(spaces, 'a kitty'), ['kitty'])
+        self.assertEqual(KeywordSpaces.resolve(spaces, 'kitty'), 'k00')
+
+    def test_chats_only_see_their_group(self):
+        self.assertEqual(KeywordSpaces.find_all(self.spaces.of_chat(-5), 'a k01'), ['a', 'k01'])
+        self.assertEqual(KeywordSpaces.find_all(self.spaces.of_chat(-6), 'a k01'), ['k01'])
+        self.assertIsNone(KeywordSpaces.owner(self.spaces.of_chat(-6), 200))
+
+if __name__ == '__main__':
+    unittest.main()
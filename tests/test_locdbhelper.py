@@ -0,0 +1,98 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+from locdbhelper import locDBHelper, row_tags
+
+class LocDBHelperTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.helpers = []
+
+    def tearDown(self):
+        for h in self.helpers:
+            h.db.close()
+        shutil.rmtree(self.dir)
+
+    def helper(self,
+               dbname = ''):
+        h = locDBHelper(dbname)
+        self.helpers.append(h)
+        return h
+
+    def test_row_tags_distinct(self):
+        self.assertEqual(row_tags({'tags': 'Sushi sushi, ramen'}), ['sushi', 'ramen'])
+        self.assertEqual(row_tags({'tag1': 'bento', 'tag2': 'bento', 'tag3': None}), ['bento'])
+
+    def test_add_remove_duplicate_tags(self):
+        h = self.helper()
+        self.assertTrue(h.add_item('a', 100, '', '', '', 25.01, 121.53, 'sushi sushi'))
+        self.assertTrue(h.add_item('b', 300, '', '', '', 25.02, 121.54, 'sushi, ramen'))
+
+        self.assertEqual(h.get_filtered_choice(['sushi'], 50, 150)['name'], 'a')
+        self.assertEqual([r['name'] for d, r in h.get_nearby(25.01, 121.53, k = 1)], ['a'])
+
+        self.assertTrue(h.add_item('c', 500, '', '', '', 25.5, 121.9, 'omakase omakase'))
+        h.remove_item('c')
+        h.remove_item('a')
+        self.assertEqual(h.tag_index, {'sushi': {'b'}, 'ramen': {'b'}})
+        self.assertEqual(h.price_index, [(300, 'b')])
+        self.assertIsNone(h.get_filtered_choice(['sushi'], 50, 150))
+        self.assertEqual(h.get_filtered_choice(['sushi'])['name'], 'b')
+        self.assertEqual([r['name'] for d, r in h.get_nearby(25.01, 121.53)], ['b'])
+
+        h.remove_item('b')
+        self.assertEqual((h.tag_index, h.price_index, h.grid, h.indexed), ({}, [], {}, 0))
+        self.assertEqual(h.get_nearby(25.01, 121.53), [])
+
+    def test_remove_tag_columns_layout(self):
+        path = os.path.join(self.dir, 'loc.sqlite')
+        with sqlite3.connect(path) as conn:
+            conn.execute('''CREATE TABLE restaurants (name TEXT UNIQUE, pricerange TEXT, tag1 TEXT, tag2 TEXT,
+                                                      tag3 TEXT, latitude REAL, longitude REAL)''')
+            conn.execute("INSERT INTO restaurants VALUES ('a', '100', 'bento', 'bento', '', 25.0, 121.5)")
+            conn.execute("INSERT INTO restaurants VALUES ('b', '200', 'bento', 'rice', '', 25.0, 121.5)")
+
+        h = self.helper(path)
+        self.assertEqual(h.tag_index, {'bento': {'a', 'b'}, 'rice': {'b'}})
+        h.remove_item('a')
+        self.assertEqual(h.tag_index, {'bento': {'b'}, 'rice': {'b'}})
+        self.assertEqual(h.get_filtered_choice(['bento'], None, 150), None)
+        self.assertEqual(h.get_filtered_choice(['bento', 'rice'])['name'], 'b')
+
+    def test_picks_while_items_change(self):
+        h = self.helper()
+        for i in range(200):
+            h.add_item('r{0}'.format(i), 100 + i, '', '', '', 25 + i * 0.001, 121.5, 'ramen')
+        errors = []
+        done = threading.Event()
+
+        def pick():
+            try:
+                while not done.is_set():
+                    h.get_nearby(25.05, 121.5, k = 5)
+                    h.get_filtered_choice(['ramen'], 100, 400)
+                    h.get_choice()
+            except Exception as ex:
+                errors.append(ex)
+
+        pickers = [threading.Thread(target = pick) for i in range(4)]
+        for t in pickers:
+            t.start()
+        for i in range(200, 400):
+            h.add_item('r{0}'.format(i), 100 + i, '', '', '', 25 + (i % 100) * 0.001, 121.5, 'ramen')
+            h.remove_item('r{0}'.format(i - 200))
+        done.set()
+        for t in pickers:
+            t.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(h.pool), 200)
+        self.assertEqual(h.indexed, 200)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from dbpool import open_db
+from migrate import LOC_MIGRATIONS, RESP_MIGRATIONS, SchemaVersionError, migrate
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class MigrateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.pools = []
+
+    def tearDown(self):
+        for db in self.pools:
+            db.close()
+        shutil.rmtree(self.dir)
+
+    def copy_of(self,
+                name):
+        path = os.path.join(self.dir, name)
+        shutil.copy(os.path.join(ROOT, name), path)
+        return path
+
+    def migrated(self,
+                 path,
+                 migrations):
+        db = open_db(path)
+        self.pools.append(db)
+        self.assertEqual(migrate(db, migrations), len(migrations))
+        # Already current, nothing runs again.
+        self.assertEqual(migrate(db, migrations), len(migrations))
+        return db
+
+    def test_example_resp_db(self):
+        path = self.copy_of('resp_db_example.sqlite')
+        with sqlite3.connect(path) as conn:
+            rows = conn.execute('SELECT COUNT(*) FROM resp').fetchone()[0]
+
+        db = self.migrated(path, RESP_MIGRATIONS)
+        self.assertEqual(db.fetchone('SELECT COUNT(*) FROM resp')[0], rows)
+        self.assertEqual(db.fetchone("SELECT COUNT(*) FROM resp WHERE typeof(gid) != 'integer' OR gid > 0")[0], 0)
+        indexes = [r[0] for r in db.fetchall("SELECT name FROM sqlite_master WHERE type = 'index'")]
+        self.assertIn('resp_keyword', indexes)
+
+    def test_example_loc_db(self):
+        path = self.copy_of('loc_db_example.sqlite')
+        db = self.migrated(path, LOC_MIGRATIONS)
+        self.assertEqual(db.fetchone("SELECT COUNT(*) FROM restaurants WHERE typeof(latitude) = 'text'")[0], 0)
+
+    def test_loc_db_with_tags_column(self):
+        path = os.path.join(self.dir, 'tags.sqlite')
+        with sqlite3.connect(path) as conn:
+            conn.execute('CREATE TABLE restaurants (name TEXT, tags TEXT, latitude REAL, longitude REAL)')
+            conn.execute("INSERT INTO restaurants VALUES ('a', ' ', '25.0', '')")
+
+        db = self.migrated(path, LOC_MIGRATIONS)
+        row = db.fetchone('SELECT tags, latitude, longitude FROM restaurants')
+        self.assertEqual((row['tags'], row['latitude'], row['longitude']), (None, 25.0, None))
+
+    def test_refuses_newer_schema(self):
+        path = os.path.join(self.dir, 'new.sqlite')
+        with sqlite3.connect(path) as conn:
+            conn.execute('PRAGMA user_version = {0}'.format(len(LOC_MIGRATIONS) + 1))
+
+        db = open_db(path)
+        self.pools.append(db)
+        with self.assertRaises(SchemaVersionError):
+            migrate(db, LOC_MIGRATIONS)
+
+if __name__ == '__main__':
+    unittest.main()
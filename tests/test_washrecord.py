@@ -0,0 +1,60 @@
+import threading
+import unittest
+from datetime import datetime, timedelta
+
+from washrecord import WashRecord, WashSnake
+
+class WashRecordTest(unittest.TestCase):
+
+    def test_window_expires_after_ttl(self):
+        record = WashRecord(timedelta(seconds = 60), 16)
+        t0 = datetime(2026, 1, 1, 12, 0, 0)
+        record.put(-1, 10, WashSnake(t0, 'hi'))
+
+        self.assertEqual(record.get(-1, 10, t0 + timedelta(seconds = 59)).content, 'hi')
+        self.assertIsNone(record.get(-1, 10, t0 + timedelta(seconds = 60)))
+        self.assertEqual(len(record), 0)
+
+    def test_sweep_drops_quiet_chats(self):
+        record = WashRecord(timedelta(seconds = 60), 16)
+        t0 = datetime(2026, 1, 1, 12, 0, 0)
+        record.put(-1, 10, WashSnake(t0, 'hi'))
+        record.put(-2, 20, WashSnake(t0, 'hi'))
+
+        record.get(-3, 30, t0 + timedelta(seconds = 120))
+        self.assertEqual(record.chats, {})
+
+    def test_chat_cap_drops_oldest_windows(self):
+        record = WashRecord(timedelta(seconds = 60), 3)
+        t0 = datetime(2026, 1, 1, 12, 0, 0)
+        for user_id in range(5):
+            record.put(-1, user_id, WashSnake(t0 + timedelta(seconds = user_id), 'x'))
+
+        self.assertEqual(list(record.chats[-1].keys()), [2, 3, 4])
+        self.assertIsNone(record.get(-1, 0, t0 + timedelta(seconds = 5)))
+
+    def test_concurrent_chats(self):
+        # A short ttl so nearly every get() sweeps the other chats.
+        record = WashRecord(timedelta(microseconds = 1), 8)
+        errors = []
+
+        def work(chat_id):
+            try:
+                for i in range(3000):
+                    now = datetime.now()
+                    record.put(chat_id, i % 20, WashSnake(now, 'x'))
+                    record.get(chat_id, i % 20, now)
+            except Exception as ex:
+                errors.append(ex)
+
+        threads = [threading.Thread(target = work, args = (-c, )) for c in range(1, 9)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+        self.assertLessEqual(max((len(e) for e in record.chats.values()), default = 0), 8)
+
+if __name__ == '__main__':
+    unittest.main()
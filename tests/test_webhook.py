@@ -0,0 +1,71 @@
+import json
+import threading
+import unittest
+import urllib.error
+import urllib.request
+
+from webhook import WebhookServer
+
+SECRET = 'test-secret_123'
+
+class FakeBot:
+
+    def __init__(self):
+        self.bot = None
+        self.handled = []
+        self.event = threading.Event()
+
+    def handle_update(self,
+                      update):
+        self.handled.append(update)
+        self.event.set()
+
+class WebhookServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bot = FakeBot()
+        self.server = WebhookServer(self.bot, '127.0.0.1', 0, '/hook-abc', SECRET, decode = lambda data: data)
+        self.server.start()
+        self.url = 'http://127.0.0.1:{0}'.format(self.server.httpd.server_address[1])
+
+    def tearDown(self):
+        self.server.stop()
+
+    def post(self,
+             path,
+             body,
+             secret = SECRET):
+        headers = {'Content-Type': 'application/json'}
+        if secret is not None:
+            headers[WebhookServer.SECRET_HEADER] = secret
+        req = urllib.request.Request(self.url + path, data = body, headers = headers, method = 'POST')
+        try:
+            with urllib.request.urlopen(req, timeout = 5) as res:
+                return res.status
+        except urllib.error.HTTPError as ex:
+            return ex.code
+
+    def test_accepts_update_with_secret(self):
+        update = {'update_id': 1, 'message': {'text': 'hi'}}
+        self.assertEqual(self.post('/hook-abc', json.dumps(update).encode('utf-8')), 200)
+        self.assertTrue(self.bot.event.wait(5))
+        self.assertEqual(self.bot.handled, [update])
+
+    def test_rejects_missing_or_wrong_secret(self):
+        body = json.dumps({'update_id': 2}).encode('utf-8')
+        self.assertEqual(self.post('/hook-abc', body, secret = None), 403)
+        self.assertEqual(self.post('/hook-abc', body, secret = 'wrong'), 403)
+        self.assertEqual(self.bot.handled, [])
+
+    def test_rejects_other_paths_and_bad_json(self):
+        self.assertEqual(self.post('/', b'{}'), 404)
+        self.assertEqual(self.post('/hook-abc', b'not json'), 400)
+        self.assertEqual(self.bot.handled, [])
+
+    def test_refuses_default_path_or_missing_secret(self):
+        for path, secret in (('/', SECRET), (None, SECRET), ('/hook', None), ('/hook', 'bad secret!')):
+            with self.assertRaises(ValueError):
+                WebhookServer(self.bot, '127.0.0.1', 0, path, secret)
+
+if __name__ == '__main__':
+    unittest.main()
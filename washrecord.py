@@ -0,0 +1,112 @@
+import threading
+from collections import OrderedDict
+from datetime import timedelta
+
+class WashSnake:
+    """
+    This object records the latest repeated message of a user in a chat.
+
+    Attributes:
+        firsttime (datetime):
+            Date of the first message of the current repeat window.
+        content (str):
+            Normalized message content.
+        repeattimes (int):
+            Repeats seen within the window.
+        responded (bool):
+            Whether the anti-flood response was already sent for this window.
+    """
+    __slots__ = ('firsttime', 'content', 'repeattimes', 'responded')
+
+    def __init__(self,
+                 firsttime,
+                 content):
+        self.firsttime = firsttime
+        self.content = content
+        self.repeattimes = 0
+        self.responded = False
+
+class WashRecord:
+    """
+    This object keeps WashSnake entries per chat and user with bounded memory.
+
+    Entries are keyed by integer ids and kept per chat in window order, so
+    entries whose window has expired are dropped from the front, chats are
+    capped at `chat_cap` users (oldest windows go first), and a periodic
+    sweep clears chats that went quiet.
+
+    Updates of different chats are handled on several threads, and a sweep
+    walks every chat, so get(), put() and sweep() hold one lock.
+    """
+
+    def __init__(self,
+                 ttl = timedelta(seconds = 60),
+                 chat_cap = 256):
+        self.ttl = ttl
+        self.chat_cap = chat_cap
+        # chat_id -> OrderedDict(user_id -> WashSnake), oldest window first
+        self.chats = dict()
+        self.last_sweep = None
+        self.lock = threading.RLock()
+
+    def _expire(self, entries, now):
+        limit = now - self.ttl
+        while entries:
+            entry = next(iter(entries.values()))
+            if entry.firsttime > limit:
+                break
+            entries.popitem(last = False)
+
+    def get(self,
+            chat_id,
+            user_id,
+            now):
+        """
+        Returns:
+            WashSnake of user_id in chat_id whose window is still open at now, or None.
+        """
+        with self.lock:
+            self.sweep(now)
+
+            entries = self.chats.get(chat_id)
+            if not entries:
+                return None
+            self._expire(entries, now)
+            return entries.get(user_id)
+
+    def put(self,
+            chat_id,
+            user_id,
+            entry):
+        """
+        Store entry as the latest window of user_id in chat_id.
+        """
+        with self.lock:
+            entries = self.chats.get(chat_id)
+            if entries is None:
+                entries = self.chats[chat_id] = OrderedDict()
+
+            entries[user_id] = entry
+            entries.move_to_end(user_id)
+            while len(entries) > self.chat_cap:
+                entries.popitem(last = False)
+
+    def sweep(self,
+              now):
+        """
+        Drop expired entries of every chat, at most once per ttl.
+        """
+        with self.lock:
+            if self.last_sweep is not None and now - self.last_sweep < self.ttl:
+                return
+            self.last_sweep = now
+
+            for chat_id in list(self.chats.keys()):
+                entries = self.chats[chat_id]
+                self._expire(entries, now)
+                if not entries:
+                    del self.chats[chat_id]
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(e) for e in self.chats.values())
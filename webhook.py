@@ -0,0 +1,160 @@
+import hmac
+import json
+import logging
+import queue
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class WebhookServer:
+    """
+    This object receives updates pushed by Telegram over HTTP.
+
+    Each POSTed Update is acknowledged right away and put on a bounded
+    queue; worker threads decode it and feed it to bot.handle_update(),
+    the same path as long polling. A full queue answers 503 so Telegram
+    retries the update later instead of it being dropped. With a single
+    worker (the default) updates are handled in arrival order.
+
+    Only POSTs to `path` carrying the secret token given to setWebhook in
+    the X-Telegram-Bot-Api-Secret-Token header are accepted, so finding
+    the port is not enough to inject updates.
+
+    Attributes:
+        bot (object):
+            Bot providing handle_update(update) and `bot` (telegram.Bot).
+        path (str):
+            URL path accepting updates, not '/' (e.g. '/<random>').
+        secret_token (str):
+            1-256 characters of A-Z, a-z, 0-9, _ and -.
+    """
+
+    SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+    def __init__(self,
+                 bot,
+                 listen = '127.0.0.1',
+                 port = 8443,
+                 path = None,
+                 secret_token = None,
+                 queue_size = 1000,
+                 workers = 1,
+                 decode = None):
+        """
+        Arguments:
+            decode (Optional[func(dict)]):
+                Turns Update JSON into the object passed to handle_update,
+                telegram.Update.de_json by default.
+        Raises:
+            ValueError: when path is missing or '/', or secret_token is
+            missing or malformed.
+        """
+        if not path or path == '/' or not path.startswith('/'):
+            raise ValueError('webhook path must be set to something other than "/", got {0!r}'.format(path))
+        if not secret_token or not re.fullmatch('[A-Za-z0-9_-]{1,256}', secret_token):
+            raise ValueError('webhook secret token must be 1-256 characters of A-Z, a-z, 0-9, _ and -')
+
+        self.bot = bot
+        self.path = path
+        self.secret_token = secret_token
+        self.queue = queue.Queue(maxsize = queue_size)
+        self.workers = workers
+        self.decode = decode
+        self.logger = logging.getLogger("WebhookServer")
+
+        self.httpd = ThreadingHTTPServer((listen, port), self.make_handler())
+        self.httpd.daemon_threads = True
+        self.threads = []
+
+    def make_handler(self):
+        server = self
+
+        class UpdateHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path != server.path:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+
+                token = self.headers.get(server.SECRET_HEADER, '')
+                if not hmac.compare_digest(token.encode('utf-8'), server.secret_token.encode('utf-8')):
+                    server.logger.warning('rejected update without a valid secret token from {0}'.format(self.client_address[0]))
+                    self.send_response(403)
+                    self.end_headers()
+                    return
+
+                length = int(self.headers.get('Content-Length', 0))
+                try:
+                    data = json.loads(self.rfile.read(length).decode('utf-8'))
+                except ValueError:
+                    self.send_response(400)
+                    self.end_headers()
+                    return
+
+                try:
+                    server.queue.put_nowait(data)
+                    self.send_response(200)
+                except queue.Full:
+                    server.logger.warning('update queue full, asking for a retry')
+                    self.send_response(503)
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                server.logger.debug(format % args)
+
+        return UpdateHandler
+
+    def decode_update(self,
+                      data):
+        if self.decode:
+            return self.decode(data)
+
+        import telegram
+        return telegram.Update.de_json(data, self.bot.bot)
+
+    def work(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                break
+
+            try:
+                self.bot.handle_update(self.decode_update(data))
+            except Exception:
+                self.logger.exception('!!! EXCEPTION HAS OCCURRED !!!')
+            finally:
+                self.queue.task_done()
+
+    def start_workers(self):
+        for i in range(self.workers):
+            t = threading.Thread(target = self.work, name = 'WebhookWorker-{0}'.format(i), daemon = True)
+            t.start()
+            self.threads.append(t)
+
+    def start(self):
+        """
+        Start workers and serve in a background thread.
+        """
+        self.start_workers()
+
+        t = threading.Thread(target = self.httpd.serve_forever, name = 'WebhookServer', daemon = True)
+        t.start()
+        self.threads.append(t)
+        self.logger.info('listening on {0}:{1}'.format(*self.httpd.server_address))
+
+    def serve_forever(self):
+        """
+        Start workers and block serving requests.
+        """
+        self.start_workers()
+        self.logger.info('listening on {0}:{1}'.format(*self.httpd.server_address))
+        self.httpd.serve_forever()
+
+    def stop(self):
+        """
+        Stop serving; queued updates are still handled by the workers.
+        """
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        for i in range(self.workers):
+            self.queue.put(None)